@@ -1,18 +1,58 @@
-from lib import network, display, _thread
+from lib import network, _thread, IndexerClosed
 from argparse import ArgumentParser
-from lib.consts import networkOpts
+import json, os, sys
+from lib.consts import networkOpts, metricsOpts, storeOpts, roomOpts
 from lib import sebcrypter as seb
+from lib import logger
+from lib.history import History
 
-def _receiver(client:network.Client,stdscr:display.Display):
+def _historyName(ip:str,port:int,room:str=roomOpts.default) -> str:
+    """One history per room of a server, the default room keeps the name of the server"""
+    name = "%s_%s" % (ip, port) if room == roomOpts.default else "%s_%s#%s" % (ip, port, room)
+    return name.replace(":","_")
+
+def _receiver(client:network.Client,stdscr:"display.Display",ip:str,port:int):
+    """Shows what is received for the room of the display, switches it when a join is answered"""
     while True:
-        code , msg = client.getMessage()
+        try:
+            code , msg = client.getMessage()
+        except IndexerClosed:
+            return
+        if code == networkOpts.join:
+            if msg != stdscr.room:
+                previous = stdscr.room
+                stdscr.switchRoom(msg,History(_historyName(ip,port,msg)))
+                client.part(previous)
+            continue
+        elif code == networkOpts.part:
+            if client.room is None:
+                # The server did not let it in
+                client.room = stdscr.room
+            continue
+        # Payloads of a room end with it
+        *payload, room = msg
+        if room != stdscr.room:
+            continue
         if code == networkOpts.message:
-            stdscr.messageBar.addMessage(*msg)
+            stdscr.addMessage(*payload)
+        elif code == networkOpts.history:
+            stdscr.replayMessages(payload[0])
         elif code == networkOpts.users:
-            msg.insert(0,stdscr.user)
-            stdscr.userBar.updateUser(msg)
+            payload[0].insert(0,stdscr.user)
+            stdscr.updateUser(payload[0])
+        elif code == networkOpts.userJoined:
+            stdscr.addUser(payload[0])
+        elif code == networkOpts.userLeft:
+            stdscr.removeUser(payload[0])
+
+def _join(client:network.Client,room:str):
+    try:
+        client.join(room)
+    except (ValueError, ConnectionError) as e:
+        client.logger.warn("Room is not joined : %s", e)
 
 def client(userName:str,password:str,ip:str,port:int=networkOpts.defaultPort):
+    from lib import display
     key = seb.keygen()
     if not port:
         port = networkOpts.defaultPort
@@ -29,12 +69,14 @@ def client(userName:str,password:str,ip:str,port:int=networkOpts.defaultPort):
     if not client.isLoggedIn():
         print("Login Failed")
         quit()
-    stdscr = display.Display(userName)
-    _thread(_receiver,client,stdscr)
+    stdscr = display.Display(userName,History(_historyName(ip,port)))
+    _thread(_receiver,client,stdscr,ip,port)
     try:
         while True:
             msg = stdscr.inputBar.getInput()
-            if msg:
+            if msg.startswith("/join "):
+                _join(client,msg[len("/join "):].strip())
+            elif msg:
                 client.addToIndex(msg)
     except KeyboardInterrupt:
         pass
@@ -42,14 +84,104 @@ def client(userName:str,password:str,ip:str,port:int=networkOpts.defaultPort):
         stdscr.logger.error("An Error Accurated",exc_info=True)
     finally:
         stdscr.exit()
+        stdscr.history.close()
         client.terminateConnection()
         quit()
 
-def server(password):
-    server = network.Server(password)
+def _printer(bot):
+    for msg, user in bot:
+        print("%s > %s" % (user, msg), flush=True)
+
+def _sendLines(bot,messages:list=None):
+    """Sends the messages, or the lines of stdin in batches as they come"""
+    if messages:
+        bot.sendMany(messages)
+        return
+    rest = b""
+    while True:
+        data = os.read(sys.stdin.fileno(),networkOpts.recvBufferSize)
+        if not data:
+            break
+        *lines, rest = (rest + data).split(b"\n")
+        bot.sendMany([line.decode(errors="replace") for line in lines if line])
+    if rest:
+        bot.sendMany([rest.decode(errors="replace")])
+
+def bot(userName:str,password:str,ip:str,port:int=networkOpts.defaultPort,messages:list=None,receive:bool=False,
+        room:str=None):
+    from lib.bot import Bot, LoginError
+    try:
+        b = Bot(userName,ip,port,password)
+    except LoginError as e:
+        print(e)
+        quit()
+    try:
+        if room and room != roomOpts.default:
+            try:
+                b.join(room)
+            except (ValueError, ConnectionError) as e:
+                print(e)
+                return
+            b.part(roomOpts.default)
+        if receive:
+            _thread(_sendLines,b,messages)
+            _printer(b)
+        else:
+            _sendLines(b,messages)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        b.close()
+
+def server(password,engine="threading",queueSize=networkOpts.sendQueueSize,slowConsumer=networkOpts.slowConsumer,
+           encryptWorkers=networkOpts.encryptWorkers,port=networkOpts.defaultPort,metricsFile=None,
+           metricsInterval=metricsOpts.interval,store=None,fsyncInterval=storeOpts.fsyncInterval,
+           historySize=networkOpts.historySize,workers=1,peers=(),peerPort=None):
+    if workers > 1:
+        from lib import bus
+        from lib.store import MessageStore
+        # The parent keeps the store, the workers send it every message over the bus
+        bus.run(workers,MessageStore(store,fsyncInterval=fsyncInterval) if store else None,historySize,
+                password=password,sendQueueSize=queueSize,slowConsumer=slowConsumer,
+                encryptWorkers=encryptWorkers,port=port,metricsFile=metricsFile,metricsInterval=metricsInterval)
+    elif engine == "asyncio":
+        from lib import asyncnetwork
+        server = asyncnetwork.AsyncServer(password,port,sendQueueSize=queueSize,slowConsumer=slowConsumer,
+                                          encryptWorkers=encryptWorkers,metricsFile=metricsFile,
+                                          metricsInterval=metricsInterval,store=store,fsyncInterval=fsyncInterval,
+                                          historySize=historySize)
+    else:
+        federation = None
+        if peers or peerPort:
+            from lib.federation import Federation
+            # Peers prove that they know the password of this server
+            federation = Federation(peerPort,peers,(password or "").encode())
+        server = network.Server(password,queueSize,slowConsumer,encryptWorkers,port,metricsFile,metricsInterval,
+                                store,fsyncInterval,historySize,federation=federation)
+
+def stats(ip:str,port:int=networkOpts.defaultPort,password:str=None,prometheus:bool=False):
+    """Prints the metrics of a server without logging in as a user"""
+    from lib import metrics
+    client = network.Client(None,seb.keygen(),ip,port or networkOpts.defaultPort)
+    try:
+        if client.isPasswordRequired():
+            if not password:
+                password = input("Password : ")
+            if client.login(password) != networkOpts.correctPassword:
+                print("Login Failed")
+                return
+        try:
+            result = client.stats()
+        except (TimeoutError, ConnectionError):
+            print("Server did not send its stats")
+            return
+        print(metrics.prometheus(result) if prometheus else json.dumps(result,indent=2))
+    finally:
+        client.terminateConnection()
 
 argparser = ArgumentParser(add_help=True,exit_on_error=True)
 argparser.set_defaults(id=0)
+argparser.add_argument("-l","--log-level",choices=("debug","info","warn","error","fatal"),help="log level, also read from $OLDSCHOOL_LOG_LEVEL")
 subparsers = argparser.add_subparsers()
 clientParser = subparsers.add_parser("client",help="Client")
 clientParser.add_argument("ip",help="IP address of server you will connect")
@@ -59,8 +191,60 @@ clientParser.add_argument("-P","--password",help="login password")
 clientParser.set_defaults(id=1)
 serverParser = subparsers.add_parser("server",help="Server")
 serverParser.add_argument("-P","--password",help="optional password")
+serverParser.add_argument("-p","--port",type=int,default=networkOpts.defaultPort,help="optional port")
+serverParser.add_argument("-e","--engine",choices=("threading","asyncio"),default="threading",help="server engine")
+serverParser.add_argument("-q","--queue-size",type=int,default=networkOpts.sendQueueSize,help="messages queued per client")
+serverParser.add_argument("-s","--slow-consumer",choices=("disconnect","drop"),default=networkOpts.slowConsumer,help="what to do when a client's queue is full")
+serverParser.add_argument("--encrypt-workers",type=int,default=networkOpts.encryptWorkers,help="workers that encrypt broadcasts, 1 to disable")
+serverParser.add_argument("--metrics-file",help="file the metrics are written to, JSON if it ends with .json, Prometheus text otherwise")
+serverParser.add_argument("--metrics-interval",type=float,default=metricsOpts.interval,help="seconds between writes of the metrics file")
+serverParser.add_argument("--store",help="directory every message is kept in")
+serverParser.add_argument("--fsync-interval",type=float,default=storeOpts.fsyncInterval,help="seconds between syncs of the store to the disk, 0 for every write, -1 to leave it to the OS")
+serverParser.add_argument("--history",type=int,default=networkOpts.historySize,help="recent messages sent to a client when it logs in, 0 to disable")
+serverParser.add_argument("-w","--workers",type=int,default=1,help="processes that share the port, only with the threading engine")
+serverParser.add_argument("--peer",action="append",default=[],metavar="HOST:PORT",help="server whose users share the chat, can be repeated")
+serverParser.add_argument("--peer-port",type=int,help="port other servers link to with --peer")
 serverParser.set_defaults(id=2)
+statsParser = subparsers.add_parser("stats",help="Metrics of a running server")
+statsParser.add_argument("ip",help="IP address of the server")
+statsParser.add_argument("-p","--port",type=int,help="optional port")
+statsParser.add_argument("-P","--password",help="password of the server")
+statsParser.add_argument("--prometheus",action="store_true",help="print in the Prometheus text format instead of JSON")
+statsParser.set_defaults(id=6)
+botParser = subparsers.add_parser("bot",help="Client without a display, sends the lines of stdin")
+botParser.add_argument("ip",help="IP address of server you will connect")
+botParser.add_argument("username",help="user name for server")
+botParser.add_argument("-p","--port",type=int,help="optional port")
+botParser.add_argument("-P","--password",help="login password")
+botParser.add_argument("-m","--message",action="append",help="message to send instead of stdin, can be repeated")
+botParser.add_argument("-r","--receive",action="store_true",help="print received messages until the connection is closed")
+botParser.add_argument("-j","--room",help="room to send to and receive from instead of the default one")
+botParser.set_defaults(id=4)
+benchParser = subparsers.add_parser("bench",help="Benchmarks")
+benchParser.add_argument("-r","--repeat",type=int,default=5,help="timed repetitions of every case")
+benchParser.add_argument("-w","--warmup",type=int,default=1,help="repetitions that are not counted")
+benchParser.add_argument("-k","--filter",action="append",help="run the cases whose names contain it, can be repeated")
+benchParser.add_argument("-o","--output",help="JSON file for the result")
+benchParser.add_argument("-c","--compare",help="JSON result of an earlier run to compare with")
+benchParser.add_argument("-t","--threshold",type=float,default=0.1,help="slowdown that is a regression, 0.1 is 10%%")
+benchParser.add_argument("--throughput",action="store_true",help="run the transfer and broadcast throughput benchmarks instead")
+benchParser.set_defaults(id=3)
+loadParser = subparsers.add_parser("load",help="Load test, starts a server and simulated clients")
+loadParser.add_argument("-c","--clients",type=int,default=20,help="simulated clients")
+loadParser.add_argument("-r","--rate",type=float,default=100,help="messages sent a second by all clients")
+loadParser.add_argument("-S","--size",type=int,default=64,help="message size")
+loadParser.add_argument("-d","--duration",type=float,default=10,help="seconds messages are sent")
+loadParser.add_argument("--churn",type=float,default=0,help="connections opened and closed a second")
+loadParser.add_argument("-e","--engine",choices=("threading","asyncio"),default="threading",help="server engine")
+loadParser.add_argument("-p","--port",type=int,default=networkOpts.defaultPort+1,help="port of the server")
+loadParser.add_argument("-q","--queue-size",type=int,default=networkOpts.sendQueueSize,help="messages queued per client")
+loadParser.add_argument("-s","--slow-consumer",choices=("disconnect","drop"),default=networkOpts.slowConsumer,help="what to do when a client's queue is full")
+loadParser.add_argument("--encrypt-workers",type=int,default=networkOpts.encryptWorkers,help="workers that encrypt broadcasts, 1 to disable")
+loadParser.add_argument("-o","--output",help="JSON file for the result, stdout if not given")
+loadParser.set_defaults(id=5)
 args = argparser.parse_args()
+if args.log_level:
+    logger.setLevel(args.log_level)
 
 if args.id == 1:
     ip = args.ip
@@ -69,7 +253,42 @@ if args.id == 1:
     password = args.password
     client(userName,password,ip,port)
 elif args.id == 2:
+    if args.workers > 1 and args.engine != "threading":
+        serverParser.error("--workers needs the threading engine")
+    if (args.peer or args.peer_port) and (args.workers > 1 or args.engine != "threading"):
+        serverParser.error("--peer and --peer-port need the threading engine without --workers")
+    from lib.federation import parsePeer
+    try:
+        peers = [parsePeer(peer) for peer in args.peer]
+    except ValueError:
+        serverParser.error("--peer must be HOST:PORT")
     password = args.password
-    server(password)
+    engine = args.engine
+    server(password,engine,args.queue_size,args.slow_consumer,args.encrypt_workers,args.port,
+           args.metrics_file,args.metrics_interval,args.store,
+           None if args.fsync_interval < 0 else args.fsync_interval,args.history,args.workers,
+           peers,args.peer_port)
+elif args.id == 3:
+    from lib import benchmark
+    if args.throughput:
+        benchmark.run()
+    else:
+        result = benchmark.suite(args.repeat,args.warmup,args.filter)
+        baseline = benchmark.load(args.compare) if args.compare else None
+        regressions = benchmark.report(result,baseline,args.threshold)
+        if args.output:
+            benchmark.save(result,args.output)
+        if regressions:
+            print("Regressions : %s" % ", ".join(regressions))
+            sys.exit(1)
+elif args.id == 4:
+    bot(args.username,args.password,args.ip,args.port,args.message,args.receive,args.room)
+elif args.id == 5:
+    from lib import loadtest
+    result = loadtest.run(args.clients,args.rate,args.size,args.duration,args.churn,args.engine,args.port,
+                          args.queue_size,args.slow_consumer,args.encrypt_workers)
+    loadtest.save(result,args.output)
+elif args.id == 6:
+    stats(args.ip,args.port,args.password,args.prometheus)
 else:
     argparser.print_help()
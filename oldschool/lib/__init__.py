@@ -1,22 +1,74 @@
 import threading as th
+from collections import deque
+
+class IndexerClosed(Exception):
+    """Raised when waiting on an _Indexer or _Value that has been closed"""
 
 class _Indexer:
-    def __init__(self, name = None):
+    def __init__(self, name = None, maxSize = 0):
         self.name = name
-        self._list = []
-    
+        self.maxSize = maxSize
+        self._list = deque()
+        self._cond = th.Condition()
+        self.closed = False
+
     def add(self,o):
-        self._list.insert(0,o)
+        """Returns False if the item is not added because closed or full"""
+        with self._cond:
+            if self.closed or (self.maxSize and len(self._list) >= self.maxSize):
+                return False
+            self._list.append(o)
+            self._cond.notify()
+            return True
+
+    def pop(self, timeout = None):
+        """Blocks until an item is added, raises TimeoutError or IndexerClosed"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._list or self.closed, timeout):
+                raise TimeoutError(self.name)
+            if self._list:
+                return self._list.popleft()
+            raise IndexerClosed(self.name)
+
+    def close(self):
+        """Wakes up every waiter, pop raises IndexerClosed once the items run out"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._list)
+
+class _Value:
+    def __init__(self, name = None):
+        self.name = name
+        self._value = None
+        self._cond = th.Condition()
+        self.closed = False
+
+    def set(self, value):
+        with self._cond:
+            self._value = value
+            self._cond.notify_all()
+
+    def get(self, timeout = None):
+        """Blocks until a value is set, returns None if closed before"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._value is not None or self.closed, timeout):
+                raise TimeoutError(self.name)
+            return self._value
 
+    def take(self, timeout = None):
+        """Same as get but resets the value"""
+        with self._cond:
+            value = self.get(timeout)
+            self._value = None
+            return value
 
-    def pop(self):
-        while True:
-            try:
-                o = self._list.pop()
-                break
-            except IndexError:
-                pass
-        return o
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
 
 def _thread(func, *args, daemon = True, **kwargs):
     t = th.Thread(target=func, args=args, kwargs=kwargs)
@@ -0,0 +1,474 @@
+"""asyncio based server engine that speaks the same protocol as network.Client"""
+import asyncio
+import socket
+import time
+from hashlib import md5
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from .consts import networkOpts, generalOpts, metricsOpts, storeOpts, roomOpts
+    from .logger import *
+    from . import sebcrypter as seb
+    from .network import _ServerBase, _Window, _Recent
+    from .broadcast import BroadcastEncrypter
+except ImportError:
+    from consts import networkOpts, generalOpts, metricsOpts, storeOpts, roomOpts
+    from logger import *
+    import sebcrypter as seb
+    from network import _ServerBase, _Window, _Recent
+    from broadcast import BroadcastEncrypter
+
+
+class _AsyncClient:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 queueSize: int = networkOpts.sendQueueSize):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+        self.userName = None
+        self.id = None
+        self.rawKey = None
+        self.key = None
+        self.keySent = False
+        self.sharedKey = None
+        self.version = 1
+        self.sendVersion = 1
+        self.recvVersion = 1
+        self.peerVersion = None
+        self.versionAnswered = False
+        self.authorized = False  # passed the password, may ask for stats
+        self.rooms = set()
+        self.writerTask = None
+        self.transferLock = asyncio.Lock()
+        self._payload = asyncio.Queue()
+        self._hash = asyncio.Queue()
+        self._data = asyncio.Queue()
+        self._response = asyncio.Queue()
+        self._messages = asyncio.Queue()
+        self._outbound = asyncio.Queue(queueSize)
+        self._incomingSize = 0
+        self._incomingHashes = 0
+
+    def write(self, code: int, data: bytes = b"", flags: int = 0):
+        code = code.to_bytes(networkOpts.constLenght, networkOpts.byteorder)
+        if self.sendVersion >= 2:
+            if data:
+                flags |= networkOpts.flags.payload
+            header = networkOpts.constLenght + networkOpts.flagsLenght
+            length = (header + len(data)).to_bytes(networkOpts.frameLenght, networkOpts.byteorder)
+            flags = flags.to_bytes(networkOpts.flagsLenght, networkOpts.byteorder)
+            self.writer.write(length + code + flags + data)
+        else:
+            self.writer.write(code + data)
+
+    def startTransfer(self, dataSize: int):
+        self._incomingSize = dataSize
+        self._incomingHashes = 0
+
+    def chunkSize(self) -> int:
+        return _Window.chunkSize(self._incomingSize, self._incomingHashes)
+
+    def setKey(self, key: bytes):
+        self.rawKey = key
+        self.key = seb.readkey(key=key)
+        self.keySent = True
+
+    def __repr__(self) -> str:
+        return str(self.addr)
+
+
+class AsyncServer(_ServerBase):
+    def __init__(self, password: str = None, port: int = networkOpts.defaultPort,
+                 sendQueueSize: int = networkOpts.sendQueueSize,
+                 slowConsumer: str = networkOpts.slowConsumer,
+                 encryptWorkers: int = networkOpts.encryptWorkers,
+                 metricsFile: str = None, metricsInterval: float = metricsOpts.interval,
+                 store: str = None, fsyncInterval: float = storeOpts.fsyncInterval,
+                 historySize: int = networkOpts.historySize):
+        self.logger = Logger("network.AsyncServer")
+        self.password = password
+        if self.password:
+            self.password = self.password.encode()
+        self.port = port
+        self.sendQueueSize = sendQueueSize
+        self.slowConsumer = slowConsumer
+        self.encrypter = BroadcastEncrypter(encryptWorkers)
+        self._id = 0
+        self.clients = []
+        self.clientsLoggedIn = []
+        self.recent = _Recent(historySize)
+        self.rooms = {}  # room : {client : None}
+        self.startMetrics("asyncio", metricsFile, metricsInterval)
+        self.metrics.gauge("rooms", lambda: len(self.rooms))
+        # The same gauges as Server, received messages wait in the queue of their client
+        self.metrics.gauge("messageQueue", lambda: sum(c._messages.qsize() for c in self.clientsLoggedIn.copy()))
+        # Presence changes are sent when they happen
+        self.metrics.gauge("presenceQueue", lambda: 0)
+        self.metrics.gauge("sendQueues", lambda: sum(c._outbound.qsize() for c in self.clientsLoggedIn.copy()))
+        self.metrics.gauge("sendQueueMax", lambda: max((c._outbound.qsize() for c in self.clientsLoggedIn.copy()), default=0))
+        self.openStore(store, fsyncInterval)
+        self._raiseFileLimit()
+        asyncio.run(self.serve())
+
+    def _raiseFileLimit(self):
+        if not resource:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+                self.logger.info("File descriptor limit raised : %s", hard)
+            except (ValueError, OSError):
+                self.logger.warn("File descriptor limit is %s", soft)
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.connection, "0.0.0.0", self.port,
+            backlog=networkOpts.backlog, reuse_address=True)
+        self.logger.info("Server is ready and running")
+        async with server:
+            await server.serve_forever()
+
+    async def connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = _AsyncClient(reader, writer, self.sendQueueSize)
+        self.logger.info("Connectted : %s", conn)
+        self.metrics.inc("connections")
+        self.clients.append(conn)
+        frames = asyncio.create_task(self.makeConnection(conn))
+        session = asyncio.create_task(self.authentication(conn))
+        await asyncio.wait((frames, session), return_when=asyncio.FIRST_COMPLETED)
+        if not frames.done():
+            # Session is over, wait until the peer reads the termination
+            try:
+                await asyncio.wait_for(frames, networkOpts.timeout)
+            except asyncio.TimeoutError:
+                pass
+        session.cancel()
+        if conn.writerTask:
+            conn.writerTask.cancel()
+        self.removeClient(conn)
+        writer.close()
+        self.logger.info("Disconnected : %s", conn)
+
+    async def makeConnection(self, conn: _AsyncClient):
+        try:
+            while True:
+                if conn.recvVersion >= 2:
+                    code = await self.recvFrame(conn)
+                else:
+                    code = await self.recvCode(conn)
+                if code >> 8 == networkOpts.version >> 8:
+                    conn.peerVersion = code & 0xff
+                    self.answerVersion(conn)
+                elif code in (networkOpts.message, networkOpts.join, networkOpts.part):
+                    conn._messages.put_nowait(code)
+                elif code == networkOpts.stats:
+                    if conn.authorized:
+                        asyncio.create_task(self.sendStats(conn))
+                else:
+                    pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.logger.info("Connection Lost : %s", conn)
+
+    async def recvCode(self, conn: _AsyncClient) -> int:
+        reader = conn.reader
+        code = self.convertBytes(await reader.readexactly(networkOpts.constLenght))
+        if code == networkOpts.dataLenght:
+            dataLen = await reader.readexactly(networkOpts.dataSizeLenght)
+            conn.startTransfer(self.convertBytes(dataLen))
+            conn._payload.put_nowait((None, dataLen))
+        elif code == networkOpts.hash:
+            conn._incomingHashes += 1
+            conn._hash.put_nowait(await reader.readexactly(networkOpts.hashLenght))
+        elif code == networkOpts.data:
+            conn._data.put_nowait(await reader.readexactly(conn.chunkSize()))
+        elif code == networkOpts.response:
+            conn._response.put_nowait(await reader.readexactly(2))
+        return code
+
+    async def recvFrame(self, conn: _AsyncClient) -> int:
+        length = self.convertBytes(await conn.reader.readexactly(networkOpts.frameLenght))
+        if not networkOpts.constLenght + networkOpts.flagsLenght <= length <= networkOpts.maxFrameLenght:
+            self.logger.error("Invalid frame length : %s %s", conn, length)
+            # Ends the connection like a lost one
+            raise ConnectionError("Invalid frame length")
+        frame = await conn.reader.readexactly(length)
+        code = self.convertBytes(frame[:networkOpts.constLenght])
+        flags = frame[networkOpts.constLenght]
+        if flags & networkOpts.flags.payload:
+            payload = frame[networkOpts.constLenght + networkOpts.flagsLenght:]
+            if code == networkOpts.response:
+                conn._response.put_nowait(payload)
+            else:
+                conn._payload.put_nowait((flags, payload))
+        return code
+
+    def answerVersion(self, conn: _AsyncClient):
+        if conn.versionAnswered:
+            conn.recvVersion = conn.version
+        else:
+            conn.versionAnswered = True
+            conn.version = min(conn.peerVersion, networkOpts.protocolVersion)
+            asyncio.create_task(self.upgrade(conn))
+
+    async def upgrade(self, conn: _AsyncClient):
+        async with conn.transferLock:
+            conn.write(networkOpts.version | conn.version)
+            conn.sendVersion = conn.version
+        self.logger.debug("Protocol version : %s %s", conn, conn.version)
+
+    async def authentication(self, conn: _AsyncClient):
+        try:
+            await asyncio.wait_for(self.addKey(conn), networkOpts.timeout)
+            if self.password:
+                conn.write(networkOpts.passwordRequired)
+                fails = 0
+                while True:
+                    passwd = await asyncio.wait_for(self.recvDecoded(conn), networkOpts.timeout)
+                    if passwd == self.password:
+                        conn.authorized = True
+                        conn.write(networkOpts.correctPassword)
+                        break
+                    fails += 1
+                    self.metrics.inc("failedLogins")
+                    self.logger.warn("Received password is incorrect : %s", conn)
+                    await asyncio.sleep(3)
+                    conn.write(networkOpts.incorrectPassword)
+                    if fails == 3:
+                        conn.write(networkOpts.loginFailed)
+                        await self.terminateConnection(conn, "3 failed login attemp")
+                        return
+            else:
+                conn.authorized = True
+                conn.write(networkOpts.passwordNotRequired)
+            if not await asyncio.wait_for(self.allowConnection(conn), networkOpts.timeout):
+                return
+        except asyncio.TimeoutError:
+            await self.terminateConnection(conn, "Timeout")
+            return
+        while True:
+            code = await conn._messages.get()
+            if code == networkOpts.message:
+                await self.message(conn)
+            else:
+                await self.room(code, conn)
+
+    async def addKey(self, conn: _AsyncClient):
+        conn.write(networkOpts.key)
+        key = await self.recvDecoded(conn)
+        conn.setKey(key)
+        conn.sharedKey = self.encrypter.share(conn.rawKey, conn.key)
+        self.logger.debug("Key added : %s", conn)
+
+    async def allowConnection(self, conn: _AsyncClient) -> bool:
+        conn.write(networkOpts.userName)
+        userName = self.checkUserName(await self.recvDecoded(conn))
+        if not userName:
+            conn.write(networkOpts.inappropriateUserName)
+            await self.terminateConnection(conn, "Inappropriate user name")
+            return False
+        conn.write(networkOpts.appropriateUserName)
+        conn.write(networkOpts.loginSuccessful)
+        conn.userName = userName.ljust(generalOpts.maxUserNameLenght)
+        conn.id = self.id()
+        conn.writerTask = asyncio.create_task(self.sender(conn))
+        self.clientsLoggedIn.append(conn)
+        self.joinRoom(conn, roomOpts.default)
+        self.metrics.inc("logins")
+        self.logger.info("Client added clientsLoggedIn : %s", conn)
+        return True
+
+    async def message(self, conn: _AsyncClient):
+        msg = await self.recvDecoded(conn)
+        start = time.perf_counter()
+        self.logger.debug("Received message : %s %s", conn, msg)
+        self.metrics.inc("messagesIn")
+        self.metrics.inc("bytesIn", len(msg))
+        room = roomOpts.default
+        if conn.version >= 5:
+            room, msg = self.readRoom(msg)
+        if room not in conn.rooms:
+            self.logger.warn("Message to a room it is not in : %s %s", conn, room)
+            return
+        if self.store is not None:
+            self.store.append(conn.userName.rstrip(), msg, room)
+        formattedMsg = self.formatMessage(msg, conn.userName)
+        self.recent.add(room, formattedMsg)
+        await self.sendToMembers(list(self.rooms.get(room, ())), networkOpts.message,
+                                 self.formatRoom(room) + formattedMsg, formattedMsg, start)
+
+    async def room(self, code: int, conn: _AsyncClient):
+        """Joins or parts the room conn sent"""
+        rawRoom = await self.recvDecoded(conn)
+        if conn.version < 5:
+            return
+        room = self.checkRoom(rawRoom)
+        if not room:
+            self.logger.warn("Inappropriate room name : %s %s", conn, rawRoom)
+            # A join that fails is answered like a part
+            self.send(conn, networkOpts.part, rawRoom)
+        elif code == networkOpts.join:
+            self.joinRoom(conn, room)
+        else:
+            self.partRoom(conn, room)
+
+    def joinRoom(self, conn: _AsyncClient, room: str):
+        # Nothing is awaited between the history and joining, so no broadcast is missed or sent twice
+        if conn not in self.clientsLoggedIn or not self.addMember(conn, room):
+            return
+        if conn.version >= 5:
+            self.send(conn, networkOpts.join, room.encode())
+        self.sendHistory(conn, room)
+        self.sendPresence(networkOpts.userJoined, conn, room)
+
+    def partRoom(self, conn: _AsyncClient, room: str, answer: bool = True):
+        """answer : tells conn, it is not told when it leaves"""
+        if not self.removeMember(conn, room):
+            return
+        if answer and conn.version >= 5:
+            self.send(conn, networkOpts.part, room.encode())
+        self.sendPresence(networkOpts.userLeft, conn, room)
+
+    async def sendStats(self, conn: _AsyncClient):
+        try:
+            await asyncio.wait_for(self.sendMessage(conn, networkOpts.stats, self.stats()), networkOpts.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.logger.warn("Stats could not be sent : %s", conn)
+
+    async def sender(self, conn: _AsyncClient):
+        try:
+            while True:
+                code, msg, encrypted, start = await conn._outbound.get()
+                await asyncio.wait_for(self.sendMessage(conn, code, msg, encrypted), networkOpts.timeout)
+                self.metrics.inc("messagesOut")
+                self.metrics.inc("bytesOut", len(msg))
+                if start is not None:
+                    self.metrics.observe("fanout", time.perf_counter() - start)
+        except (asyncio.TimeoutError, ConnectionError):
+            self.logger.warn("Client is not reading : %s", conn)
+            conn.writer.close()
+
+    def send(self, conn: _AsyncClient, code: int, msg: bytes, encrypted: bool = False, start: float = None):
+        """start : perf_counter of the message being received, for the fan-out latency"""
+        try:
+            conn._outbound.put_nowait((code, msg, encrypted, start))
+        except asyncio.QueueFull:
+            if self.slowConsumer == "drop":
+                self.metrics.inc("dropped")
+                self.logger.warn("Send queue is full, message dropped : %s %s", conn, code)
+                return
+            self.logger.warn("Send queue is full : %s", conn)
+            self.metrics.inc("evictions")
+            self.removeClient(conn)
+            conn.writer.close()
+
+    async def sendToMembers(self, conns: list, code: int, msg: bytes, oldMsg: bytes = None, start: float = None):
+        """Sends msg to conns, clients older than version 5 get oldMsg if it is given"""
+        groups = {}
+        for conn in conns:
+            groups.setdefault(oldMsg if oldMsg is not None and conn.version < 5 else msg, []).append(conn)
+        for payload, conns in groups.items():
+            keyed = [conn for conn in conns if conn.sharedKey]
+            keys = [conn.sharedKey for conn in keyed]
+            encryptStart = time.perf_counter()
+            if self.encrypter.parallel(payload, len(keys)):
+                payloads = await asyncio.get_running_loop().run_in_executor(
+                    None, self.encrypter.encrypt, payload, keys)
+            else:
+                payloads = self.encrypter.encrypt(payload, keys)
+            self.metrics.observe("encrypt", time.perf_counter() - encryptStart)
+            payloads = dict(zip(keyed, payloads))
+            for conn in conns:
+                if conn in payloads:
+                    self.send(conn, code, payloads[conn], True, start)
+                else:
+                    self.send(conn, code, payload, start=start)
+
+    def sendPresence(self, code: int, conn: _AsyncClient, room: str):
+        for c, code, msg in self.presence(code, conn, list(self.rooms.get(room, ())), room):
+            self.send(c, code, msg)
+
+    async def sendMessage(self, conn: _AsyncClient, code: int, msg: bytes, encrypted: bool = False):
+        async with conn.transferLock:
+            flags = networkOpts.flags.payload
+            if encrypted:
+                flags |= networkOpts.flags.encrypted
+            elif conn.key and conn.keySent:
+                msg = seb.encrypt(msg, conn.key)
+                flags |= networkOpts.flags.encrypted
+            if conn.sendVersion >= 2:
+                conn.write(code, msg, flags)
+                await conn.writer.drain()
+            else:
+                conn.write(code)
+                await self._sendChunks(conn, msg)
+
+    async def _sendChunks(self, conn: _AsyncClient, msg: bytes):
+        conn.write(networkOpts.dataLenght, len(msg).to_bytes(
+            networkOpts.dataSizeLenght, networkOpts.byteorder))
+        window = _Window(msg)
+        while not window.done:
+            for code, data in window.frames():
+                conn.write(code, data)
+            await conn.writer.drain()
+            window.response(await conn._response.get())
+        if window.retransmits:
+            self.metrics.inc("chunksRetransmitted", window.retransmits)
+
+    async def recvDecoded(self, conn: _AsyncClient) -> bytes:
+        flags, msg = await conn._payload.get()
+        if flags is None:
+            msg = await self._recvChunks(conn, self.convertBytes(msg))
+            encrypted = conn.keySent
+        else:
+            encrypted = flags & networkOpts.flags.encrypted
+        if conn.key and encrypted:
+            msg = seb.decrypt(msg, conn.key)
+        return msg
+
+    async def _recvChunks(self, conn: _AsyncClient, dataLen: int) -> bytes:
+        packCount = (dataLen // networkOpts.packageSize) + 1
+        msg = []
+        for i in range(packCount):
+            hsh = await conn._hash.get()
+            while True:
+                data = await conn._data.get()
+                if md5(data).digest() == hsh:
+                    conn.write(networkOpts.response, b"ok")
+                    msg.append(data)
+                    break
+                conn.write(networkOpts.response, b"no")
+                self.metrics.inc("chunksRejected")
+        return b"".join(msg)
+
+    async def terminateConnection(self, conn: _AsyncClient, reason: str):
+        self.logger.warn("Terminating connection : %s %s", conn, reason)
+        self.removeClient(conn)
+        if conn.writerTask:
+            conn.writerTask.cancel()
+        try:
+            await asyncio.wait_for(self.sendMessage(
+                conn, networkOpts.terminateConnection, reason.encode()), networkOpts.timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        conn.writer.close()
+
+    def removeClient(self, conn: _AsyncClient):
+        if conn.sharedKey:
+            conn.sharedKey.close()
+        if conn in self.clients:
+            self.clients.remove(conn)
+        if conn in self.clientsLoggedIn:
+            self.clientsLoggedIn.remove(conn)
+            for room in list(conn.rooms):
+                self.partRoom(conn, room, False)
+
+    def convertBytes(self, _bytes: bytes) -> int:
+        return int.from_bytes(_bytes, networkOpts.byteorder)
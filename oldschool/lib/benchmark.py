@@ -0,0 +1,250 @@
+"""Benchmarks for the hot paths"""
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import time
+import timeit
+
+try:
+    from .consts import networkOpts
+    from . import network
+    from . import sebcrypter as seb
+    from .broadcast import BroadcastEncrypter
+    from lib import _thread, _Value
+except ImportError:
+    from consts import networkOpts
+    import network
+    import sebcrypter as seb
+    from broadcast import BroadcastEncrypter
+    from __init__ import _thread, _Value
+
+
+def _reader(conn: network._SocketBase):
+    try:
+        while conn.recvCode():
+            pass
+    except OSError:
+        pass
+
+
+def _pair(key: bytes = None, version: int = 1) -> tuple:
+    """Two connected sockets that speak the protocol, one reader thread each"""
+    a, b = socket.socketpair()
+    a = network._Client(a, "benchmark.sender", key)
+    b = network._Client(b, "benchmark.receiver", key)
+    for conn in (a, b):
+        conn.version = conn.sendVersion = conn.recvVersion = version
+        conn.keySent = key is not None
+    _thread(_reader, a)
+    _thread(_reader, b)
+    return a, b
+
+
+def transfer(size: int, windowSize: int, count: int = 200) -> dict:
+    """Sends <count> messages of <size> bytes with the chunked v1 transfer"""
+    default = networkOpts.windowSize
+    networkOpts.windowSize = windowSize
+    sender, receiver = _pair()
+    msg = os.urandom(size)
+    received = _Value("received")
+    def receive():
+        for i in range(count):
+            receiver.recvDecoded()
+        received.set(True)
+    try:
+        start = time.perf_counter()
+        _thread(receive)
+        for i in range(count):
+            sender.sendEncoded(msg)
+        received.get()
+        elapsed = time.perf_counter() - start
+    finally:
+        networkOpts.windowSize = default
+        sender.close()
+        receiver.close()
+    return {"size": size, "window": windowSize, "messages": count,
+            "seconds": elapsed, "throughput": size * count / elapsed}
+
+
+def broadcast(recipients: int, size: int, workers: int, count: int = 20) -> dict:
+    """Encrypts <count> messages of <size> bytes for <recipients> keys"""
+    encrypter = BroadcastEncrypter(workers)
+    keys = []
+    for i in range(recipients):
+        rawKey = seb.keygen()
+        keys.append(encrypter.share(rawKey, seb.readkey(key=rawKey)))
+    msg = os.urandom(size)
+    try:
+        encrypter.encrypt(msg, keys)
+        start = time.perf_counter()
+        for i in range(count):
+            encrypter.encrypt(msg, keys)
+        elapsed = time.perf_counter() - start
+    finally:
+        for key in keys:
+            key.close()
+        encrypter.shutdown()
+    return {"recipients": recipients, "size": size, "workers": workers,
+            "messages": count, "seconds": elapsed}
+
+
+def run(sizes: tuple = (256, 2048, 4100), windows: tuple = (1, 4, 8, 16)):
+    for size in sizes:
+        for window in windows:
+            result = transfer(size, window)
+            print("transfer size={size:<5} window={window:<3} {mbs:8.2f} MB/s {rate:8.0f} msg/s".format(
+                mbs=result["throughput"] / 2**20, rate=result["messages"] / result["seconds"], **result))
+    for size in (512, 2048):
+        serial = broadcast(100, size, 1)
+        for workers in (1, 2, 4):
+            result = broadcast(100, size, workers)
+            print("broadcast recipients={recipients} size={size:<5} workers={workers} {rate:8.1f} msg/s speedup {speedup:.2f}x".format(
+                rate=result["messages"] / result["seconds"], speedup=serial["seconds"] / result["seconds"], **result))
+
+# Micro benchmarks, every case returns the function it times and a cleanup
+
+def _crypto(size: int, decrypt: bool = False):
+    def case():
+        table = seb.readkey(key=seb.keygen())
+        msg = os.urandom(size)
+        if decrypt:
+            encrypted = seb.encrypt(msg, table)
+            return (lambda: seb.decrypt(encrypted, table)), None
+        return (lambda: seb.encrypt(msg, table)), None
+    return case
+
+
+def _keygen():
+    return seb.keygen, None
+
+
+def _readkey():
+    key = seb.keygen()
+    return (lambda: seb.readkey(key=key)), None
+
+
+def _roundtrip(size: int, encrypted: bool):
+    """sendEncoded and recvDecoded of one message in a v2 frame"""
+    def case():
+        sender, receiver = _pair(seb.keygen() if encrypted else None, 2)
+        msg = os.urandom(size)
+        def roundtrip():
+            sender.sendEncoded(msg, networkOpts.message)
+            receiver.recvDecoded()
+        def close():
+            sender.close()
+            receiver.close()
+        return roundtrip, close
+    return case
+
+
+def _formatMessage():
+    server = network._ServerBase()
+    msg = os.urandom(200)
+    return (lambda: server.formatMessage(msg, "benchmark")), None
+
+
+def _formatMsg():
+    msg = network._ServerBase().formatMessage(b"m" * 200, "benchmark")
+    return (lambda: network.Client._formatMsg(None, msg)), None
+
+
+def _wrapMessage(size: int):
+    def case():
+        try:
+            from . import display
+        except ImportError:
+            import display
+        bar = display._MessageBar.__new__(display._MessageBar)
+        bar.size = display._YX((40, 120))
+        msg = "m" * size
+        return (lambda: bar.formatMsg(msg, "benchmark")), None
+    return case
+
+
+cases = {
+    "keygen": _keygen,
+    "readkey": _readkey,
+    **{"encrypt %s" % size: _crypto(size) for size in (16, 256, 2048)},
+    **{"decrypt %s" % size: _crypto(size, True) for size in (16, 256, 2048)},
+    **{"roundtrip %s" % size: _roundtrip(size, False) for size in (64, 2048)},
+    **{"roundtrip encrypted %s" % size: _roundtrip(size, True) for size in (64, 2048)},
+    "formatMessage": _formatMessage,
+    "formatMsg": _formatMsg,
+    **{"wrap %s" % size: _wrapMessage(size) for size in (80, 2048)},
+}
+
+
+def measure(func, repeat: int = 5, warmup: int = 1) -> dict:
+    """Seconds a call of func takes, calls are looped so a repetition takes
+    at least 0.2 seconds, the first <warmup> repetitions are not counted"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(warmup + repeat, number)[warmup:]]
+    return {"number": number, "best": min(times), "median": statistics.median(times),
+            "stdev": statistics.stdev(times) if len(times) > 1 else 0}
+
+
+def _commit() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+                                capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def suite(repeat: int = 5, warmup: int = 1, names: list = None) -> dict:
+    """Runs the cases whose names contain one of <names>, or all of them"""
+    results = {}
+    for name, case in cases.items():
+        if names and not any(n in name for n in names):
+            continue
+        func, close = case()
+        try:
+            results[name] = measure(func, repeat, warmup)
+        finally:
+            if close:
+                close()
+    return {"commit": _commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "numpy": seb.np is not None,
+            "repeat": repeat, "warmup": warmup, "results": results}
+
+
+def compare(result: dict, baseline: dict, threshold: float = 0.1) -> list:
+    """Names of the cases that are more than <threshold> slower than in baseline,
+    best times are compared since they are the least noisy"""
+    regressions = []
+    for name, stats in result["results"].items():
+        base = baseline["results"].get(name)
+        if base and stats["best"] > base["best"] * (1 + threshold):
+            regressions.append(name)
+    return regressions
+
+
+def report(result: dict, baseline: dict = None, threshold: float = 0.1):
+    regressions = compare(result, baseline, threshold) if baseline else []
+    for name, stats in result["results"].items():
+        line = "{name:<24} {best:12.2f} us {median:12.2f} us median".format(
+            name=name, best=stats["best"] * 1e6, median=stats["median"] * 1e6)
+        base = baseline and baseline["results"].get(name)
+        if base:
+            line += " {change:+8.1%} vs {commit}".format(
+                change=stats["best"] / base["best"] - 1, commit=baseline.get("commit"))
+            if name in regressions:
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def save(result: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(result, file, indent=2)
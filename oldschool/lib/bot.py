@@ -0,0 +1,117 @@
+"""Clients without a display, for scripts such as alert bots and load drivers"""
+import socket
+import time
+
+try:
+    from .consts import networkOpts
+    from . import network
+    from . import sebcrypter as seb
+    from lib import IndexerClosed
+except ImportError:
+    from consts import networkOpts
+    import network
+    import sebcrypter as seb
+    from __init__ import IndexerClosed
+
+
+class LoginError(Exception):
+    """Raised when the server does not let the bot in"""
+
+
+class Bot:
+    """Logs in with a network.Client and sends and receives its messages
+
+        with Bot("alerts", "127.0.0.1") as bot:
+            bot.send("Disk is full")
+            for msg, user in bot:
+                ...
+    """
+
+    def __init__(self, userName: str, ip: str, port: int = networkOpts.defaultPort, password: str = None):
+        self.client = network.Client(userName, seb.keygen(), ip, port or networkOpts.defaultPort)
+        try:
+            self.login(password)
+        except BaseException:
+            self.close()
+            raise
+
+    def login(self, password: str = None) -> None:
+        if self.client.isPasswordRequired():
+            if not password:
+                raise LoginError("Password is required")
+            if self.client.login(password) != networkOpts.correctPassword:
+                raise LoginError("Incorrect password")
+        if not self.client.isLoggedIn():
+            raise LoginError("Login failed")
+
+    def send(self, msg: str, room: str = None) -> None:
+        """room : the last joined one if it is not given"""
+        self.sendMany([msg], room)
+
+    def sendMany(self, msgs: list, room: str = None) -> None:
+        """Sends the messages in one write"""
+        if self.client.version < 2:
+            self._sendEchoed(msgs, room)
+        elif msgs:
+            self.client.sendMsgs(msgs, room)
+
+    def _sendEchoed(self, msgs: list, room: str = None) -> None:
+        """Version 1 servers can not read a message while they send the one
+        before, every message waits for the echo of the one before like the
+        display client"""
+        for msg in msgs:
+            self.client.messageSendable.wait(networkOpts.timeout)
+            self.client.messageSendable.clear()
+            self.client.sendMsg(msg, room)
+
+    def join(self, room: str) -> None:
+        """Joins room, the messages are sent to it after that"""
+        self.client.join(room)
+
+    def part(self, room: str) -> None:
+        self.client.part(room)
+
+    def events(self):
+        """Yields (code, payload) for every received message, users change
+        and room answer until the connection is closed, payloads of a room
+        have the room as their last item"""
+        while True:
+            try:
+                yield self.client.getMessage()
+            except (IndexerClosed, StopIteration):
+                return
+
+    def messages(self, room: str = None):
+        """Yields (msg, user) for every received message, only the ones of
+        room if it is given"""
+        for code, msg in self.events():
+            if code == networkOpts.message and room in (None, msg[2]):
+                yield msg[:2]
+
+    def __iter__(self):
+        return self.messages()
+
+    def close(self, timeout: float = networkOpts.timeout) -> None:
+        """Waits up to <timeout> seconds for the server to read what is sent
+        and close the connection, closing first would reset it
+
+        Version 1 servers do not close it, the connection is closed once
+        the last message is echoed"""
+        if self.client.version < 2:
+            self.client.messageSendable.wait(timeout)
+            self.client.terminateConnection()
+            return
+        try:
+            self.client.shutdown(socket.SHUT_WR)
+            end = time.monotonic() + timeout
+            while True:
+                self.client.messages.pop(max(end - time.monotonic(), 0))
+        except (OSError, IndexerClosed, TimeoutError):
+            pass
+        self.client.terminateConnection()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,110 @@
+"""Encrypts one message with the keys of many clients in parallel"""
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+try:
+    from .consts import networkOpts
+    from . import sebcrypter as seb
+except ImportError:
+    from consts import networkOpts
+    import sebcrypter as seb
+
+_tables = {}  # key tables a worker process has read, by shared memory name
+
+
+def _table(name: str) -> seb.KeyTable:
+    table = _tables.get(name)
+    if table is None:
+        shm = shared_memory.SharedMemory(name)
+        try:
+            table = seb.readkey(key=bytes(shm.buf))
+        finally:
+            shm.close()
+        if len(_tables) >= networkOpts.maxCachedKeys:
+            _tables.clear()
+        _tables[name] = table
+    return table
+
+
+def _encryptShared(msg: bytes, names: list) -> list:
+    return [seb.encrypt(msg, _table(name)) for name in names]
+
+
+def _encryptTables(msg: bytes, tables: list) -> list:
+    return [seb.encrypt(msg, table) for table in tables]
+
+
+class SharedKey:
+    """Key of a client, also kept in shared memory if workers are processes
+    so only its name is pickled with a message"""
+
+    def __init__(self, rawKey: bytes, table: seb.KeyTable, shared: bool):
+        self.table = table
+        self.shm = None
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=len(rawKey))
+            self.shm.buf[:len(rawKey)] = rawKey
+            self.name = self.shm.name
+
+    def close(self):
+        shm, self.shm = self.shm, None
+        if shm:
+            shm.close()
+            shm.unlink()
+
+
+class BroadcastEncrypter:
+    """Splits the recipients of a message into one batch per worker
+
+    sebcrypter holds the GIL unless numpy is installed, so the workers are
+    processes without numpy and threads with it."""
+
+    def __init__(self, workers: int = networkOpts.encryptWorkers):
+        self.workers = max(workers, 1)
+        self.processes = seb.np is None
+        self.executor = None
+        if self.workers > 1 and self.processes:
+            if os.name == "posix":
+                # Workers inherit it and do not start their own trackers
+                # that would unlink the keys they read when they exit
+                resource_tracker.ensure_running()
+            self.executor = ProcessPoolExecutor(self.workers)
+            # Starts the workers now, before the server starts its threads
+            self.executor.submit(int).result()
+        elif self.workers > 1:
+            self.executor = ThreadPoolExecutor(self.workers, "encrypter")
+
+    def share(self, rawKey: bytes, table: seb.KeyTable) -> SharedKey:
+        return SharedKey(rawKey, table, self.processes and self.executor is not None)
+
+    def parallel(self, msg: bytes, recipients: int) -> bool:
+        if self.executor is None or recipients * len(msg) < networkOpts.parallelEncryptSize:
+            return False
+        # Small messages take the pure python path that holds the GIL
+        return self.processes or len(msg) >= seb.NUMPYTHRESHOLD
+
+    def encrypt(self, msg: bytes, keys: list) -> list:
+        """Encrypted msg for every SharedKey in keys, in the same order"""
+        if not self.parallel(msg, len(keys)):
+            return _encryptTables(msg, [key.table for key in keys])
+        size = -(-len(keys) // self.workers)
+        batches = [keys[i:i + size] for i in range(0, len(keys), size)]
+        if self.processes:
+            futures = [self.executor.submit(_encryptShared, msg, [key.name for key in batch])
+                       for batch in batches]
+        else:
+            futures = [self.executor.submit(_encryptTables, msg, [key.table for key in batch])
+                       for batch in batches]
+        result = []
+        for batch, future in zip(batches, futures):
+            try:
+                result += future.result()
+            except Exception:
+                # A key closed while its batch was waiting, or a broken pool
+                result += _encryptTables(msg, [key.table for key in batch])
+        return result
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
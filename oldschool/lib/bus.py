@@ -0,0 +1,256 @@
+"""Local bus that ties the worker processes of a server together
+
+Workers share the port with SO_REUSEPORT and publish the messages and
+presence changes of their clients to the hub in the parent process. The hub
+relays every frame to all workers, the publisher too, so every worker sees
+them in the same order and sends them to its own clients. Frames are
+[lenght 4][code 3][payload], messages are [room lenght 1][room][formatted
+message] and presence payloads are [worker 4][id 8][room lenght 1][room][user name]."""
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import threading as th
+import time
+
+try:
+    from .consts import networkOpts, busOpts
+    from .logger import *
+    from .network import _ServerBase, _Recent, Server
+    from lib import _thread
+except ImportError:
+    from consts import networkOpts, busOpts
+    from logger import *
+    from network import _ServerBase, _Recent, Server
+    from __init__ import _thread
+
+_header = networkOpts.frameLenght + networkOpts.constLenght
+
+
+def _frame(code: int, payload: bytes) -> bytes:
+    return ((networkOpts.constLenght + len(payload)).to_bytes(networkOpts.frameLenght, networkOpts.byteorder)
+            + code.to_bytes(networkOpts.constLenght, networkOpts.byteorder) + payload)
+
+
+def _batches(sock: socket.socket):
+    """Yields the complete frames of every read as lists of (code, payload)"""
+    buffer = b""
+    while True:
+        try:
+            data = sock.recv(networkOpts.recvBufferSize)
+        except OSError:
+            return
+        if not data:
+            return
+        buffer += data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= networkOpts.frameLenght:
+            length = int.from_bytes(buffer[offset:offset + networkOpts.frameLenght], networkOpts.byteorder)
+            end = offset + networkOpts.frameLenght + length
+            if end > len(buffer):
+                break
+            code = int.from_bytes(buffer[offset + networkOpts.frameLenght:offset + _header], networkOpts.byteorder)
+            frames.append((code, buffer[offset + _header:end]))
+            offset = end
+        buffer = buffer[offset:]
+        if frames:
+            yield frames
+
+
+def _worker(worker: int) -> bytes:
+    return worker.to_bytes(busOpts.workerLenght, networkOpts.byteorder)
+
+
+def _presence(id: int, userName: str, room: str) -> bytes:
+    return id.to_bytes(busOpts.idLenght, networkOpts.byteorder) + _ServerBase.formatRoom(room) + userName.encode()
+
+
+def _readPresence(payload: bytes) -> tuple:
+    """(worker, id, room, user name) of a relayed presence payload"""
+    idStart = busOpts.workerLenght
+    roomStart = idStart + busOpts.idLenght
+    room, userName = _ServerBase.readRoom(payload[roomStart:])
+    return (int.from_bytes(payload[:idStart], networkOpts.byteorder),
+            int.from_bytes(payload[idStart:roomStart], networkOpts.byteorder),
+            room, userName.decode())
+
+
+class Hub(_ServerBase):
+    """Relays the frames of the workers, keeps who is logged in to which
+    worker and the recent messages for workers that start later
+
+    store : store.MessageStore, every message is kept in it"""
+
+    def __init__(self, path: str, store=None, historySize: int = networkOpts.historySize):
+        self.logger = Logger("bus.Hub")
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        self.store = store
+        self.recent = _Recent(historySize)
+        if store is not None:
+            for record in store.last(historySize):
+                self.recent.add(record.room, self.formatMessage(record.msg, record.user))
+        self.workers = {}
+        self.users = {}  # worker : {(id, room) : user name}
+        self._id = 0
+        # Every worker gets the frames in the order they are relayed
+        self._lock = th.Lock()
+
+    def serve(self):
+        while True:
+            sock, _ = self.sock.accept()
+            _thread(self.worker, sock)
+
+    def worker(self, sock: socket.socket):
+        with self._lock:
+            worker = self.id()
+            data = [_frame(busOpts.hello, _worker(worker))]
+            for room, messages in self.recent.items():
+                data += [_frame(busOpts.history, self.formatRoom(room) + msg) for msg in messages]
+            for other, users in self.users.items():
+                for (id, room), userName in users.items():
+                    data.append(_frame(busOpts.joined, _worker(other) + _presence(id, userName, room)))
+            sock.sendall(b"".join(data))
+            self.workers[worker] = sock
+            self.users[worker] = {}
+        self.logger.info("Worker connected : %s", worker)
+        for frames in _batches(sock):
+            self.publish(worker, frames)
+        with self._lock:
+            del self.workers[worker]
+            users = self.users.pop(worker)
+        self.logger.warn("Worker disconnected : %s", worker)
+        # Its clients are gone with it
+        self.publish(worker, [(busOpts.left, _presence(id, userName, room))
+                              for (id, room), userName in users.items()])
+        sock.close()
+
+    def publish(self, worker: int, frames: list):
+        """Relays the frames of worker to every worker in one write each"""
+        with self._lock:
+            data = []
+            for code, payload in frames:
+                if code == busOpts.message:
+                    room, formattedMsg = self.readRoom(payload)
+                    self.recent.add(room, formattedMsg)
+                    if self.store is not None:
+                        self.store.append(*self.readMessage(formattedMsg), room)
+                elif code in (busOpts.joined, busOpts.left):
+                    payload = _worker(worker) + payload
+                    _, id, room, userName = _readPresence(payload)
+                    users = self.users.get(worker, {})
+                    if code == busOpts.joined:
+                        users[id, room] = userName
+                    else:
+                        users.pop((id, room), None)
+                else:
+                    continue
+                data.append(_frame(code, payload))
+            data = b"".join(data)
+            for other, sock in list(self.workers.items()):
+                try:
+                    sock.sendall(data)
+                except OSError:
+                    self.logger.warn("Worker is not reading : %s", other)
+
+
+class Bus:
+    """Connection of a worker to the hub"""
+
+    def __init__(self, path: str):
+        self.logger = Logger("bus.Bus")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The hub listens before the workers start, it accepts once they are all started
+        self.sock.connect(path)
+        self._lock = th.Lock()
+        self._events = self.events()
+        _, self.worker = next(self._events)
+        self.logger.info("Connected to the hub as worker : %s", self.worker)
+
+    def events(self):
+        """Yields (code, payload), presence payloads as (worker, id, room, user name)"""
+        for frames in _batches(self.sock):
+            for code, payload in frames:
+                if code == busOpts.hello:
+                    payload = int.from_bytes(payload, networkOpts.byteorder)
+                elif code in (busOpts.joined, busOpts.left):
+                    payload = _readPresence(payload)
+                yield code, payload
+
+    def __iter__(self):
+        return self._events
+
+    def _publish(self, code: int, payload: bytes):
+        try:
+            with self._lock:
+                self.sock.sendall(_frame(code, payload))
+        except OSError:
+            self.logger.warn("Hub is not reachable : %s", code)
+
+    def message(self, msg: bytes):
+        self._publish(busOpts.message, msg)
+
+    def joined(self, id: int, userName: str, room: str):
+        self._publish(busOpts.joined, _presence(id, userName, room))
+
+    def left(self, id: int, userName: str, room: str):
+        self._publish(busOpts.left, _presence(id, userName, room))
+
+
+def _serve(path: str, kwargs: dict):
+    # The parent stops the workers, Ctrl-C reaches the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    bus = Bus(path)
+    if kwargs.get("metricsFile"):
+        # One file for each worker
+        root, extension = os.path.splitext(kwargs["metricsFile"])
+        kwargs["metricsFile"] = "%s.%s%s" % (root, bus.worker, extension)
+    # Returns when the hub is lost
+    Server(bus=bus, **kwargs)
+    stopLogging()
+
+
+def _terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def run(workers: int, store=None, historySize: int = networkOpts.historySize, **kwargs):
+    """Serves with <workers> processes that run a Server each, kwargs are
+    passed to them, workers that exit are started again"""
+    logger = Logger("bus.run")
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("Workers need SO_REUSEPORT")
+    path = os.path.join(tempfile.gettempdir(), busOpts.socketName % os.getpid())
+    hub = Hub(path, store, historySize)
+    context = multiprocessing.get_context("fork")
+    kwargs["historySize"] = historySize
+    def start():
+        process = context.Process(target=_serve, args=(path, kwargs), daemon=True)
+        process.start()
+        return process
+    # Forked before the hub starts its threads
+    processes = [start() for _ in range(workers)]
+    _thread(hub.serve)
+    logger.info("Started %s workers", workers)
+    # So the workers are stopped and the socket is removed below
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        while True:
+            time.sleep(busOpts.checkInterval)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error("Worker exited with %s, starting it again", process.exitcode)
+                    processes[i] = start()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        os.remove(path)
@@ -2,10 +2,68 @@
 
 class generalOpts:
     maxUserNameLenght = 16
+class roomOpts:
+    default = "general"  # every user is in it after logging in
+    maxNameLenght = 16
+    chars = "-_"  # allowed in names besides letters and digits
+    recentRooms = 256  # rooms whose recent messages are kept
 class loggerOpts:
     directory = "log"
     file = "oldschool.log"
-    format = "%(asctime)s > %(name)s > %(levelname)s > %(message)s"
+    format = "%(asctime)s > %(name)s > %(context)s > %(levelname)s > %(message)s"
+    queueSize = 10000
+    level = "info"  # OLDSCHOOL_LOG_LEVEL overrides it
+    environ = "OLDSCHOOL_LOG_LEVEL"
+    payloadLenght = 64  # longer bytes are cut in the records
+    packetSample = 10  # one in packetSample per packet records is written
+
+class historyOpts:
+    directory = "history"
+    extension = ".history"
+    indexExtension = ".index"
+
+class storeOpts:
+    directory = "store"
+    extension = ".segment"
+    indexExtension = ".index"
+    segmentSize = 1 << 24  # bytes a segment grows to before a new one is started
+    retention = 16  # segments that are kept
+    indexInterval = 64  # records between index entries
+    fsyncInterval = 1.0  # seconds between syncs, 0 syncs every write
+
+class busOpts:
+    socketName = "oldschool-%s.bus"  # in the temp directory, by the pid of the server
+    workerLenght = 4
+    idLenght = 8
+    checkInterval = 1  # seconds between checks of the workers
+    hello = 0xfff200
+    message = 0xfff201
+    joined = 0xfff202
+    left = 0xfff203
+    history = 0xfff204
+
+class federationOpts:
+    nodeLenght = 8
+    seqLenght = 8
+    idLenght = 8
+    nonceLenght = 16
+    seenSize = 1 << 16  # events remembered to drop the copies that come back
+    queueSize = 4096  # events waiting for a peer, the link is closed when it is full
+    reconnect = (1, 30)  # first and longest wait in seconds before connecting again
+    heartbeatInterval = 2  # seconds between the heartbeats of a node
+    missedHeartbeats = 3  # the users of a node are forgotten when this many are missed
+    hello = 0xfff300
+    auth = 0xfff301
+    message = 0xfff302
+    joined = 0xfff303
+    left = 0xfff304
+    heartbeat = 0xfff305
+
+class metricsOpts:
+    prefix = "oldschool"
+    samples = 1024  # latest timings the percentiles are taken from
+    quantiles = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+    interval = 10  # seconds between dumps to the metrics file
 
 class displayOpts:
     class colorPairs:
@@ -19,17 +77,35 @@ class displayOpts:
         minUserBarWidth = 20
         minDisplayWidth = 40
         minDisplayHeight = 20
+        messageLines = 1000  # wrapped lines kept for a width
+        cachedLayouts = 4  # widths whose wrapped lines are kept
+        maxMessages = 1000  # messages kept in memory, older ones are read from the history
+    fps = 30  # frames drawn a second at most
 
 class networkOpts:
     defaultPort = 31415
     byteorder = "little"
     constLenght = 3
+    protocolVersion = 5
+    frameLenght = 4
+    flagsLenght = 1
+    maxFrameLenght = 1 << 20
+    recvBufferSize = 1 << 14
     timeout = 45
+    backlog = 1024
+    sendQueueSize = 256
+    receiveQueueSize = 4096
+    slowConsumer = "disconnect"  # or "drop", what to do when a send queue is full
+    encryptWorkers = 4
+    parallelEncryptSize = 1 << 16  # recipients * message size to use the workers
+    maxCachedKeys = 4096
     maxPasswordLenght = 64
     maxMessageLenght = 2048
+    historySize = 100  # latest messages a server sends to a client that logs in
     reasonLenght = 1024
     keySize = 4100
     packageSize = 256
+    windowSize = 8
     dataSizeLenght = 8
     hashLenght = 16
     passwordRequired = 0xfff000
@@ -48,4 +124,14 @@ class networkOpts:
     dataLenght = 0xfff00d
     hash = 0xfff00e
     data = 0xfff00f
-    response = 0xfff010
\ No newline at end of file
+    response = 0xfff010
+    userJoined = 0xfff011
+    userLeft = 0xfff012
+    stats = 0xfff013
+    history = 0xfff014
+    join = 0xfff015
+    part = 0xfff016
+    version = 0xfff100
+    class flags:
+        payload = 0x01
+        encrypted = 0x02
\ No newline at end of file
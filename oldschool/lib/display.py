@@ -7,27 +7,110 @@ except ImportError:
 try:
     from .logger import *
     from .consts import *
+    from lib import _thread
 except ImportError:
     from logger import *
     from consts import *
+    from __init__ import _thread
+import os
+import select
+import sys
+import threading as th
+import time
+from collections import deque
+from itertools import islice
 class _Messages:
     """Storage for last <numberOfLines> messages"""
 
     def __init__(self, numberOfLines: int) -> None:
-        self.messages = []
+        self.messages = deque(maxlen=numberOfLines)
         self.nol = numberOfLines
 
     def add(self, item: object) -> None:
         """Adds a new message to storage"""
         self.messages.append(item)
-        l = len(self.messages)
-        if l > self.nol:
-            self.messages = self.messages[-self.nol:]
+
+    def last(self, n: int) -> list:
+        """Returns the last <n> messages"""
+        n = min(n, len(self.messages))
+        return list(islice(self.messages, len(self.messages) - n, None))
+
+    def __len__(self) -> int:
+        return len(self.messages)
 
     def __repr__(self) -> str:
         return self.messages.__repr__()
 
 
+class _Layout(_Messages):
+    """Wrapped lines of the messages for a window width"""
+
+    def __init__(self, width: int) -> None:
+        super().__init__(displayOpts.sizes.messageLines)
+        self.width = width
+        self.count = 0  # messages that are wrapped
+
+
+class _GapBuffer:
+    """Text of the input bar split at the cursor, so editing there
+    does not copy the rest of the text"""
+
+    def __init__(self) -> None:
+        self.before = []  # characters before the cursor
+        self.after = []  # characters after the cursor, the nearest one is the last
+
+    @property
+    def cursor(self) -> int:
+        return len(self.before)
+
+    def insert(self, text: str) -> None:
+        self.before.extend(text)
+
+    def delete(self) -> None:
+        """Deletes the character before the cursor"""
+        if self.before:
+            self.before.pop()
+
+    def deleteForward(self) -> None:
+        """Deletes the character under the cursor"""
+        if self.after:
+            self.after.pop()
+
+    def move(self, n: int) -> None:
+        """Moves the cursor n characters, to the left if n is negative"""
+        n = max(-len(self.before), min(n, len(self.after)))
+        if n > 0:
+            moved = self.after[-n:]
+            del self.after[-n:]
+            moved.reverse()
+            self.before.extend(moved)
+        elif n < 0:
+            moved = self.before[n:]
+            del self.before[n:]
+            moved.reverse()
+            self.after.extend(moved)
+
+    def slice(self, start: int, stop: int) -> str:
+        """Returns the text in [start, stop)"""
+        cursor = len(self.before)
+        text = "".join(self.before[start:stop]) if start < cursor else ""
+        if stop > cursor:
+            length = len(self.after)
+            first, last = max(start - cursor, 0), stop - cursor
+            text += "".join(reversed(self.after[max(length - last, 0):max(length - first, 0)]))
+        return text
+
+    def text(self) -> str:
+        return "".join(self.before) + "".join(reversed(self.after))
+
+    def clear(self) -> None:
+        self.before.clear()
+        self.after.clear()
+
+    def __len__(self) -> int:
+        return len(self.before) + len(self.after)
+
+
 class _YX:
     """Makes easier to access size of windows"""
 
@@ -73,6 +156,7 @@ class _WindowBase:
         self.size = None
         self.name = name
         self.logger = Logger(self.name)
+        self.drawn = {}  # row : segments on it, rows that did not change are not drawn
         self.resize()
 
     @property
@@ -82,8 +166,32 @@ class _WindowBase:
     @window.setter
     def window(self, window: curses.window) -> None:
         self._window = window
+        self.drawn = {}
         self.resize()
 
+    def drawRow(self, y: int, *segments) -> None:
+        """Draws (text, attr) segments on row y if they differ from the drawn ones"""
+        if self.drawn.get(y) == segments:
+            return
+        self.window.move(y, 0)
+        self.window.clrtoeol()
+        for text, attr in segments:
+            self.window.addstr(text, attr)
+        self.drawn[y] = segments
+
+    def clearRows(self, start: int) -> None:
+        """Clears the drawn rows from row start"""
+        for y in [y for y in self.drawn if y >= start]:
+            self.drawRow(y)
+
+    def update(self) -> None:
+        """Puts the changes on the screen with the ones of the other windows"""
+        self.window.noutrefresh()
+        if getattr(self, "display", None):
+            self.display.update()
+        else:
+            curses.doupdate()
+
     def resize(self) -> _YX:
         """Updates self.size"""
         if self.window:
@@ -133,10 +241,12 @@ class _Grid(_WindowBase):
 
 
 class _UserBar(_WindowBase):
-    """Lists users in the list <self.users>"""
+    """Lists users in the list <self.users>, the users of the room <self.room>"""
 
-    def __init__(self, window: curses.window) -> None:
+    def __init__(self, window: curses.window, display=None) -> None:
         super().__init__(window, "display._UserBar")
+        self.display = display
+        self.room = roomOpts.default
         self.users = list()
         self.refresh()
 
@@ -161,48 +271,144 @@ class _UserBar(_WindowBase):
         self.logger.debug("New users list : %s", users)
         self.refresh()
 
-    def rightBorder(self, char: str, connectionChar: str) -> None:
+    def switchRoom(self, room: str) -> None:
+        """Shows room with only the first user, the own one, until its users come"""
+        self.room = room
+        self.users = self.users[:1]
+        self.refresh()
+
+    def applyUsers(self, users: list, presence: list) -> None:
+        """Applies a users list if it is not None, then (joined, user) changes,
+        the window is drawn once"""
+        if users is not None:
+            self.users = users
+        for joined, user in presence:
+            if joined:
+                self.users.append(user)
+            elif user in self.users:
+                self.users.remove(user)
+        self.logger.debug("New users list : %s", self.users)
+        self.refresh()
+
+    def rightBorder(self, y: int) -> tuple:
         """Separates _MessagesBar from itself"""
-        if self.window:
-            colPair = curses.color_pair(displayOpts.colorPairs.greenBlack)
-            for y in range(1, self.size.y-1):
-                self.window.addstr(y, self.size.x-1, char, colPair)
-            self.window.addstr(self.size.y-6, self.size.x -
-                               1, connectionChar, colPair)
+        char = displayOpts.chars.verticalSeparator
+        if y == self.size.y-6:
+            char = displayOpts.chars.connector
+        return (char, curses.color_pair(displayOpts.colorPairs.greenBlack))
 
     def refresh(self) -> None:
-        """Refreshes the users in the list in the window"""
+        """Refreshes the users in the list in the window, only changed rows are drawn"""
         if self.window:
-            self.window.clear()
-            y = 1
-            for user in self.users:
-                self.window.addstr(y, 2, user, curses.color_pair(
-                    displayOpts.colorPairs.yellowBlack))
-                y += 1
-            self.rightBorder(displayOpts.chars.verticalSeparator,
-                             displayOpts.chars.connector)
-            self.window.refresh()
+            colPair = curses.color_pair(displayOpts.colorPairs.yellowBlack)
+            width = self.size.x - 3
+            room = ("#" + self.room)[:width].ljust(width)
+            self.drawRow(1, ("  ", 0), (room, curses.color_pair(displayOpts.colorPairs.greenBlack)),
+                         self.rightBorder(1))
+            for y in range(2, self.size.y-1):
+                user = self.users[y-2] if y-2 < len(self.users) else ""
+                if isinstance(user, bytes):
+                    user = user.decode(errors="replace")
+                self.drawRow(y, ("  ", 0), (user[:width].ljust(width), colPair), self.rightBorder(y))
+            self.update()
 
 
 class _MessageBar(_WindowBase):
-    def __init__(self, window: curses.window, display) -> None:
-        """Shows the messages in the list (self.messages)"""
+    def __init__(self, window: curses.window, display, history=None) -> None:
+        """Shows the messages in the list (self.messages)
+        history : history.History that keeps every message for scrollback"""
         super().__init__(window, "display._MessageBar")
         self.display = display
-        self.messages = _Messages(self.size.y - 2)
+        self.history = history
         self.userNameLen = generalOpts.maxUserNameLenght+2
         self.colorPair = curses.color_pair(displayOpts.colorPairs.yellowBlack)
-        self.rawMessages = []
+        self.rawMessages = deque(maxlen=displayOpts.sizes.maxMessages)
+        self.total = 0  # messages added so far
+        self.scrollback = 0  # messages under the page, 0 shows the newest ones
+        self.pageMessages = 0  # messages on the last page
+        self.pageStart = 0
+        self.layouts = {}
+        self.messages = self.layout()
 
     def addMessage(self, msg: str, user: str) -> None:
-        """Adds a new message to the list"""
-        self.rawMessages.append((msg, user))
-        message = self.formatMsg(msg, user)
-        for line in message:
+        """Adds a new message to the list and draws only its lines"""
+        self.addMessages([(msg, user)])
+
+    def addMessages(self, messages: list, recorded: int = 0) -> None:
+        """Adds (msg, user) messages and draws their lines at once,
+        the first <recorded> ones are already in the history"""
+        for i, (msg, user) in enumerate(messages):
+            self.rawMessages.append((msg, user))
+            if self.history is not None and i >= recorded:
+                self.history.append(user, msg)
+            self.logger.debug("Added message : %s",msg)
+        self.total += len(messages)
+        if self.scrollback:
+            # Keeps the page where it is
+            self.scrollback += len(messages)
+            self.pageInfo()
+            self.update()
+            return
+        if (len(messages) >= self.size.y - 2 or self.messages.width != self.size.x
+                or self.messages.count != self.total - len(messages)):
+            self.refresh()
+            return
+        shown = min(len(self.messages), self.size.y - 2)
+        lines = []
+        for msg, user in messages:
+            lines += self.formatMsg(msg, user)
+        for line in lines:
             self.messages.add(line)
-        self.logger.info("Added message : %s",msg)
+        self.messages.count = self.total
+        self.draw(lines, shown)
+
+    def switchHistory(self, history) -> None:
+        """Shows the messages of another history, the ones of a room"""
+        self.history = history
+        self.rawMessages.clear()
+        self.total = 0
+        self.scrollback = 0
+        self.layouts = {}
+        self.messages = self.layout()
         self.refresh()
 
+    def replayMessages(self, messages: list) -> None:
+        """Adds the recent messages a server sends on login, the ones at the
+        end of the history from an earlier session are not kept again"""
+        recorded = 0
+        if self.history is not None:
+            count = len(self.history)
+            kept = [tuple(m) for m in self.history.read(count - len(messages), count)]
+            for k in range(min(len(kept), len(messages)), 0, -1):
+                if kept[len(kept) - k:] == messages[:k]:
+                    recorded = k
+                    break
+        self.addMessages(messages, recorded)
+
+    def layout(self) -> _Layout:
+        """Wrapped lines for the current width, wraps only the messages it misses"""
+        width = self.size.x
+        raw = list(self.rawMessages)
+        layout = self.layouts.pop(width, None)
+        if layout is None:
+            layout = _Layout(width)
+            # Messages that do not fit in the layout are not wrapped
+            lines = 0
+            start = len(raw)
+            while start and lines < layout.nol:
+                start -= 1
+                lines += len(self.formatMsg(*raw[start]))
+            layout.count = self.total - len(raw) + start
+        missing = min(self.total - layout.count, len(raw))
+        for m in raw[len(raw) - missing:]:
+            for line in self.formatMsg(*m):
+                layout.add(line)
+        layout.count = self.total
+        self.layouts[width] = layout
+        if len(self.layouts) > displayOpts.sizes.cachedLayouts:
+            del self.layouts[next(iter(self.layouts))]
+        return layout
+
     def formatMsg(self, msg: str, user: str) -> list:
         """Formats message (msg) in list format (lines)"""
         maxMsgLen = self.size.x - 3 - generalOpts.maxUserNameLenght
@@ -219,112 +425,352 @@ class _MessageBar(_WindowBase):
         message.append(" "*(18+maxMsgLen))
         return message
 
+    def draw(self, lines: list, shown: int) -> None:
+        """Draws new lines under the <shown> ones, scrolls up the old ones if needed"""
+        rows = self.size.y - 2
+        if len(lines) >= rows:
+            self.refresh()
+            return
+        overflow = shown + len(lines) - rows
+        if overflow > 0:
+            self.window.scrollok(True)
+            self.window.setscrreg(1, rows)
+            self.window.scroll(overflow)
+            self.window.scrollok(False)
+            # The rows moved up with the text on them
+            drawn = {}
+            for y, segments in self.drawn.items():
+                if not 1 <= y <= rows:
+                    drawn[y] = segments
+                elif y - overflow >= 1:
+                    drawn[y - overflow] = segments
+            self.drawn = drawn
+            shown -= overflow
+        y = 1 + shown
+        for line in lines:
+            self.addLine(y, line)
+            y += 1
+        self.update()
+
+    def addLine(self, y: int, line: str) -> None:
+        if line[:self.userNameLen] != " "*self.userNameLen:
+            self.drawRow(y, (line[:self.userNameLen], self.colorPair),
+                         (line[self.userNameLen:], 0))
+        else:
+            self.drawRow(y, (line, 0))
+
+    def stored(self) -> tuple:
+        """Range of the messages that can be shown"""
+        if self.history is not None:
+            return 0, len(self.history)
+        return self.total - len(self.rawMessages), self.total
+
+    def read(self, start: int, stop: int) -> list:
+        if self.history is not None:
+            return self.history.read(start, stop)
+        first = self.total - len(self.rawMessages)
+        return list(islice(self.rawMessages, start - first, stop - first))
+
+    def page(self) -> list:
+        """Wrapped lines of the page that ends <self.scrollback> messages before
+        the newest one, only the messages on it are read"""
+        rows = self.size.y - 2
+        first, end = self.stored()
+        end -= self.scrollback
+        start = end
+        lines = []
+        while start > first and len(lines) < rows:
+            for m in reversed(self.read(max(start - rows, first), start)):
+                lines = self.formatMsg(*m) + lines
+                start -= 1
+                if len(lines) >= rows:
+                    break
+        self.pageStart = start
+        self.pageMessages = end - start
+        return lines[-rows:]
+
+    def pageUp(self) -> None:
+        """Shows older messages, the top message of the page stays on the screen"""
+        first, end = self.stored()
+        self.page()
+        if self.pageStart <= first:
+            return
+        step = max(self.pageMessages - 1, 1)
+        self.scrollback = min(self.scrollback + step, end - first - 1)
+        self.refresh()
+
+    def pageDown(self) -> None:
+        if self.scrollback:
+            self.scrollback = max(self.scrollback - max(self.pageMessages - 1, 1), 0)
+            self.refresh()
+
+    def pageInfo(self) -> None:
+        info = " %s newer messages, PageDown to return " % self.scrollback
+        self.drawRow(0, (info[:self.size.x - 1], curses.color_pair(displayOpts.colorPairs.greenBlack)))
+
     def refresh(self) -> None:
-        """Refreshes messages in the window"""
-        self.messages = _Messages(self.size.y - 2)
-        for m in self.rawMessages:
-            for l in self.formatMsg(*m):
-                self.messages.add(l)
-        self.window.clear()
+        """Refreshes messages in the window, wraps them again if the width changed"""
+        if self.scrollback:
+            lines = self.page()
+        else:
+            if self.messages.width != self.size.x or self.messages.count != self.total:
+                self.messages = self.layout()
+            lines = self.messages.last(self.size.y - 2)
         y = 1
-        for line in self.messages.messages:
-            if line[:self.userNameLen] != " "*self.userNameLen:
-                self.window.addstr(
-                    y, 0, line[:self.userNameLen], self.colorPair)
-                self.window.addstr(y, self.userNameLen,
-                                   line[self.userNameLen:])
-            else:
-                self.window.addstr(y, 0, line)
+        for line in lines:
+            self.addLine(y, line)
             y += 1
-        self.window.refresh()
-        self.display.inputBar.window.touchwin()
+        self.clearRows(y)
+        if self.scrollback:
+            self.pageInfo()
+        else:
+            self.drawRow(0)
+        self.update()
 
 
 class _InputBar(_WindowBase):
     """Gets messages from user"""
 
+    backspaceKeys = ("\x08", "\x7f", curses.KEY_BACKSPACE)
+    enterKeys = ("\n", "\r", curses.KEY_ENTER)
+    editKeys = {curses.KEY_BACKSPACE, curses.KEY_ENTER, curses.KEY_DC, curses.KEY_LEFT,
+                curses.KEY_RIGHT, curses.KEY_UP, curses.KEY_DOWN, curses.KEY_HOME, curses.KEY_END}
+
     def __init__(self, window: curses.window, display) -> None:
         super().__init__(window, "display._InputBar")
-        self.input = ""
+        self.buffer = _GapBuffer()
+        self.pending = deque()  # keys that are read but not handled, a paste comes at once
+        self.top = 0  # first wrapped row of the input that is shown
         self.display = display
-        self.bottomLeft = (self.size.y - 1, 0)
         self.colorPair = curses.color_pair(displayOpts.colorPairs.greenBlack)
         self.sep = displayOpts.chars.horizontalSeparator
         self.refresh()
 
     def getInput(self) -> str:
         """Gets message from user"""
-        self.window.move(1, 0)
         while True:
-            char = self.getch()
-            if char == 8:  # Backspace
-                self.input = self.input[:-1]
-                self.refresh()
-            elif char == 10:  # Enter
-                break
-            else:
-                yx = self.window.getyx()
-                self.input += chr(char)
-                if yx == self.bottomLeft:
+            if not self.pending:
+                # Drawn once for all the keys that came together
+                with self.display.lock:
                     self.refresh()
-        input = self.input
-        self.input = ""
-        self.refresh()
+                self.readKeys()
+            key = self.pending.popleft()
+            if key in self.enterKeys:
+                break
+            self.edit(key)
+        input = self.buffer.text()
+        self.buffer.clear()
+        with self.display.lock:
+            self.refresh()
         return input
 
-    def getch(self) -> int:
-        """Redirects got char if it is not special key that the method uses"""
+    def waitKey(self) -> None:
+        """Waits for the terminal to have input, curses is not locked meanwhile"""
+        if os.name == "posix":
+            select.select([sys.stdin], [], [])
+        else:
+            time.sleep(1 / displayOpts.fps)
+
+    def readKeys(self) -> None:
+        """Waits for a key, then takes the ones that are already in the input"""
+        while not self.pending:
+            self.waitKey()
+            with self.display.lock:
+                self.window.nodelay(True)
+                try:
+                    while len(self.pending) < networkOpts.maxMessageLenght:
+                        self.pending.append(self.getch())
+                except curses.error:
+                    pass
+                finally:
+                    self.window.nodelay(False)
+
+    def edit(self, key) -> None:
+        """Applies a key to the input"""
+        width = self.size.x - 1
+        if key in self.backspaceKeys:
+            self.buffer.delete()
+        elif key == curses.KEY_DC:
+            self.buffer.deleteForward()
+        elif key == curses.KEY_LEFT:
+            self.buffer.move(-1)
+        elif key == curses.KEY_RIGHT:
+            self.buffer.move(1)
+        elif key == curses.KEY_UP:
+            self.buffer.move(-width)
+        elif key == curses.KEY_DOWN:
+            self.buffer.move(width)
+        elif key == curses.KEY_HOME:
+            self.buffer.move(-self.buffer.cursor)
+        elif key == curses.KEY_END:
+            self.buffer.move(len(self.buffer))
+        elif isinstance(key, str) and key.isprintable():
+            if len(self.buffer) < networkOpts.maxMessageLenght:
+                self.buffer.insert(key)
+
+    def getch(self):
+        """Redirects got char if it is not special key that the method uses,
+        returns a str for characters and an int for the keys in editKeys"""
         while True:
             char = self.window.get_wch()
             if char == curses.KEY_RESIZE:
                 self.display.reseparate()
+            elif char == curses.KEY_PPAGE:
+                self.display.messageBar.pageUp()
+            elif char == curses.KEY_NPAGE:
+                self.display.messageBar.pageDown()
             elif char == 3:
                 raise KeyboardInterrupt
+            elif isinstance(char, int) and char not in self.editKeys:
+                continue
             else:
-                return ord(char)
+                return char
 
     def topBorder(self) -> None:
         """Separates _MessagesBar from itself"""
-        for x in range(self.size.x-1):
-            self.window.addstr(0, x, self.sep, self.colorPair)
-
-    def formatInput(self) -> None:
-        """Scrolls message if it is too long"""
-        cursors = self.size.x * (self.size.y - 3)
-        length = len(self.input) % self.size.x
-        input = self.input[-(cursors + length):]
-        self.logger.debug("Input : %s")
-        self.window.addstr(input)
+        self.drawRow(0, (self.sep*(self.size.x-1), self.colorPair))
 
     def refresh(self) -> None:
-        """Refreshes the window"""
-        self.window.clear()
+        """Draws the rows of the input around the cursor, scrolls if it is too long"""
         self.topBorder()
-        self.window.move(1, 0)
-        self.formatInput()
-        self.window.refresh()
+        # The last column is left empty, curses can not write the last cell
+        width, rows = self.size.x - 1, self.size.y - 1
+        row, column = divmod(self.buffer.cursor, width)
+        self.top = min(max(self.top, row - rows + 1), row)
+        for y in range(rows):
+            start = (self.top + y) * width
+            self.drawRow(y + 1, (self.buffer.slice(start, start + width), 0))
+        self.window.move(row - self.top + 1, column)
+        self.update()
 
 
 class Display(_WindowBase):
-    """Main window"""
-
-    def __init__(self, user: str) -> None:
-        """user : user name"""
+    """Main window
+
+    Other threads post messages and users, one render thread draws them
+    at most displayOpts.fps times a second. Curses is used under self.lock."""
+
+    def __init__(self, user: str, history=None) -> None:
+        """user : user name
+        history : history.History for the scrollback of the default room"""
+        self.lock = th.RLock()
+        self._cond = th.Condition()
+        self._messages = []  # (msg, user) that are not drawn yet
+        self._replay = None  # recent messages of the server that are not drawn yet
+        self._users = None  # the last users list that is not drawn yet
+        self._presence = []  # (joined, user) after self._users
+        self._switch = None  # (room, history) that is not drawn yet
+        self.closed = False
         window = curses.initscr()
         window.keypad(1)
         curses.cbreak()
+        curses.noecho()  # the input bar draws the typed characters
         super().__init__(window, "display.Display")
         self.user = user
+        self.room = roomOpts.default
+        self.history = history
+        self.batching = True  # windows wait for one update of the display
         self.colors()
         self.bars()
         self.userBar.addUser(user)
+        self.batching = False
         self.refresh()
         self._ready = True
+        _thread(self._render)
 
     def exit(self):
-        self.window.keypad(0)
-        curses.nocbreak()
-        curses.endwin()
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        with self.lock:
+            self.window.keypad(0)
+            curses.echo()
+            curses.nocbreak()
+            curses.endwin()
+
+    def addMessage(self, msg: str, user: str) -> None:
+        """Posts a message to the render thread"""
+        with self._cond:
+            self._messages.append((msg, user))
+            self._cond.notify()
+
+    def replayMessages(self, messages: list) -> None:
+        """Posts the history a server sends on login, it is drawn in one frame"""
+        with self._cond:
+            self._replay = messages
+            self._cond.notify()
+
+    def switchRoom(self, room: str, history=None) -> None:
+        """Posts a room to show instead of the current one with its history,
+        what is posted for the current one and not drawn yet is dropped"""
+        with self._cond:
+            if self._switch and self._switch[1] is not None:
+                # Never shown
+                self._switch[1].close()
+            self.room = room
+            self.history = history
+            self._switch = (room, history)
+            self._messages = []
+            self._replay = None
+            self._users = None
+            self._presence = []
+            self._cond.notify()
+
+    def updateUser(self, users: list) -> None:
+        """Posts a users list, it replaces the one that is not drawn yet"""
+        with self._cond:
+            self._users = users
+            self._presence.clear()
+            self._cond.notify()
+
+    def addUser(self, user: str) -> None:
+        with self._cond:
+            self._presence.append((True, user))
+            self._cond.notify()
+
+    def removeUser(self, user: str) -> None:
+        with self._cond:
+            self._presence.append((False, user))
+            self._cond.notify()
+
+    def _pending(self) -> bool:
+        return bool(self._messages or self._replay or self._users is not None or self._presence
+                    or self._switch or self.closed)
+
+    def _render(self) -> None:
+        """Draws what is posted since the last frame, one frame at a time"""
+        frame = 1 / displayOpts.fps
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._pending)
+                messages, self._messages = self._messages, []
+                replay, self._replay = self._replay, None
+                users, self._users = self._users, None
+                presence, self._presence = self._presence, []
+                switch, self._switch = self._switch, None
+            start = time.perf_counter()
+            with self.lock:
+                if self.closed:
+                    return
+                self.batching = True
+                try:
+                    if switch:
+                        room, history = switch
+                        old = self.messageBar.history
+                        self.userBar.switchRoom(room)
+                        self.messageBar.switchHistory(history)
+                        if old is not None and old is not history:
+                            old.close()
+                    if users is not None or presence:
+                        self.userBar.applyUsers(users, presence)
+                    if replay:
+                        self.messageBar.replayMessages(replay)
+                    if messages:
+                        self.messageBar.addMessages(messages)
+                finally:
+                    self.batching = False
+                self.update()
+            time.sleep(max(frame - (time.perf_counter() - start), 0))
 
     def reseparate(self) -> None:
         """Updates the windows and the grid"""
@@ -338,16 +784,19 @@ class Display(_WindowBase):
             self.userBar.window = self.userBarSubwin
             self.messageBar.window = self.messageBarSubwin
             self.inputBar.window = self.inputBarSubwin
+            self.batching = True
             self.userBar.refresh()
             self.messageBar.refresh()
             self.inputBar.refresh()
+            self.batching = False
+            self.update()
             self.logger.debug("Windows reseparated")
 
     def bars(self) -> None:
         """Initilazes windows"""
         self.userBarSubwin, self.messageBarSubwin, self.inputBarSubwin = self.windows()
-        self.userBar = _UserBar(self.userBarSubwin)
-        self.messageBar = _MessageBar(self.messageBarSubwin, self)
+        self.userBar = _UserBar(self.userBarSubwin, self)
+        self.messageBar = _MessageBar(self.messageBarSubwin, self, self.history)
         self.inputBar = _InputBar(self.inputBarSubwin, self)
 
     def windows(self) -> tuple:
@@ -364,6 +813,7 @@ class Display(_WindowBase):
             userBar = None
             messageBar = grid.grids[0][0].window
             inputBar = grid.grids[1][0].window
+        inputBar.keypad(1)  # keys are read from the input bar
         return userBar, messageBar, inputBar
 
     def checkSizes(self) -> bool:
@@ -382,9 +832,19 @@ class Display(_WindowBase):
         curses.init_pair(displayOpts.colorPairs.yellowBlack,
                          curses.COLOR_YELLOW, curses.COLOR_BLACK)
 
+    def update(self) -> None:
+        """Writes the changes of every window to the terminal at once,
+        the input bar is the last one so the cursor stays in it"""
+        if self.batching:
+            return
+        if getattr(self, "inputBar", None):
+            self.inputBar.window.noutrefresh()
+        curses.doupdate()
+
     def refresh(self) -> None:
         """Refreshes the display"""
-        self.window.refresh()
+        self.window.noutrefresh()
+        self.update()
 
 
 if __name__ == "__main__":
@@ -392,7 +852,7 @@ if __name__ == "__main__":
     try:
         while True:
             msg = d.inputBar.getInput()
-            d.messageBar.addMessage(msg,d.user)
+            d.addMessage(msg,d.user)
     except KeyboardInterrupt:
         print("hahahahahhaha")
     except:
@@ -0,0 +1,291 @@
+"""Links between servers that share one chat
+
+Every server is a node with a random id. Messages and presence changes are
+events [origin 8][seq 8][payload], a node applies an event it has not seen,
+relays it to its other peers and drops the copies that come back, so the
+peers can be linked in any shape. Messages are the ones of the bus, presence
+payloads are [node 8][id 8][room lenght 1][room][user name], node is the one
+the user is logged in to. Only that node tells that its user left, a lost
+link only loses a path, the users of a node are forgotten when its
+heartbeats stop coming through any path. Frames are the ones of the
+bus, peers prove they know the password of the server with an HMAC of the
+nonce of the other side."""
+import hashlib
+import hmac
+import os
+import socket
+import threading as th
+import time
+from collections import deque
+
+try:
+    from .consts import networkOpts, federationOpts
+    from .logger import *
+    from .bus import _frame, _batches
+    from .network import _ServerBase
+    from lib import _thread, _Indexer, IndexerClosed
+except ImportError:
+    from consts import networkOpts, federationOpts
+    from logger import *
+    from bus import _frame, _batches
+    from network import _ServerBase
+    from __init__ import _thread, _Indexer, IndexerClosed
+
+
+def _int(value: int, size: int) -> bytes:
+    return value.to_bytes(size, networkOpts.byteorder)
+
+
+def _frames(sock: socket.socket):
+    for frames in _batches(sock):
+        yield from frames
+
+
+def parsePeer(peer: str) -> tuple:
+    """(host, port) of host:port"""
+    host, _, port = peer.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+class _Link:
+    """Connection to a peer, its events are written in batches by a thread"""
+
+    def __init__(self, sock: socket.socket, node: int, addr):
+        self.sock = sock
+        self.node = node
+        self.addr = addr
+        self.logger = Logger("federation._Link", addr)
+        self.outbound = _Indexer("outbound", federationOpts.queueSize)
+        _thread(self.writer)
+
+    def send(self, frame: bytes):
+        if not self.outbound.add(frame) and not self.outbound.closed:
+            self.logger.warn("Peer is not reading")
+            self.close()
+
+    def writer(self):
+        while True:
+            try:
+                frames = [self.outbound.pop()]
+            except IndexerClosed:
+                return
+            while len(frames) < federationOpts.queueSize and len(self.outbound):
+                frames.append(self.outbound.pop())
+            try:
+                self.sock.sendall(b"".join(frames))
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        self.outbound.close()
+        try:
+            # Wakes up the reader of the link
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Federation:
+    """Node of a server, listens for peers on <port> and connects to the
+    (host, port) of <peers>, again and again if the link is lost"""
+
+    def __init__(self, port: int = None, peers: list = (), secret: bytes = None):
+        self.logger = Logger("federation.Federation")
+        self.node = int.from_bytes(os.urandom(federationOpts.nodeLenght), networkOpts.byteorder)
+        self.port = port
+        self.peers = list(peers)
+        self.secret = secret or b""
+        self.server = None
+        self.links = []
+        self.users = {}  # (node, id, room) : user name
+        self._alive = {}  # node : monotonic time of its last event
+        self._seq = 0
+        self._seen = set()
+        self._order = deque()
+        self._lock = th.Lock()
+
+    def start(self, server):
+        """server : network.Server that gets the events of the peers"""
+        self.server = server
+        server.metrics.gauge("peers", lambda: len(self.links))
+        if self.port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("0.0.0.0", self.port))
+            sock.listen()
+            _thread(self.listen, sock)
+        for host, port in self.peers:
+            _thread(self.connector, host, port)
+        _thread(self.heartbeat)
+        self.logger.info("Node started : %016x", self.node)
+
+    def listen(self, sock: socket.socket):
+        while True:
+            conn, addr = sock.accept()
+            _thread(self.link, conn, addr)
+
+    def connector(self, host: str, port: int):
+        wait, longest = federationOpts.reconnect
+        while True:
+            try:
+                sock = socket.create_connection((host, port), networkOpts.timeout)
+            except OSError:
+                self.logger.warn("Peer is not reachable : %s:%s", host, port)
+            else:
+                if self.link(sock, (host, port)):
+                    wait = federationOpts.reconnect[0]
+            time.sleep(wait)
+            wait = min(wait * 2, longest)
+
+    def handshake(self, sock: socket.socket, frames) -> int:
+        """Node of the peer, None if it does not know the secret or it is this node"""
+        nonce = os.urandom(federationOpts.nonceLenght)
+        sock.sendall(_frame(federationOpts.hello, _int(self.node, federationOpts.nodeLenght) + nonce))
+        code, payload = next(frames, (None, b""))
+        if code != federationOpts.hello:
+            return None
+        node = int.from_bytes(payload[:federationOpts.nodeLenght], networkOpts.byteorder)
+        sock.sendall(_frame(federationOpts.auth, hmac.new(
+            self.secret, payload[federationOpts.nodeLenght:], hashlib.sha256).digest()))
+        code, payload = next(frames, (None, b""))
+        expected = hmac.new(self.secret, nonce, hashlib.sha256).digest()
+        if code != federationOpts.auth or not hmac.compare_digest(payload, expected):
+            self.logger.warn("Peer does not know the password")
+            return None
+        if node == self.node:
+            self.logger.warn("Link to this node")
+            return None
+        return node
+
+    def link(self, sock: socket.socket, addr) -> bool:
+        """Serves a link until it is lost, returns whether it was established"""
+        sock.settimeout(networkOpts.timeout)
+        frames = _frames(sock)
+        node = self.handshake(sock, frames)
+        if node is None:
+            sock.close()
+            return False
+        sock.settimeout(None)
+        link = _Link(sock, node, addr)
+        with self._lock:
+            self.links.append(link)
+            # The users this node knows, the peer relays them to its own peers
+            for user, userName in self.users.items():
+                link.send(self._event(federationOpts.joined, self._presence(user, userName)))
+        self.logger.info("Peer linked : %s %016x", addr, node)
+        self.server.metrics.inc("peerLinks")
+        for code, payload in frames:
+            self.receive(link, code, payload)
+        link.close()
+        with self._lock:
+            # Its users can be reachable through other links, heartbeat forgets the ones that are not
+            self.links.remove(link)
+        self.logger.warn("Peer is lost : %s", addr)
+        return True
+
+    def heartbeat(self):
+        """Tells the peers that this node is alive, forgets the users of the
+        nodes that are not heard from"""
+        while True:
+            time.sleep(federationOpts.heartbeatInterval)
+            with self._lock:
+                self._send([self._event(federationOpts.heartbeat, b"")])
+                expired = time.monotonic() - federationOpts.heartbeatInterval * federationOpts.missedHeartbeats
+                for user in [user for user in self.users
+                             if user[0] != self.node and self._alive.get(user[0], 0) < expired]:
+                    self.remove(user)
+                for node in [node for node, last in self._alive.items() if last < expired]:
+                    del self._alive[node]
+
+    def _presence(self, user: tuple, userName: str) -> bytes:
+        node, id, room = user
+        return (_int(node, federationOpts.nodeLenght) + _int(id, federationOpts.idLenght)
+                + _ServerBase.formatRoom(room) + userName.encode())
+
+    def _event(self, code: int, payload: bytes) -> bytes:
+        """Frame of a new event of this node, it is marked as seen"""
+        seq = self._seq
+        self._seq += 1
+        self._see((self.node, seq))
+        return _frame(code, _int(self.node, federationOpts.nodeLenght) + _int(seq, federationOpts.seqLenght)
+                      + payload)
+
+    def _see(self, event: tuple) -> bool:
+        """Returns False if the event is seen before"""
+        if event in self._seen:
+            return False
+        self._seen.add(event)
+        self._order.append(event)
+        if len(self._order) > federationOpts.seenSize:
+            self._seen.discard(self._order.popleft())
+        return True
+
+    def _send(self, frames: list, exclude: _Link = None):
+        for link in self.links:
+            if link is not exclude:
+                for frame in frames:
+                    link.send(frame)
+
+    def receive(self, link: _Link, code: int, payload: bytes):
+        if code not in (federationOpts.message, federationOpts.joined, federationOpts.left,
+                        federationOpts.heartbeat):
+            return
+        header = federationOpts.nodeLenght + federationOpts.seqLenght
+        event = (int.from_bytes(payload[:federationOpts.nodeLenght], networkOpts.byteorder),
+                 int.from_bytes(payload[federationOpts.nodeLenght:header], networkOpts.byteorder))
+        body = payload[header:]
+        with self._lock:
+            if not self._see(event):
+                return
+            self._alive[event[0]] = time.monotonic()
+            if code in (federationOpts.joined, federationOpts.left):
+                roomStart = federationOpts.nodeLenght + federationOpts.idLenght
+                room, userName = _ServerBase.readRoom(body[roomStart:])
+                userName = userName.decode(errors="replace")
+                user = (int.from_bytes(body[:federationOpts.nodeLenght], networkOpts.byteorder),
+                        int.from_bytes(body[federationOpts.nodeLenght:roomStart], networkOpts.byteorder), room)
+                if user[0] == self.node:
+                    self.correct(code, user, userName)
+                    return
+            self._send([_frame(code, payload)], link)
+            if code == federationOpts.message:
+                self.server.metrics.inc("peerMessagesIn")
+                self.server.remoteMessage(body)
+            elif code == federationOpts.joined:
+                # Its users are known to be there, even if only a peer told it
+                self._alive[user[0]] = time.monotonic()
+                if user not in self.users:
+                    self.users[user] = userName
+                    self.server.remoteJoined(user[:2], userName, room)
+            elif code == federationOpts.left and user in self.users:
+                self.remove(user)
+
+    def correct(self, code: int, user: tuple, userName: str):
+        """Answers a presence event about a user of this node that is not true
+        anymore, only this node knows whether its users are here"""
+        here = user in self.users
+        if here != (code == federationOpts.joined):
+            code = federationOpts.joined if here else federationOpts.left
+            self._send([self._event(code, self._presence(user, self.users.get(user, userName)))])
+
+    def remove(self, user: tuple):
+        del self.users[user]
+        self.server.remoteLeft(user[:2], user[2])
+
+    def message(self, msg: bytes):
+        """Sends a message of a local client to every peer"""
+        with self._lock:
+            self._send([self._event(federationOpts.message, msg)])
+
+    def joined(self, id: int, userName: str, room: str):
+        user = (self.node, id, room)
+        with self._lock:
+            self.users[user] = userName
+            self._send([self._event(federationOpts.joined, self._presence(user, userName))])
+
+    def left(self, id: int, userName: str, room: str):
+        user = (self.node, id, room)
+        with self._lock:
+            self.users.pop(user, None)
+            self._send([self._event(federationOpts.left, self._presence(user, userName))])
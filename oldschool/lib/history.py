@@ -0,0 +1,126 @@
+"""Append-only chat history on disk"""
+import json
+import mmap
+import os
+import threading as th
+from array import array
+
+try:
+    from .consts import historyOpts
+except ImportError:
+    from consts import historyOpts
+
+
+class _Mapped:
+    """Read only mmap of a file that grows, mapped again when it is needed"""
+
+    def __init__(self, file):
+        self.file = file
+        self.map = None
+
+    def view(self, end: int) -> mmap.mmap:
+        """Returns a map that covers the first <end> bytes"""
+        if self.map is None or len(self.map) < end:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class History:
+    """Messages of a server as one json line each, and an index file that
+    keeps the offset of every line, so any slice is read without a scan"""
+
+    OFFSET = "Q"
+
+    def __init__(self, name: str, directory: str = None):
+        directory = directory or os.path.join(os.path.dirname(__file__), "..", historyOpts.directory)
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        path = os.path.join(directory, name)
+        self._lock = th.Lock()
+        self._file = open(path + historyOpts.extension, "a+b")
+        self._index = open(path + historyOpts.indexExtension, "a+b")
+        self._offsetSize = array(self.OFFSET).itemsize
+        self._size = os.fstat(self._file.fileno()).st_size
+        if not self._valid():
+            self._rebuild()
+        self._count = os.fstat(self._index.fileno()).st_size // self._offsetSize
+        self._lines = _Mapped(self._file)
+        self._offsets = _Mapped(self._index)
+
+    def _valid(self) -> bool:
+        indexSize = os.fstat(self._index.fileno()).st_size
+        if indexSize % self._offsetSize:
+            return False
+        if not indexSize:
+            return not self._size
+        self._index.seek(indexSize - self._offsetSize)
+        last = array(self.OFFSET, self._index.read(self._offsetSize))[0]
+        self._file.seek(last)
+        tail = self._file.read()
+        # The last offset must point at the last complete line
+        return tail.endswith(b"\n") and tail.count(b"\n") == 1
+
+    def _rebuild(self):
+        """Indexes the history file again, cuts a partly written last line"""
+        offsets = array(self.OFFSET)
+        offset = 0
+        self._file.seek(0)
+        for line in self._file:
+            if not line.endswith(b"\n"):
+                break
+            offsets.append(offset)
+            offset += len(line)
+        self._file.truncate(offset)
+        self._index.truncate(0)
+        self._index.write(offsets.tobytes())
+        self._index.flush()
+        self._size = offset
+
+    def append(self, user: str, msg: str):
+        line = json.dumps((user, msg)).encode() + b"\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._index.write(array(self.OFFSET, (self._size,)).tobytes())
+            self._index.flush()
+            self._size += len(line)
+            self._count += 1
+
+    def read(self, start: int, stop: int) -> list:
+        """Returns the messages in [start, stop) as (message, user) tuples"""
+        with self._lock:
+            start, stop = max(start, 0), min(stop, self._count)
+            if start >= stop:
+                return []
+            size = self._offsetSize
+            offsets = array(self.OFFSET, self._offsets.view(stop * size)[start * size:stop * size])
+            end = self._size if stop == self._count else self.offset(stop)
+            data = self._lines.view(end)[offsets[0]:end]
+        first = offsets[0]
+        messages = []
+        for i, offset in enumerate(offsets):
+            lineEnd = offsets[i + 1] if i + 1 < len(offsets) else end
+            user, msg = json.loads(data[offset - first:lineEnd - first])
+            messages.append((msg, user))
+        return messages
+
+    def offset(self, i: int) -> int:
+        size = self._offsetSize
+        return array(self.OFFSET, self._offsets.view((i + 1) * size)[i * size:(i + 1) * size])[0]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        with self._lock:
+            self._lines.close()
+            self._offsets.close()
+            self._file.close()
+            self._index.close()
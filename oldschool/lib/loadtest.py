@@ -0,0 +1,192 @@
+"""Load test, drives a server in a child process with simulated clients
+
+Every client is a bot.Bot that speaks the real protocol. Messages carry the
+time they are sent, so every copy the server broadcasts gives the fan-out
+latency of one recipient."""
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from .consts import networkOpts
+    from .bot import Bot, LoginError
+    from .benchmark import _commit
+    from lib import _thread, _Value
+except ImportError:
+    from consts import networkOpts
+    from bot import Bot, LoginError
+    from benchmark import _commit
+    from __init__ import _thread, _Value
+
+_root = os.path.join(os.path.dirname(__file__), "..")
+
+
+def percentiles(values: list) -> dict:
+    """p50, p95, p99 and max of seconds in milliseconds"""
+    if not values:
+        return {}
+    values = sorted(values)
+    def at(p):
+        return values[min(len(values) * p // 100, len(values) - 1)] * 1000
+    return {"p50": at(50), "p95": at(95), "p99": at(99), "max": values[-1] * 1000}
+
+
+class _Server:
+    """Server in a child process, so the CPU time and RSS it reports are its own"""
+
+    def __init__(self, port: int, engine: str, queueSize: int, slowConsumer: str, encryptWorkers: int):
+        self.port = port
+        self.before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+        self.process = subprocess.Popen(
+            [sys.executable, _root, "-l", "warn", "server", "-p", str(port), "-e", engine,
+             "-q", str(queueSize), "-s", slowConsumer, "--encrypt-workers", str(encryptWorkers)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait()
+
+    def wait(self, timeout: float = 10):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited with %s" % self.process.returncode)
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError("Server did not start")
+
+    def stop(self) -> dict:
+        """Stops the server, returns its CPU seconds and peak RSS in KB"""
+        # SIGINT lets it shut its encrypt workers down, so they are counted too
+        self.process.send_signal(signal.SIGINT if os.name == "posix" else signal.SIGTERM)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        if self.before is None:
+            return {}
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {"cpu": after.ru_utime - self.before.ru_utime + after.ru_stime - self.before.ru_stime,
+                "maxrss": after.ru_maxrss}
+
+
+def _receive(bot: Bot, latencies: list, last: dict):
+    for msg, user in bot:
+        if user.startswith("load"):
+            now = time.perf_counter()
+            latencies.append(now - float(msg.split(" ", 2)[1]))
+            last["received"] = now
+
+
+def _payload(seq: int, size: int) -> str:
+    msg = "%s %.9f " % (seq, time.perf_counter())
+    return msg + "x" * (size - len(msg))
+
+
+def _churn(port: int, rate: float, stopped: _Value, result: dict):
+    """Connects, logs in and leaves <rate> times a second"""
+    i = 0
+    while not stopped.closed:
+        start = time.perf_counter()
+        try:
+            bot = Bot("churn%s" % i, "127.0.0.1", port)
+        except (LoginError, OSError):
+            result["failed"] += 1
+        else:
+            result["connect"].append(time.perf_counter() - start)
+            bot.close(1)
+        i += 1
+        try:
+            stopped.get(max(1 / rate - (time.perf_counter() - start), 0))
+        except TimeoutError:
+            pass
+
+
+def run(clients: int = 20, rate: float = 100, size: int = 64, duration: float = 10, churn: float = 0,
+        engine: str = "threading", port: int = networkOpts.defaultPort + 1,
+        queueSize: int = networkOpts.sendQueueSize, slowConsumer: str = networkOpts.slowConsumer,
+        encryptWorkers: int = networkOpts.encryptWorkers) -> dict:
+    """Sends <rate> messages of <size> characters a second from <clients> clients
+    for <duration> seconds, while <churn> more connect and leave every second"""
+    config = {"clients": clients, "rate": rate, "size": size, "duration": duration, "churn": churn,
+              "engine": engine, "queueSize": queueSize, "slowConsumer": slowConsumer,
+              "encryptWorkers": encryptWorkers}
+    server = _Server(port, engine, queueSize, slowConsumer, encryptWorkers)
+    bots = []
+    latencies = []
+    last = {"received": 0}
+    churned = {"connect": [], "failed": 0}
+    stopped = _Value("stopped")
+    usage = os.times()
+    try:
+        for i in range(clients):
+            bot = Bot("load%s" % i, "127.0.0.1", port)
+            bots.append(bot)
+            _thread(_receive, bot, latencies, last)
+        if churn:
+            _thread(_churn, port, churn, stopped, churned)
+        senders = list(bots)
+        sent = 0
+        expected = 0
+        start = time.perf_counter()
+        end = start + duration
+        while senders:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            due = start + sent / rate
+            if now < due:
+                time.sleep(due - now)
+                continue
+            bot = senders[sent % len(senders)]
+            try:
+                bot.send(_payload(sent, size))
+            except OSError:
+                # Disconnected by the server, a slow consumer
+                senders.remove(bot)
+                continue
+            sent += 1
+            expected += len(senders)
+        stopped.close()
+        # Waits for the broadcasts until they stop coming
+        delivered = -1
+        while delivered != len(latencies) < expected:
+            delivered = len(latencies)
+            time.sleep(0.5)
+        elapsed = max(last["received"], end) - start
+        disconnected = sum(bot.client.messages.closed for bot in bots)
+    finally:
+        stopped.close()
+        for bot in bots:
+            bot.close(1)
+        usage = [after - before for after, before in zip(os.times(), usage)]
+        serverUsage = server.stop()
+    delivered = len(latencies)
+    return {"commit": _commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config,
+            "sent": sent, "expected": expected, "delivered": delivered, "disconnected": disconnected,
+            "throughput": {"sent": sent / duration, "delivered": delivered / elapsed},
+            "latency": percentiles(latencies),
+            "churn": {"connections": len(churned["connect"]), "failed": churned["failed"],
+                      "connect": percentiles(churned["connect"])},
+            "server": serverUsage, "clients": {"cpu": usage[0] + usage[1]}}
+
+
+def save(result: dict, path: str = None):
+    """Writes the result as JSON to path, or stdout"""
+    if path:
+        with open(path, "w") as file:
+            json.dump(result, file, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
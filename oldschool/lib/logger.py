@@ -1,61 +1,192 @@
-import logging, os
+import logging, os, queue, threading, atexit
+from logging.handlers import QueueHandler, QueueListener
 try:
     from .consts import *
 except ImportError:
     from consts import *
 
+class _Logger(logging.Logger):
+    def findCaller(self, stack_info=False, stacklevel=1):
+        # The format has no file or line, walking the stack is wasted
+        return "(unknown file)", 0, "(unknown function)", None
+
+class _Formatter(logging.Formatter):
+    """Formats a record once for all the files it is written to"""
+
+    def format(self, record):
+        if not hasattr(record, "text"):
+            record.text = super().format(record)
+        return record.text
+
+class _Handler(QueueHandler):
+    """Drops records instead of blocking the caller when the queue is full"""
+    dropped = 0
+
+    def prepare(self, record):
+        # The listener is a thread of this process, no copy is needed
+        if isinstance(record.args, tuple):
+            record.args = tuple(map(_truncate, record.args))
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _FileHandler(logging.FileHandler):
+    """Leaves flushing to the listener"""
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+class _Listener(QueueListener):
+    def handle(self, record):
+        super().handle(record)
+        # One flush for every record that was waiting in the queue
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+    def enqueue_sentinel(self):
+        # Waits for room, the last records must be written before exit
+        self.queue.put(self._sentinel)
+
+def _truncate(arg):
+    if isinstance(arg, (bytes, bytearray)) and len(arg) > loggerOpts.payloadLenght:
+        return "%r...(%s bytes)" % (bytes(arg[:loggerOpts.payloadLenght]), len(arg))
+    return arg
+
+def _parseLevel(level) -> int:
+    if isinstance(level, int):
+        return level
+    for value, name in _levels.items():
+        if name == level.lower():
+            return value
+    raise ValueError("Unknown log level : %s" % level)
+
+def setLevel(level) -> None:
+    """Sets the level of every Logger, level is a name like "debug" or a number"""
+    global _level
+    _level = _parseLevel(level)
+    with _lock:
+        for logger in _loggers.values():
+            logger.setLevel(_level)
+
+_queue = queue.Queue(loggerOpts.queueSize)
+_handler = _Handler(_queue)
+_loggers = {}
+_lock = threading.Lock()
+_listener = None
+
+def _start() -> None:
+    """Opens one file per level, shared by every Logger, written by one thread"""
+    global _listener
+    path = os.path.join(os.path.dirname(__file__),"..",loggerOpts.directory)
+    if not os.path.exists(path):
+        os.mkdir(path)
+    formatter = _Formatter(loggerOpts.format)
+    handlers = []
+    for level in (logging.DEBUG, logging.INFO, logging.WARN, logging.ERROR, logging.FATAL):
+        file = os.path.join(path,".".join((_levels[level],loggerOpts.file)))
+        fileHandler = _FileHandler(file)
+        fileHandler.setLevel(level)
+        fileHandler.setFormatter(formatter)
+        handlers.append(fileHandler)
+    _listener = _Listener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def _afterFork() -> None:
+    """A forked process has no listener thread, it starts its own"""
+    global _queue, _lock, _listener
+    _queue = queue.Queue(loggerOpts.queueSize)
+    _handler.queue = _queue
+    _lock = threading.Lock()
+    if _listener is not None:
+        atexit.unregister(_listener.stop)
+        _listener = None
+        _start()
+
+def stopLogging() -> None:
+    """Writes the queued records, processes that leave through os._exit skip atexit"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            atexit.unregister(_listener.stop)
+            _listener.stop()
+            _listener = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_afterFork)
+
+def _getLogger(name: str) -> logging.Logger:
+    with _lock:
+        if _listener is None:
+            _start()
+        logger = _loggers.get(name)
+        if logger is None:
+            logger = _Logger(name, _level)
+            logger.addHandler(_handler)
+            _loggers[name] = logger
+        return logger
+
 class Logger:
-    def __init__(self, name:str):
-        self.formatter = logging.Formatter(loggerOpts.format)
-        self.path = os.path.join(os.path.dirname(__file__),"..",loggerOpts.directory)
-        if not os.path.exists(self.path):
-            os.mkdir(self.path)
-        self.file = ".".join((str(name),loggerOpts.file))
-        self._debug = self._logger(name, logging.DEBUG)
-        self._info = self._logger(name, logging.INFO)
-        self._warn = self._logger(name, logging.WARN)
-        self._error = self._logger(name, logging.ERROR)
-        self._fatal = self._logger(name, logging.FATAL)
+    def __init__(self, name:str, context:object=None):
+        self._logger = _getLogger(str(name))
+        self.context = context
+        self._packets = 0
 
+    @property
+    def context(self) -> object:
+        """Connection or anything else the records are about"""
+        return self.extra["context"]
+
+    @context.setter
+    def context(self, context:object) -> None:
+        self.extra = {"context": "-" if context is None else context}
+
+    # Disabled levels return before logging builds a record or formats args
     def debug(self, msg, *args, exc_info=False):
-        self._debug.debug(msg,*args,exc_info=exc_info)
+        if _level <= logging.DEBUG:
+            self._logger.debug(msg,*args,exc_info=exc_info,extra=self.extra)
+
+    def packet(self, msg, *args):
+        """Debug record for a packet, only one in loggerOpts.packetSample is written"""
+        if _level <= logging.DEBUG:
+            self._packets += 1
+            if self._packets % loggerOpts.packetSample == 0:
+                self._logger.debug(msg,*args,extra=self.extra)
 
     def info(self, msg, *args, exc_info=False):
-        self._debug.info(msg,*args,exc_info=exc_info)
-        self._info.info(msg,*args,exc_info=exc_info)
+        if _level <= logging.INFO:
+            self._logger.info(msg,*args,exc_info=exc_info,extra=self.extra)
 
     def warn(self, msg, *args, exc_info=False):
-        self._debug.warning(msg,*args,exc_info=exc_info)
-        self._info.warning(msg,*args,exc_info=exc_info)
-        self._warn.warning(msg,*args,exc_info=exc_info)
+        if _level <= logging.WARN:
+            self._logger.warning(msg,*args,exc_info=exc_info,extra=self.extra)
 
     def error(self, msg, *args, exc_info=False):
-        self._debug.error(msg,*args,exc_info=exc_info)
-        self._info.error(msg,*args,exc_info=exc_info)
-        self._warn.error(msg,*args,exc_info=exc_info)
-        self._error.error(msg,*args,exc_info=exc_info)
+        if _level <= logging.ERROR:
+            self._logger.error(msg,*args,exc_info=exc_info,extra=self.extra)
 
     def fatal(self, msg, *args, exc_info=False):
-        self._debug.fatal(msg,*args,exc_info=exc_info)
-        self._info.fatal(msg,*args,exc_info=exc_info)
-        self._warn.fatal(msg,*args,exc_info=exc_info)
-        self._error.fatal(msg,*args,exc_info=exc_info)
-        self._fatal.fatal(msg,*args,exc_info=exc_info)
-
-    def _addHandler(self, logger:logging.Logger, level:int) -> None:
-        file = ".".join((_levels[level],self.file))
-        file = os.path.join(self.path,file)
-        fileHandler = logging.FileHandler(file)
-        fileHandler.setFormatter(self.formatter)
-        logger.addHandler(fileHandler)
-
-    def _logger(self, name, level) -> logging.Logger:
-        logger = logging.Logger(name)
-        self._addHandler(logger, level)
-        return logger
+        self._logger.fatal(msg,*args,exc_info=exc_info,extra=self.extra)
 
 _levels = {0:"notset",10:"debug",20:"info",30:"warn",40:"error",50:"fatal"}
 
+try:
+    _level = _parseLevel(os.environ.get(loggerOpts.environ, loggerOpts.level))
+except ValueError:
+    _level = _parseLevel(loggerOpts.level)
+
 if __name__ == "__main__":
     import time
     l = Logger("test")
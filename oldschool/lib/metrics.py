@@ -0,0 +1,118 @@
+"""Counters, gauges and timings of a running server"""
+import json
+import os
+import re
+import threading as th
+import time
+from collections import deque
+
+try:
+    from .consts import metricsOpts
+except ImportError:
+    from consts import metricsOpts
+
+
+class _Timing:
+    """Count and sum of every sample, percentiles of the last ones"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=metricsOpts.samples)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.samples.append(seconds)
+
+    def summary(self) -> dict:
+        summary = {"count": self.count, "sum": self.sum}
+        samples = sorted(self.samples)
+        for name, quantile in metricsOpts.quantiles.items():
+            summary[name] = samples[min(int(len(samples) * quantile), len(samples) - 1)] if samples else 0
+        return summary
+
+
+class Metrics:
+    """Updated from every thread of a server, read with snapshot
+
+    Gauges are functions that are called when a snapshot is taken."""
+
+    def __init__(self, engine: str):
+        self.engine = engine
+        self.started = time.time()
+        self._lock = th.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def inc(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, func):
+        self.gauges[name] = func
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = _Timing()
+            timing.add(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            timings = {name: timing.summary() for name, timing in self.timings.items()}
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                # Lists of clients change while they are read
+                gauges[name] = None
+        return {"engine": self.engine, "time": time.time(), "uptime": time.time() - self.started,
+                "counters": counters, "gauges": gauges, "timings": timings}
+
+    def dump(self, path: str):
+        """Writes a snapshot to path, as JSON if it ends with .json and
+        in the Prometheus text format otherwise"""
+        snapshot = self.snapshot()
+        if path.endswith(".json"):
+            text = json.dumps(snapshot, indent=2)
+        else:
+            text = prometheus(snapshot)
+        temp = path + ".tmp"
+        with open(temp, "w") as file:
+            file.write(text)
+        # Readers never see a half written file
+        os.replace(temp, path)
+
+    def dumper(self, path: str, interval: float = metricsOpts.interval):
+        while True:
+            time.sleep(interval)
+            self.dump(path)
+
+
+def _name(name: str) -> str:
+    return metricsOpts.prefix + "_" + re.sub("([A-Z])", r"_\1", name).lower()
+
+
+def prometheus(snapshot: dict) -> str:
+    """Snapshot in the Prometheus text format, timings are summaries in seconds"""
+    lines = []
+    for name, value in sorted(snapshot["counters"].items()):
+        name = _name(name) + "_total"
+        lines += ["# TYPE %s counter" % name, "%s %s" % (name, value)]
+    gauges = dict(snapshot["gauges"], uptime=snapshot["uptime"])
+    for name, value in sorted(gauges.items()):
+        if value is not None:
+            name = _name(name)
+            lines += ["# TYPE %s gauge" % name, "%s %s" % (name, value)]
+    for name, summary in sorted(snapshot["timings"].items()):
+        name = _name(name) + "_seconds"
+        lines.append("# TYPE %s summary" % name)
+        for key, quantile in metricsOpts.quantiles.items():
+            lines.append('%s{quantile="%s"} %s' % (name, quantile, summary[key]))
+        lines += ["%s_sum %s" % (name, summary["sum"]), "%s_count %s" % (name, summary["count"])]
+    return "\n".join(lines) + "\n"
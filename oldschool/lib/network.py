@@ -1,136 +1,396 @@
 import socket
 import time
+import threading as th
 
 try:
-    from .consts import networkOpts, generalOpts
+    from .consts import networkOpts, generalOpts, metricsOpts, storeOpts, busOpts, roomOpts
     from .logger import *
     from . import sebcrypter as seb
-    from lib import _thread, _Indexer
+    from .broadcast import BroadcastEncrypter
+    from .metrics import Metrics
+    from .store import MessageStore
+    from lib import _thread, _Indexer, _Value, IndexerClosed
 except ImportError:
-    from consts import networkOpts, generalOpts
+    from consts import networkOpts, generalOpts, metricsOpts, storeOpts, busOpts, roomOpts
     from logger import *
     import sebcrypter as seb
-    from __init__ import _thread, _Indexer
+    from broadcast import BroadcastEncrypter
+    from metrics import Metrics
+    from store import MessageStore
+    from __init__ import _thread, _Indexer, _Value, IndexerClosed
 from hashlib import md5
+import json
+from collections import deque, OrderedDict
+
+
+class _Window:
+    """Sliding window over the chunks of a v1 transfer
+
+    Receivers answer data frames in order and reject everything until the
+    chunk they wait for arrives, so a no for the first unacknowledged chunk
+    sends it and the ones after it again. The last chunk waits for the
+    others, only its data frame can be shorter than packageSize."""
+
+    def __init__(self, msg: bytes, size: int = None):
+        packSize = networkOpts.packageSize
+        self.size = max(size or networkOpts.windowSize, 1)
+        self.chunks = [msg[i*packSize:(i+1)*packSize]
+                       for i in range((len(msg) // packSize) + 1)]
+        self.hashes = [md5(chunk).digest() for chunk in self.chunks]
+        self.acked = 0
+        self.next = 0
+        self.hashed = 0
+        self.inFlight = deque()
+        self.retransmits = 0
+
+    @property
+    def done(self) -> bool:
+        return self.acked == len(self.chunks)
+
+    def frames(self) -> list:
+        """Frames that fit in the window, as (code, data) tuples"""
+        frames = []
+        last = len(self.chunks) - 1
+        while self.next <= last and len(self.inFlight) < self.size:
+            if self.next == last and self.acked < last:
+                break
+            if self.hashed == self.next:
+                frames.append((networkOpts.hash, self.hashes[self.next]))
+                self.hashed += 1
+            frames.append((networkOpts.data, self.chunks[self.next]))
+            self.inFlight.append(self.next)
+            self.next += 1
+        return frames
+
+    @staticmethod
+    def chunkSize(dataSize: int, hashes: int) -> int:
+        """Length of a data frame after <hashes> hash frames of the transfer"""
+        packSize = networkOpts.packageSize
+        packCount = (dataSize // packSize) + 1
+        if hashes == packCount:
+            return dataSize - (packCount - 1) * packSize
+        return packSize
+
+    def response(self, resp: bytes):
+        chunk = self.inFlight.popleft()
+        if resp == b"ok":
+            self.acked += 1
+        elif chunk == self.acked:
+            self.retransmits += 1
+            self.next = self.acked
+
+
+class _RecvBuffer:
+    """Receive buffer filled with recv_into, frames are read with exact lengths"""
+
+    def __init__(self, sock: socket.socket, size: int = None):
+        self.sock = sock
+        self.buffer = bytearray(size or networkOpts.recvBufferSize)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def fill(self, n: int) -> bool:
+        """Receives until n bytes are buffered, False if the connection is closed"""
+        while self.end - self.start < n:
+            if self.start == self.end:
+                self.start = self.end = 0
+            if len(self.buffer) - self.start < n:
+                self._compact(n)
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end += received
+        return True
+
+    def _compact(self, n: int):
+        pending = bytes(self.view[self.start:self.end])
+        if n > len(self.buffer):
+            self.view.release()
+            self.buffer = bytearray(max(n, len(self.buffer) * 2))
+            self.view = memoryview(self.buffer)
+        self.buffer[:len(pending)] = pending
+        self.start = 0
+        self.end = len(pending)
+
+    def read(self, n: int) -> bytes:
+        if not self.fill(n):
+            return b""
+        data = bytes(self.view[self.start:self.start + n])
+        self.start += n
+        return data
+
+    def readInt(self, n: int) -> int:
+        """Reads an already buffered integer without copying it"""
+        value = int.from_bytes(self.view[self.start:self.start + n], networkOpts.byteorder)
+        self.start += n
+        return value
 
 
 class _SocketBase(socket.socket):
-    def __init__(self, name: str, key: bytes = None) -> None:
+    def __init__(self, name: str, key: bytes = None, context: object = None) -> None:
         super().__init__()
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.logger = Logger(name)
+        self.logger = Logger(name, context)
         self.rawKey = key
-        self._dataLength = _Indexer("_dataLength")
         self._hash = _Indexer("_hash")
         self._data = _Indexer("_data")
         self._response = _Indexer("_response")
+        self._payload = _Indexer("_payload")
+        self._frameLock = th.Lock()
+        self._transferLock = th.RLock()
         if self.rawKey:
             self.key = seb.readkey(key=key)
         else:
             self.key = None
         self.keySent = False
+        self.version = 1
+        self.sendVersion = 1
+        self.recvVersion = 1
+        self.peerVersion = None
+        self.metrics = None  # Metrics of the server the connection belongs to
+        self._incomingSize = 0
+        self._incomingHashes = 0
 
     def _send(self, code: int, data: bytes):
-        self.sendCode(code)
-        self.sock.send(data)
+        with self._frameLock:
+            if self.sendVersion >= 2:
+                self._sendFrame(code, data, networkOpts.flags.payload)
+            else:
+                self.sock.sendall(self._code(code) + data)
 
     def _recv(self, ind: _Indexer, buflen: int):
-        msg = self.sock.recv(buflen)
+        msg = self.recvBuffer.read(buflen)
         ind.add(msg)
-        self.logger.info("Message added to index : %s %s", msg, ind.name)
+        self.logger.packet("Message added to index : %s %s", msg, ind.name)
+
+    def _code(self, code: int) -> bytes:
+        return code.to_bytes(networkOpts.constLenght, networkOpts.byteorder)
+
+    def _frame(self, code: int, payload: bytes = b"", flags: int = 0) -> bytes:
+        header = networkOpts.constLenght + networkOpts.flagsLenght
+        frame = (header + len(payload)).to_bytes(networkOpts.frameLenght, networkOpts.byteorder)
+        frame += self._code(code) + flags.to_bytes(networkOpts.flagsLenght, networkOpts.byteorder)
+        return frame + payload
+
+    def _sendFrame(self, code: int, payload: bytes = b"", flags: int = 0):
+        self.sock.sendall(self._frame(code, payload, flags))
+        self.logger.packet("Frame sent : %s %s %s", code, flags, len(payload))
+
+    def _recvFrame(self) -> int:
+        buffer = self.recvBuffer
+        header = networkOpts.constLenght + networkOpts.flagsLenght
+        if not buffer.fill(networkOpts.frameLenght):
+            return 0
+        length = buffer.readInt(networkOpts.frameLenght)
+        if not header <= length <= networkOpts.maxFrameLenght:
+            self.logger.error("Invalid frame length : %s", length)
+            return 0
+        if not buffer.fill(length):
+            return 0
+        code = buffer.readInt(networkOpts.constLenght)
+        flags = buffer.readInt(networkOpts.flagsLenght)
+        payload = buffer.read(length - header)
+        if flags & networkOpts.flags.payload:
+            if code == networkOpts.response:
+                self._response.add(payload)
+            else:
+                self._payload.add((flags, payload))
+        self.logger.packet("Frame received : %s %s", code, flags)
+        return code
 
     def sendCode(self, code: int):
         if code.bit_length() == networkOpts.constLenght*8:
-            code = code.to_bytes(networkOpts.constLenght,
-                                 networkOpts.byteorder)
-            self.sock.send(code)
-            self.logger.info("Code sent : %s", code)
+            with self._frameLock:
+                if self.sendVersion >= 2:
+                    self._sendFrame(code)
+                else:
+                    self.sock.sendall(self._code(code))
+            self.logger.debug("Code sent : %s", code)
         else:
             self.logger.error("Code length is not approprite : %s", code)
 
     def recvCode(self) -> int:
-        buflen = networkOpts.constLenght
-        code = self.sock.recv(buflen)
-        self.logger.info("Received code : %s", code)
-        code = self.convertBytes(code)
+        """Receives the next code, payloads of transfer frames are put in their indexes"""
+        if self.recvVersion >= 2:
+            code = self._recvFrame()
+        else:
+            buflen = networkOpts.constLenght
+            if not self.recvBuffer.fill(buflen):
+                return 0
+            code = self.recvBuffer.readInt(buflen)
+            self.logger.debug("Received code : %s", code)
+            if code == networkOpts.dataLenght:
+                dataLen = self.recvBuffer.read(networkOpts.dataSizeLenght)
+                self._incomingSize = self.convertBytes(dataLen)
+                self._incomingHashes = 0
+                self._payload.add((None, dataLen))
+            elif code == networkOpts.hash:
+                self._incomingHashes += 1
+                self._recv(self._hash, networkOpts.hashLenght)
+            elif code == networkOpts.data:
+                self._recv(self._data, _Window.chunkSize(self._incomingSize, self._incomingHashes))
+            elif code == networkOpts.response:
+                self._recv(self._response, 2)
+        if code >> 8 == networkOpts.version >> 8:
+            self.peerVersion = code & 0xff
+            code = networkOpts.version
         return code
 
-    def sendEncoded(self, msg: bytes):
-        if self.key and self.keySent:
+    def upgrade(self, version: int):
+        """Sends the version code and switches outgoing frames to the version"""
+        with self._transferLock:
+            with self._frameLock:
+                self.sock.sendall(self._code(networkOpts.version | version))
+                self.sendVersion = version
+        self.logger.info("Sending with protocol version : %s", version)
+
+    def sendMessage(self, code: int, msg: bytes, encrypted: bool = False):
+        """Sends a code and its payload as one transfer"""
+        with self._transferLock:
+            if self.sendVersion >= 2:
+                self.sendEncoded(msg, code, encrypted)
+            else:
+                self.sendCode(code)
+                self.sendEncoded(msg, encrypted=encrypted)
+
+    def sendMessages(self, code: int, msgs: list):
+        """Sends many messages of a code, their frames are written at once"""
+        with self._transferLock:
+            if self.sendVersion < 2:
+                for msg in msgs:
+                    self.sendMessage(code, msg)
+                return
+            data = b"".join(self._frame(code, *self._encode(msg)) for msg in msgs)
+            with self._frameLock:
+                self.sock.sendall(data)
+        self.logger.debug("Messages sent : %s %s", code, len(msgs))
+
+    def _encode(self, msg: bytes, encrypted: bool = False) -> tuple:
+        """Encrypts msg if the key is sent, unless it is already encrypted with it,
+        returns it with the flags of its frame"""
+        flags = networkOpts.flags.payload
+        if encrypted:
+            flags |= networkOpts.flags.encrypted
+        elif self.key and self.keySent:
             msg = seb.encrypt(msg, self.key)
-        else:
-            pass
-        packSize = networkOpts.packageSize
+            flags |= networkOpts.flags.encrypted
+        return msg, flags
+
+    def sendEncoded(self, msg: bytes, code: int = networkOpts.data, encrypted: bool = False):
+        """Encrypts msg if the key is sent, unless it is already encrypted with it"""
+        msg, flags = self._encode(msg, encrypted)
+        with self._transferLock:
+            if self.sendVersion >= 2:
+                with self._frameLock:
+                    self._sendFrame(code, msg, flags)
+            else:
+                self._sendChunks(msg)
+
+    def _sendChunks(self, msg: bytes):
         dataSize = len(msg)
         self.logger.debug("Data size : %s", dataSize)
-        packCount = (dataSize // networkOpts.packageSize) + 1
-        self.logger.debug("Package count : %s", packCount)
         _dataSize = dataSize.to_bytes(
             networkOpts.dataSizeLenght, networkOpts.byteorder)
         self._send(networkOpts.dataLenght, _dataSize)
         self.logger.debug("Data size sent: %s", _dataSize)
-        for i in range(packCount):
-            data = msg[i*packSize:(i+1)*packSize]
-            hsh = md5(data).digest()
-            self._send(networkOpts.hash, hsh)
-            self.logger.debug("Hash sent : %s", hsh)
-            while True:
-                self._send(networkOpts.data, data)
-                self.logger.debug("Data sent : %s", data)
-                resp = self._response.pop()
-                self.logger.debug("Received response : %s", resp)
-                if resp == b"ok":
-                    break
-                elif resp == b"no":
-                    continue
+        window = _Window(msg)
+        while not window.done:
+            frames = window.frames()
+            if frames:
+                with self._frameLock:
+                    self.sock.sendall(b"".join(self._code(code) + data for code, data in frames))
+                self.logger.packet("Frames sent : %s", len(frames))
+            resp = self._response.pop(networkOpts.timeout)
+            self.logger.packet("Received response : %s", resp)
+            window.response(resp)
+        if window.retransmits:
+            self.logger.warn("Retransmitted chunks : %s", window.retransmits)
+            if self.metrics:
+                self.metrics.inc("chunksRetransmitted", window.retransmits)
 
     def recvDecoded(self) -> bytes:
+        flags, msg = self._payload.pop(networkOpts.timeout)
+        if flags is None:
+            msg = self._recvChunks(self.convertBytes(msg))
+            encrypted = self.keySent
+        else:
+            encrypted = flags & networkOpts.flags.encrypted
+        if self.key and encrypted:
+            msg = seb.decrypt(msg, self.key)
+            self.logger.debug("Decrypted message received : %s", msg)
+        else:
+            self.logger.debug("Unencrypted message received : %s", msg)
+        return msg
+
+    def _recvChunks(self, dataLen: int) -> bytes:
         sock = self
-        key = self.key
-        keySent = self.keySent
-        dataLen = int.from_bytes(sock._dataLength.pop(), networkOpts.byteorder)
         self.logger.debug("Received data length : %s", dataLen)
         packSize = networkOpts.packageSize
         packCount = (dataLen // packSize) + 1
         self.logger.debug("Package count to receive : %s", packCount)
         msg = b""
         for i in range(packCount):
-            hsh = sock._hash.pop()
-            self.logger.debug("Hash received : %s", hsh)
+            hsh = sock._hash.pop(networkOpts.timeout)
+            self.logger.packet("Hash received : %s", hsh)
             while True:
-                data = sock._data.pop()
-                self.logger.debug("Data received : %s", data)
+                data = sock._data.pop(networkOpts.timeout)
+                self.logger.packet("Data received : %s", data)
                 if md5(data).digest() == hsh:
                     sock._send(networkOpts.response, b"ok")
-                    self.logger.debug("Response sent : %s", "OK")
+                    self.logger.packet("Response sent : %s", "OK")
                     msg += data
                     break
                 else:
                     sock._send(networkOpts.response, b"no")
-                    self.logger.debug("Response sent : %s", "NO")
+                    self.logger.packet("Response sent : %s", "NO")
+                    if self.metrics:
+                        self.metrics.inc("chunksRejected")
                     continue
-        if key and keySent:
-            msg = seb.decrypt(msg, key)
-            self.logger.info("Decrypted message received : %s", msg)
-        else:
-            self.logger.info("Unencrypted message received : %s", msg)
         return msg
 
     def convertBytes(self, _bytes: bytes) -> int:
         return int.from_bytes(_bytes, networkOpts.byteorder)
 
+    def closeIndexes(self):
+        for ind in (self._hash, self._data, self._response, self._payload):
+            ind.close()
+
+    def close(self):
+        self.closeIndexes()
+        if getattr(self, "sock", self) is not self:
+            self.sock.close()
+        super().close()
+
 
 class _Client(_SocketBase):
-    def __init__(self, sock: socket.socket, addr: tuple, key: bytes):
-        super().__init__(addr, key)
+    def __init__(self, sock: socket.socket, addr: tuple, key: bytes,
+                 queueSize: int = networkOpts.sendQueueSize):
+        super().__init__("network._Client", key, addr)
         self.addr = addr
         self.sock = sock
+        self.recvBuffer = _RecvBuffer(sock)
+        self.outbound = _Indexer("outbound", queueSize)
+        self.sharedKey = None
         self.userName = None
         self.id = None
+        self.versionAnswered = False
+        self.authorized = False  # passed the password, may ask for stats
+        self.rooms = set()
 
     def sendMsg(self, msg: bytes):
         self.sendEncoded(msg)
 
+    def answerVersion(self):
+        if self.versionAnswered:
+            # Second version code marks that the peer switched its frames
+            self.recvVersion = self.version
+            self.logger.info("Receiving with protocol version : %s", self.version)
+        else:
+            self.versionAnswered = True
+            self.version = min(self.peerVersion, networkOpts.protocolVersion)
+            _thread(self.upgrade, self.version)
+
     def setUserName(self, userName: str):
         self.userName = userName
         self.logger.debug("User name set : %s", userName)
@@ -144,52 +404,285 @@ class _Client(_SocketBase):
         self.id = id
         self.logger.debug("ID set : %s", id)
 
+    def closeIndexes(self):
+        super().closeIndexes()
+        self.outbound.close()
+
     def __repr__(self) -> str:
         return str(self.addr)
 
 
-class Server(_SocketBase):
-    def __init__(self, password: str = None):
+class _RemoteUser:
+    """Client of another worker or server, it is only in the users lists"""
+
+    def __init__(self, userName: str):
+        self.userName = userName
+        self.rooms = set()
+
+
+class _Recent:
+    """Latest <size> messages of every room, the rooms that have not had a
+    message for the longest are forgotten after roomOpts.recentRooms"""
+
+    def __init__(self, size: int, rooms: int = roomOpts.recentRooms):
+        self.size = size
+        self.rooms = rooms
+        self._rooms = OrderedDict()
+
+    def add(self, room: str, msg: bytes):
+        if not self.size:
+            return
+        recent = self._rooms.pop(room, None)
+        if recent is None:
+            recent = deque(maxlen=self.size)
+        recent.append(msg)
+        self._rooms[room] = recent
+        if len(self._rooms) > self.rooms:
+            self._rooms.popitem(last=False)
+
+    def get(self, room: str) -> list:
+        return list(self._rooms.get(room, ()))
+
+    def items(self):
+        """(room, messages) from the room with the oldest last message"""
+        return [(room, list(recent)) for room, recent in self._rooms.items()]
+
+
+class _ServerBase:
+    def startMetrics(self, engine: str, metricsFile: str = None, interval: float = metricsOpts.interval):
+        """Metrics of the server, dumped to metricsFile every <interval> seconds if it is given"""
+        self.metrics = Metrics(engine)
+        self.metrics.gauge("connected", lambda: len(self.clients))
+        self.metrics.gauge("loggedIn", lambda: len(self.clientsLoggedIn))
+        if metricsFile:
+            _thread(self.metrics.dumper, metricsFile, interval)
+
+    def openStore(self, directory: str = None, fsyncInterval: float = storeOpts.fsyncInterval):
+        """Keeps every message in a MessageStore in directory if it is given,
+        the recent messages start with the newest ones in it"""
+        self.store = None
+        if directory:
+            self.store = MessageStore(directory, fsyncInterval=fsyncInterval)
+            self.metrics.gauge("storeQueue", lambda: len(self.store._queue))
+            self.metrics.gauge("stored", lambda: len(self.store))
+            self.logger.info("Message store opened : %s", directory)
+            for record in self.store.last(self.recent.size):
+                self.recent.add(record.room, self.formatMessage(record.msg, record.user))
+
+    def formatHistory(self, messages: list, prefix: bytes = b"") -> bytes:
+        """Formatted messages as [lenght][message] each after prefix, the
+        oldest ones are left out if the encrypted payload would not fit in a frame"""
+        size = len(prefix)
+        history = []
+        for msg in reversed(messages):
+            size += networkOpts.frameLenght + len(msg)
+            # Encryption doubles the size
+            if size * 2 > networkOpts.maxFrameLenght - networkOpts.constLenght - networkOpts.flagsLenght:
+                break
+            history.append(len(msg).to_bytes(networkOpts.frameLenght, networkOpts.byteorder) + msg)
+        return prefix + b"".join(reversed(history))
+
+    def sendHistory(self, conn, room: str, **kwargs):
+        """Sends the recent messages of room to conn in one transfer, before
+        any new one, kwargs are passed to send"""
+        messages = self.recent.get(room)
+        if conn.version < 4 or not messages:
+            return
+        prefix = self.formatRoom(room) if conn.version >= 5 else b""
+        self.send(conn, networkOpts.history, self.formatHistory(messages, prefix), **kwargs)
+        self.metrics.inc("historyReplays")
+
+    @staticmethod
+    def formatRoom(room: str) -> bytes:
+        """[lenght 1][room], room payloads of clients since version 5 start with it"""
+        room = room.encode()
+        return len(room).to_bytes(1, networkOpts.byteorder) + room
+
+    @staticmethod
+    def readRoom(payload: bytes) -> tuple:
+        """(room, the rest of the payload)"""
+        size = payload[0] if payload else 0
+        return payload[1:size + 1].decode(errors="replace"), payload[size + 1:]
+
+    @staticmethod
+    def checkRoom(room: bytes):
+        try:
+            room = room.decode()
+        except UnicodeDecodeError:
+            return False
+        # Rooms name the history files of the clients
+        if not 0 < len(room) <= roomOpts.maxNameLenght or not all(
+                c.isalnum() or c in roomOpts.chars for c in room):
+            return False
+        return room
+
+    def roomPayload(self, conn, room: str, payload: bytes) -> bytes:
+        """payload as conn expects it, older clients are only in the default room"""
+        return self.formatRoom(room) + payload if conn.version >= 5 else payload
+
+    def addMember(self, conn, room: str) -> bool:
+        """Adds conn to the members of room, False if it is already one"""
+        if room in conn.rooms:
+            return False
+        conn.rooms.add(room)
+        # Ordered like a list, removed without a scan
+        self.rooms.setdefault(room, {})[conn] = None
+        return True
+
+    def removeMember(self, conn, room: str) -> bool:
+        if room not in conn.rooms:
+            return False
+        conn.rooms.discard(room)
+        members = self.rooms[room]
+        del members[conn]
+        if not members:
+            del self.rooms[room]
+        return True
+
+    def stats(self) -> bytes:
+        return json.dumps(self.metrics.snapshot()).encode()
+
+    def id(self):
+        id = self._id
+        self._id += 1
+        return id
+
+    def formatMessage(self, msg: bytes, userName: str) -> bytes:
+        message = generalOpts.maxUserNameLenght.to_bytes(
+            1, networkOpts.byteorder) + userName.encode().ljust(generalOpts.maxUserNameLenght) + msg
+        return message
+
+    def readMessage(self, msg: bytes) -> tuple:
+        """(user name, message) of a formatted message"""
+        mul = msg[0]
+        return msg[1:mul + 1].decode(errors="replace").rstrip(), msg[mul + 1:]
+
+    def formatUsers(self, users: list) -> bytes:
+        mul = generalOpts.maxUserNameLenght.to_bytes(1, networkOpts.byteorder)
+        return mul + b"".join(user.encode() for user in users)
+
+    def presence(self, code: int, conn, roster: list, room: str):
+        """Tells roster, the users of room, that conn joined or left as
+        (client, code, payload)
+
+        Clients since version 3 get a snapshot when they join and the
+        joined or left user after that, older ones get the whole list."""
+        userName = conn.userName.encode()
+        for c in roster:
+            if isinstance(c, _RemoteUser):
+                continue
+            if c.version >= 3 and c is not conn:
+                yield c, code, self.roomPayload(c, room, userName)
+            else:
+                users = [u.userName for u in roster if u is not c]
+                yield c, networkOpts.users, self.roomPayload(c, room, self.formatUsers(users))
+
+    def checkUserName(self, userName: bytes):
+        try:
+            userName = userName.decode()
+        except UnicodeDecodeError:
+            return False
+        # TODO return int for determition of inappropriate user name
+        if "\\" in repr(userName) or len(userName) > generalOpts.maxUserNameLenght:
+            return False
+        return userName
+
+
+class Server(_SocketBase, _ServerBase):
+    def __init__(self, password: str = None, sendQueueSize: int = networkOpts.sendQueueSize,
+                 slowConsumer: str = networkOpts.slowConsumer,
+                 encryptWorkers: int = networkOpts.encryptWorkers, port: int = networkOpts.defaultPort,
+                 metricsFile: str = None, metricsInterval: float = metricsOpts.interval,
+                 store: str = None, fsyncInterval: float = storeOpts.fsyncInterval,
+                 historySize: int = networkOpts.historySize, bus=None, federation=None):
+        """bus : bus.Bus of a worker, the messages and users of the other workers come from it
+        federation : federation.Federation, the same for the users of other servers"""
         super().__init__("network.Server")
         self.password = password
         if self.password:
             self.password = self.password.encode()
-        self.bind(("0.0.0.0", networkOpts.defaultPort))
+        self.sendQueueSize = sendQueueSize
+        self.slowConsumer = slowConsumer
+        self.bus = bus
+        self.federation = federation
+        if bus is not None:
+            # Every worker listens on the port, the kernel shares the connections between them
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.bind(("0.0.0.0", port))
         self.listen()
         self.settimeout(networkOpts.timeout)
+        self.running = True
         self._id = 0
         self.clients = []
         self.clientsLoggedIn = []
-        self._messagesToSend = _Indexer()
+        self._messagesToSend = _Indexer("_messagesToSend")
+        self._presence = _Indexer("_presence")
+        self.recent = _Recent(historySize)
+        self.rooms = {}  # room : {client of this server : None}, the other users are only in the presence rosters
+        # A join takes the recent messages and joins between two broadcasts
+        self._recentLock = th.Lock()
+        self.encrypter = BroadcastEncrypter(encryptWorkers)
+        self.startMetrics("threading", metricsFile, metricsInterval)
+        # Received messages, joins and parts that wait for the sender
+        self.metrics.gauge("messageQueue", lambda: len(self._messagesToSend))
+        self.metrics.gauge("presenceQueue", lambda: len(self._presence))
+        self.metrics.gauge("rooms", lambda: len(self.rooms))
+        self.metrics.gauge("sendQueues", lambda: sum(len(c.outbound) for c in self.clientsLoggedIn.copy()))
+        self.metrics.gauge("sendQueueMax", lambda: max((len(c.outbound) for c in self.clientsLoggedIn.copy()), default=0))
+        self.openStore(store, fsyncInterval)
         _thread(self.sender)
         self.logger.debug("Sender started")
         _thread(self.userNameSender)
         self.logger.debug("User name sender started")
+        self._remote = {}  # (worker or node, id) : _RemoteUser
+        if bus is not None:
+            _thread(self.busReader)
+            self.logger.debug("Bus reader started")
+        if federation is not None:
+            federation.start(self)
         self.logger.info("Server is ready and running")
         self.waitConnection()
 
     def sender(self):
+        """Reads the messages, joins and parts of the clients in the order they are sent"""
         while True:
-            c = self._messagesToSend.pop()
-            self.message(c)
-
-    def id(self):
-        id = self._id
-        self._id += 1
-        return id
+            code, c = self._messagesToSend.pop()
+            try:
+                if code == networkOpts.message:
+                    self.message(c)
+                elif code == 0:
+                    _thread(self.terminateConnection, c, "Connection Lost")
+                else:
+                    self.room(code, c)
+            except (TimeoutError, IndexerClosed):
+                c.logger.warn("Message could not be received")
 
     def waitConnection(self) -> None:
-        while True:
+        while self.running:
             try:
                 conn, addr = self.accept()
                 self.logger.info("Connectted : %s", addr)
+                self.metrics.inc("connections")
                 _thread(self.authentication, conn)
             except socket.timeout:
                 continue
+            except OSError:
+                if self.running:
+                    raise
+
+    def stop(self):
+        """Stops accepting connections, waitConnection returns"""
+        self.running = False
+        try:
+            # Wakes up accept
+            self.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def authentication(self, conn: socket.socket) -> bool:
         fails = 0
-        conn = _Client(conn, conn.getpeername(), None)
+        conn = _Client(conn, conn.getpeername(), None, self.sendQueueSize)
+        conn.metrics = self.metrics
         self.clients.append(conn)
         _thread(self.makeConnection, conn)
         self.addKey(conn)
@@ -203,12 +696,14 @@ class Server(_SocketBase):
                     conn.logger.info("Received password : %s", passwd)
                     if passwd == self.password:
                         conn.logger.info("Received password is correct")
+                        conn.authorized = True
                         conn.sendCode(networkOpts.correctPassword)
                         conn.logger.debug("Correct password code sent")
                         self.allowConnection(conn)
                         break
                     else:
                         fails += 1
+                        self.metrics.inc("failedLogins")
                         conn.logger.warn("Received password is incorrect")
                         time.sleep(3)
                         conn.sendCode(networkOpts.incorrectPassword)
@@ -228,7 +723,11 @@ class Server(_SocketBase):
                     conn.logger.warn("BrokenPipe")
                     self.terminateConnection(conn, "BrokenPipe")
                     break
+                except IndexerClosed:
+                    conn.logger.info("Closed before login")
+                    break
         else:
+            conn.authorized = True
             conn.sendCode(networkOpts.passwordNotRequired)
             conn.logger.debug("Password not required code sent")
             self.allowConnection(conn)
@@ -237,17 +736,26 @@ class Server(_SocketBase):
         self.logger.info("Connecttion allowed : %s", conn)
         conn.sendCode(networkOpts.userName)
         conn.logger.debug("User name code sent")
-        rawUserName = conn.recvDecoded()
+        try:
+            rawUserName = conn.recvDecoded()
+        except (TimeoutError, IndexerClosed):
+            # Closed by a stats query or a client that gave up
+            conn.logger.info("No user name received")
+            return
         conn.logger.info("Received user name : %s", rawUserName)
         userName = self.checkUserName(rawUserName)
         if userName:
             conn.sendCode(networkOpts.appropriateUserName)
             self.logger.debug("User name appropriate code sent")
-            conn.sendCode(networkOpts.loginSuccessful)
-            self.logger.debug("Login successful code sent")
             conn.setUserName(userName.ljust(generalOpts.maxUserNameLenght))
             conn.setId(self.id())
+            # In the room before the client can send to it, what is queued is written after the login code
             self.clientsLoggedIn.append(conn)
+            self.joinRoom(conn, roomOpts.default)
+            conn.sendCode(networkOpts.loginSuccessful)
+            self.logger.debug("Login successful code sent")
+            _thread(self.writer, conn)
+            self.metrics.inc("logins")
             self.logger.info("Client added clientsLoggedIn : %s", conn)
         else:
             conn.sendCode(networkOpts.inappropriateUserName)
@@ -258,30 +766,160 @@ class Server(_SocketBase):
         while True:
             try:
                 code = conn.recvCode()
-                conn.logger.info("Received code : %s", code)
+                conn.logger.debug("Received code : %s", code)
             except ConnectionResetError:
                 self.terminateConnection(conn, "Connection Reset by Peer")
-            if code == networkOpts.message:
-                self._messagesToSend.add(conn)
-            elif code == networkOpts.dataLenght:
-                conn._recv(conn._dataLength, networkOpts.dataSizeLenght)
-            elif code == networkOpts.hash:
-                conn._recv(conn._hash, networkOpts.hashLenght)
-            elif code == networkOpts.data:
-                conn._recv(conn._data, networkOpts.packageSize)
-            elif code == networkOpts.response:
-                conn._recv(conn._response, 2)
+                break
+            except OSError:
+                break
+            if code in (networkOpts.message, networkOpts.join, networkOpts.part):
+                self._messagesToSend.add((code, conn))
+            elif code == networkOpts.version:
+                conn.answerVersion()
+            elif code == networkOpts.stats:
+                if conn.authorized:
+                    _thread(self.sendStats, conn)
             elif code == 0:
-                self.terminateConnection(conn, "Connection Lost")
+                # After what it sent before
+                self._messagesToSend.add((code, conn))
                 break
             else:
                 pass
 
     def message(self, conn: _Client):
         msg = conn.recvDecoded()
-        conn.logger.info("Received message : %s", msg)
-        formattedMsg = self.formatMessage(msg, conn.userName)
-        self.sendToEveryone(networkOpts.message, formattedMsg)
+        start = time.perf_counter()
+        conn.logger.debug("Received message : %s", msg)
+        self.metrics.inc("messagesIn")
+        self.metrics.inc("bytesIn", len(msg))
+        room = roomOpts.default
+        if conn.version >= 5:
+            room, msg = self.readRoom(msg)
+        if room not in conn.rooms:
+            conn.logger.warn("Message to a room it is not in : %s", room)
+            return
+        # Relayed with its room, the clients since version 5 get it as it is
+        routedMsg = self.formatRoom(room) + self.formatMessage(msg, conn.userName)
+        if self.bus is not None:
+            # Sent to the clients when the hub relays it back
+            self.bus.message(routedMsg)
+            return
+        if self.store is not None:
+            self.store.append(conn.userName.rstrip(), msg, room)
+        self.broadcast(routedMsg, start)
+        if self.federation is not None:
+            self.federation.message(routedMsg)
+
+    def broadcast(self, msg: bytes, start: float = None):
+        """Sends a message with its room to the members of the room"""
+        room, formattedMsg = self.readRoom(msg)
+        evicted = []
+        with self._recentLock:
+            self.recent.add(room, formattedMsg)
+            self.sendToMembers(list(self.rooms.get(room, ())), networkOpts.message, msg, formattedMsg, start,
+                               evicted)
+        # Evicting parts the rooms of the client, that takes the lock again
+        for conn in evicted:
+            self.evict(conn)
+
+    def room(self, code: int, conn: _Client):
+        """Joins or parts the room conn sent"""
+        rawRoom = conn.recvDecoded()
+        if conn.version < 5:
+            return
+        room = self.checkRoom(rawRoom)
+        if not room:
+            conn.logger.warn("Inappropriate room name : %s", rawRoom)
+            # A join that fails is answered like a part
+            self.send(conn, networkOpts.part, rawRoom)
+        elif code == networkOpts.join:
+            self.joinRoom(conn, room)
+        else:
+            self.partRoom(conn, room)
+
+    def joinRoom(self, conn: _Client, room: str):
+        evicted = []
+        with self._recentLock:
+            if conn not in self.clientsLoggedIn or not self.addMember(conn, room):
+                return
+            if conn.version >= 5:
+                self.send(conn, networkOpts.join, room.encode(), evicted=evicted)
+            self.sendHistory(conn, room, evicted=evicted)
+        self.presenceChanged(networkOpts.userJoined, conn, room)
+        conn.logger.info("Joined room : %s", room)
+        # After the join, so it is left after it
+        for conn in evicted:
+            self.evict(conn)
+
+    def partRoom(self, conn: _Client, room: str, answer: bool = True):
+        """answer : tells conn, it is not told when it leaves"""
+        with self._recentLock:
+            if not self.removeMember(conn, room):
+                return
+        if answer and conn.version >= 5:
+            self.send(conn, networkOpts.part, room.encode())
+        self.presenceChanged(networkOpts.userLeft, conn, room)
+        conn.logger.info("Parted room : %s", room)
+
+    def remoteMessage(self, msg: bytes):
+        """Message of a client of another server"""
+        if self.store is not None:
+            room, formattedMsg = self.readRoom(msg)
+            self.store.append(*self.readMessage(formattedMsg), room)
+        self.broadcast(msg)
+
+    def remoteJoined(self, user: tuple, userName: str, room: str):
+        conn = self._remote.get(user)
+        if conn is None:
+            conn = self._remote[user] = _RemoteUser(userName)
+        if room not in conn.rooms:
+            conn.rooms.add(room)
+            self._presence.add((networkOpts.userJoined, conn, room))
+
+    def remoteLeft(self, user: tuple, room: str):
+        conn = self._remote.get(user)
+        if conn is None or room not in conn.rooms:
+            return
+        conn.rooms.discard(room)
+        if not conn.rooms:
+            del self._remote[user]
+        self._presence.add((networkOpts.userLeft, conn, room))
+
+    def presenceChanged(self, code: int, conn: _Client, room: str):
+        """Tells the users of room here and the other workers or servers"""
+        self._presence.add((code, conn, room))
+        # Both publish the same way, only one of them is used
+        publisher = self.bus if self.bus is not None else self.federation
+        if publisher is not None:
+            publish = publisher.joined if code == networkOpts.userJoined else publisher.left
+            publish(conn.id, conn.userName, room)
+
+    def busReader(self):
+        """Sends what the hub relays to the clients of this worker, in the
+        order every worker gets it"""
+        for code, payload in self.bus:
+            if code == busOpts.message:
+                self.broadcast(payload)
+            elif code == busOpts.history:
+                self.recent.add(*self.readRoom(payload))
+            elif code in (busOpts.joined, busOpts.left):
+                worker, id, room, userName = payload
+                # The users of this worker are told when they join or leave
+                if worker == self.bus.worker:
+                    continue
+                if code == busOpts.joined:
+                    self.remoteJoined((worker, id), userName, room)
+                else:
+                    self.remoteLeft((worker, id), room)
+        self.logger.fatal("Connection to the hub is lost")
+        # Its clients are lost for the other workers, the worker is started again if the hub is still there
+        self.stop()
+
+    def sendStats(self, conn: _Client):
+        try:
+            conn.sendMessage(networkOpts.stats, self.stats())
+        except (TimeoutError, IndexerClosed, socket.error):
+            conn.logger.warn("Stats could not be sent")
 
     def addKey(self, conn: _Client) -> list:
         conn.sendCode(networkOpts.key)
@@ -289,58 +927,107 @@ class Server(_SocketBase):
         key = conn.recvDecoded()
         conn.logger.debug("Received key : %s", key)
         conn.setKey(key)
+        conn.sharedKey = self.encrypter.share(conn.rawKey, conn.key)
         conn.keySent = True
 
-    def formatMessage(self, msg: bytes, userName: str) -> bytes:
-        message = generalOpts.maxUserNameLenght.to_bytes(
-            1, networkOpts.byteorder) + userName.encode().ljust(generalOpts.maxUserNameLenght) + msg
-        return message
-
     def userNameSender(self):
+        # Own copy of the users of every room so a snapshot and the changes after it match
+        rosters = {}
         while True:
-            loggedinclients = self.clientsLoggedIn.copy()
-            while loggedinclients == self.clientsLoggedIn:
-                pass
-            self.logger.debug("Sending users : %s", self.clientsLoggedIn)
-            for c in self.clientsLoggedIn:
-                users = [u.userName for u in self.clientsLoggedIn if u.id != c.id]
-                if not users:
-                    break
-                mul = generalOpts.maxUserNameLenght.to_bytes(
-                    1, networkOpts.byteorder)
-                message = b""
-                message += mul
-                for user in users:
-                    message += user.encode()
-                c.sendCode(networkOpts.users)
-                c.logger.debug("Users code sent")
-                c.sendEncoded(message)
-                c.logger.debug("Users sent")
-
-    def sendToEveryone(self, code, msg):
-        self.logger.debug("Sending to everyone : %s %s", code, msg)
-        for conn in self.clientsLoggedIn:
-            conn.sendCode(code)
-            conn.sendEncoded(msg)
+            code, conn, room = self._presence.pop()
+            roster = rosters.setdefault(room, [])
+            if code == networkOpts.userJoined:
+                roster.append(conn)
+            elif conn in roster:
+                roster.remove(conn)
+            else:
+                continue
+            self.logger.debug("Sending presence : %s %s %s", code, conn, room)
+            for c, code, msg in self.presence(code, conn, roster, room):
+                self.send(c, code, msg)
+            if not roster:
+                del rosters[room]
 
-    def checkUserName(self, userName: bytes):
+    def writer(self, conn: _Client):
+        """Drains the send queue of conn, a stalled client only blocks its own writer"""
+        while True:
+            try:
+                code, msg, encrypted, start = conn.outbound.pop()
+            except IndexerClosed:
+                return
+            try:
+                conn.sendMessage(code, msg, encrypted)
+            except (TimeoutError, IndexerClosed, socket.error):
+                conn.logger.warn("Client is not reading")
+                self.evict(conn)
+                return
+            self.metrics.inc("messagesOut")
+            self.metrics.inc("bytesOut", len(msg))
+            if start is not None:
+                self.metrics.observe("fanout", time.perf_counter() - start)
+
+    def send(self, conn: _Client, code: int, msg: bytes, encrypted: bool = False, start: float = None,
+             evicted: list = None):
+        """start : perf_counter of the message being received, for the fan-out latency
+        evicted : conn is added to it instead of being evicted if its queue is full,
+        for callers that hold _recentLock"""
+        if conn.outbound.add((code, msg, encrypted, start)) or conn.outbound.closed:
+            return
+        if self.slowConsumer == "drop":
+            self.metrics.inc("dropped")
+            conn.logger.warn("Send queue is full, message dropped : %s", code)
+        else:
+            conn.logger.warn("Send queue is full")
+            if evicted is None:
+                self.evict(conn)
+            else:
+                evicted.append(conn)
+
+    def sendToMembers(self, conns: list, code, msg, oldMsg: bytes = None, start: float = None,
+                      evicted: list = None):
+        """Sends msg to conns, clients older than version 5 get oldMsg if it is given"""
+        self.logger.debug("Sending to members : %s %s %s", code, len(conns), msg)
+        groups = {}
+        for conn in conns:
+            groups.setdefault(oldMsg if oldMsg is not None and conn.version < 5 else msg, []).append(conn)
+        for payload, conns in groups.items():
+            keyed = [conn for conn in conns if conn.sharedKey]
+            encryptStart = time.perf_counter()
+            payloads = self.encrypter.encrypt(payload, [conn.sharedKey for conn in keyed])
+            self.metrics.observe("encrypt", time.perf_counter() - encryptStart)
+            payloads = dict(zip(keyed, payloads))
+            for conn in conns:
+                if conn in payloads:
+                    self.send(conn, code, payloads[conn], True, start, evicted)
+                else:
+                    self.send(conn, code, payload, start=start, evicted=evicted)
+
+    def evict(self, conn: _Client):
+        """Closes conn without waiting for it, unlike terminateConnection"""
+        if conn.outbound.closed:
+            return
+        self.removeClient(conn)
+        self.metrics.inc("evictions")
         try:
-            userName = userName.decode()
-        except UnicodeDecodeError:
-            return False
-        # TODO return int for determition of inappropriate user name
-        if "\\" in repr(userName) or len(userName) > generalOpts.maxUserNameLenght:
-            return False
-        return userName
+            # Wakes up the writer if it is blocked in sendall
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+        conn.logger.warn("Connection evicted")
 
     def terminateConnection(self, conn: _Client, reason: str):
         try:
-            conn.sendCode(networkOpts.terminateConnection)
-            conn.sendEncoded(reason.encode())
+            conn.sendMessage(networkOpts.terminateConnection, reason.encode())
             conn.close()
             conn.logger.warn("Connection terminated")
         except socket.error as error:
             conn.logger.warn("Error catched : %s", error, exc_info=True)
+        self.removeClient(conn)
+
+    def removeClient(self, conn: _Client):
+        if conn.sharedKey:
+            conn.sharedKey.close()
         try:
             self.clients.remove(conn)
         except ValueError:
@@ -349,22 +1036,32 @@ class Server(_SocketBase):
             self.clientsLoggedIn.remove(conn)
         except ValueError:
             conn.logger.debug("Client not in clientsLoggedIn : %s", conn)
+            return
+        for room in list(conn.rooms):
+            self.partRoom(conn, room, False)
 
 
 class Client(_SocketBase):
     def __init__(self, userName: str, key: bytes, ip: str, port: int = networkOpts.defaultPort):
         super().__init__("network.Client", key)
         self.sock = self
+        self.recvBuffer = _RecvBuffer(self)
         self.userName = userName
+        self.room = roomOpts.default  # room the messages are sent to
         addr = (ip, port)
         self.connect(addr)
+        self.sendCode(networkOpts.version | networkOpts.protocolVersion)
         self._loggedin = False
-        self.passwordRequired = None
-        self.messages = []
+        self.loginResult = _Value("loginResult")
+        self.passwordRequired = _Value("passwordRequired")
+        # Received messages wait here until getMessage, the newest ones are dropped when it is full
+        self.messages = _Indexer("messages", networkOpts.receiveQueueSize)
         self.receiver = self._getMessage()
-        self.result = None
-        self.userNameResult = None
-        self.messageSendable = True
+        self.result = _Indexer("result")
+        self.userNameResult = _Value("userNameResult")
+        self.statsResult = _Value("statsResult")
+        self.messageSendable = th.Event()
+        self.messageSendable.set()
         self._messagesToSend = _Indexer("_messagesToSend")
         _thread(self._messageSender)
         self.logger.info("Message sender started")
@@ -375,49 +1072,79 @@ class Client(_SocketBase):
         while True:
             # if self._loggedin:
             #    breakpoint()
-            code = self.recvCode()
-            self.logger.info("Recevied code : %s", code)
+            try:
+                code = self.recvCode()
+            except OSError:
+                # Reset or closed by terminateConnection, same as a lost connection
+                code = 0
+            self.logger.debug("Recevied code : %s", code)
             if code == networkOpts.passwordRequired:
-                self.passwordRequired = True
+                self.passwordRequired.set(True)
             elif code == networkOpts.passwordNotRequired:
-                self.passwordRequired = False
+                self.passwordRequired.set(False)
             elif code == networkOpts.correctPassword:
-                self.result = networkOpts.correctPassword
+                self.result.add(networkOpts.correctPassword)
             elif code == networkOpts.incorrectPassword:
-                self.result = networkOpts.incorrectPassword
+                self.result.add(networkOpts.incorrectPassword)
             elif code == networkOpts.userName:
-                _thread(self._sendUserName)
+                # A client without a user name only asks for stats
+                if self.userName is not None:
+                    _thread(self._sendUserName)
             elif code == networkOpts.loginSuccessful:
                 self._loggedin = True
+                self.loginResult.set(True)
             elif code == networkOpts.loginFailed:
                 self._loggedin = False
+                self.loginResult.set(False)
             elif code == networkOpts.appropriateUserName:
-                self.userNameResult = True
+                self.userNameResult.set(True)
             elif code == networkOpts.inappropriateUserName:
-                self.userNameResult = False
+                self.userNameResult.set(False)
             elif code == networkOpts.message:
-                _thread(self._recvMsg)
+                self._handle(self._recvMsg)
             elif code == networkOpts.key:
                 _thread(self._sendKey)
             elif code == networkOpts.users:
-                _thread(self._recvUsers)
-            elif code == networkOpts.dataLenght:
-                self._recv(self._dataLength, networkOpts.dataSizeLenght)
-            elif code == networkOpts.hash:
-                self._recv(self._hash, networkOpts.hashLenght)
-            elif code == networkOpts.data:
-                self._recv(self._data, networkOpts.packageSize)
-            elif code == networkOpts.response:
-                self._recv(self._response, 2)
+                self._handle(self._recvUsers)
+            elif code in (networkOpts.userJoined, networkOpts.userLeft):
+                self._handle(self._recvUser, code)
+            elif code == networkOpts.stats:
+                self._handle(self._recvStats)
+            elif code == networkOpts.history:
+                self._handle(self._recvHistory)
+            elif code in (networkOpts.join, networkOpts.part):
+                self._handle(self._recvRoom, code)
+            elif code == networkOpts.version:
+                self.version = min(self.peerVersion, networkOpts.protocolVersion)
+                self.recvVersion = self.version
+                _thread(self.upgrade, self.version)
             elif code == networkOpts.terminateConnection:
-                reason = self.recvDecoded()
+                self._handle(self._recvReason)
             elif code == 0:
+                self.passwordRequired.set(False)
                 self.terminateConnection()
-                self.passwordRequired = False
                 return
             else:
                 pass
 
+    def _handle(self, func, *args):
+        # Payload of a frame is already received, chunks need this thread
+        if self.recvVersion >= 2:
+            func(*args)
+        else:
+            _thread(self._chunked, func, *args)
+
+    def _chunked(self, func, *args):
+        """Runs a receiver of chunks, the connection can be closed while it answers them"""
+        try:
+            func(*args)
+        except (OSError, IndexerClosed):
+            self.logger.debug("Transfer ended with the connection : %s", func.__name__)
+
+    def _recvReason(self):
+        reason = self.recvDecoded()
+        self.logger.warn("Connection terminated by server : %s", reason)
+
     def _sendKey(self):
         self.logger.debug("Sending key")
         self.sendEncoded(self.rawKey)
@@ -428,42 +1155,79 @@ class Client(_SocketBase):
         self.logger.debug("Sending user name")
         self.sendEncoded(self.userName.encode())
         self.logger.debug("User name sent")
-        while self.userNameResult == None:
-            pass
-        if self.userNameResult:
+        if self.userNameResult.take():
             self.logger.debug("User name is okay")
         else:
             self.logger.warn("User name is not appropriate")
-        self.userNameResult = None
 
     def _messageSender(self):
         while True:
-            while not self.messageSendable:
-                pass
-            msg = self._messagesToSend.pop()
-            self.logger.info("Sending message : %s", msg)
-            self.sendMsg(msg)
-            self.logger.info("Message sent : %s", msg)
-            self.messageSendable = False
+            if not self.messageSendable.wait(networkOpts.timeout):
+                self.logger.warn("Previous message was not echoed")
+            try:
+                msg, room = self._messagesToSend.pop()
+            except IndexerClosed:
+                return
+            self.logger.debug("Sending message : %s %s", room, msg)
+            self.messageSendable.clear()
+            try:
+                self.sendMsg(msg, room)
+            except (TimeoutError, IndexerClosed, OSError):
+                self.logger.warn("Message could not be sent : %s", msg)
+                continue
+            self.logger.debug("Message sent : %s", msg)
+
+    def _readRoom(self, payload: bytes) -> tuple:
+        """(room, the rest of a room payload)"""
+        if self.version >= 5:
+            return _ServerBase.readRoom(payload)
+        return roomOpts.default, payload
 
     def _recvMsg(self):
-        msg = self.recvDecoded()
-        self.logger.info("Received message : %s", msg)
-        msg = self._formatMsg(msg)
-        self.messages.append((networkOpts.message, msg))
-        if msg[1].strip() == self.userName:
-            self.messageSendable = True
+        room, msg = self._readRoom(self.recvDecoded())
+        self.logger.debug("Received message : %s %s", room, msg)
+        msg, user = self._formatMsg(msg)
+        self.messages.add((networkOpts.message, (msg, user, room)))
+        if user.strip() == self.userName:
+            self.messageSendable.set()
+
+    def _recvHistory(self):
+        room, history = self._readRoom(self.recvDecoded())
+        msgs = []
+        i = 0
+        while i < len(history):
+            size = self.convertBytes(history[i:i+networkOpts.frameLenght])
+            i += networkOpts.frameLenght
+            msgs.append(self._formatMsg(history[i:i+size]))
+            i += size
+        self.logger.debug("Received history : %s %s messages", room, len(msgs))
+        self.messages.add((networkOpts.history, (msgs, room)))
+
+    def _recvRoom(self, code: int):
+        room = self.recvDecoded().decode(errors="replace")
+        self.logger.info("Room answered : %s %s", code, room)
+        if code == networkOpts.part and room == self.room:
+            self.room = None
+        self.messages.add((code, room))
 
     def _recvUsers(self):
-        _users = self.recvDecoded()
-        self.logger.info("Received users : %s", _users)
+        room, _users = self._readRoom(self.recvDecoded())
+        self.logger.debug("Received users : %s %s", room, _users)
         users = []
         mul, _users = _users[0], _users[1:]
         userCount = len(_users) // mul
         for i in range(userCount):
             user = _users[i*mul:(i+1)*mul]
             users.append(user)
-        self.messages.append((networkOpts.users, users))
+        self.messages.add((networkOpts.users, (users, room)))
+
+    def _recvUser(self, code: int):
+        room, user = self._readRoom(self.recvDecoded())
+        self.logger.debug("Received user : %s %s %s", code, room, user)
+        self.messages.add((code, (user, room)))
+
+    def _recvStats(self):
+        self.statsResult.set(json.loads(self.recvDecoded()))
 
     def _checkPassword(self, password: str):
         try:
@@ -476,18 +1240,10 @@ class Client(_SocketBase):
 
     def _getMessage(self):
         while True:
-            try:
-                msg = self.messages.pop()
-                yield msg
-            except IndexError:
-                pass
+            yield self.messages.pop()
 
     def _getResult(self):
-        while self.result == None:
-            pass
-        result = self.result
-        self.result = None
-        return result
+        return self.result.pop(networkOpts.timeout)
 
     def _formatMsg(self, msg: bytes):
         userNameLen = msg[0]
@@ -496,34 +1252,76 @@ class Client(_SocketBase):
         return (message, userName)
 
     def isLoggedIn(self):
-        for i in range(10):
-            if self._loggedin:
-                return True
-            else:
-                time.sleep(.5)
-        return False
+        try:
+            return bool(self.loginResult.get(5))
+        except TimeoutError:
+            return False
+
+    def closeIndexes(self):
+        super().closeIndexes()
+        for ind in (self.loginResult, self.passwordRequired, self.messages,
+                    self.result, self.userNameResult, self.statsResult, self._messagesToSend):
+            ind.close()
+        self.messageSendable.set()
 
     def terminateConnection(self):
+        try:
+            # close alone does not reach the server while the receiver is in recv
+            self.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.close()
         self.logger.info("Connection terminated")
 
-    def sendMsg(self, msg: str):
+    def _roomMsg(self, msg: str, room: str = None) -> bytes:
+        if self.version >= 5:
+            return _ServerBase.formatRoom(room or self.room or "") + msg.encode()
+        return msg.encode()
+
+    def sendMsg(self, msg: str, room: str = None):
+        """room : the one of the last join if it is not given"""
         if self._loggedin:
-            self.sendCode(networkOpts.message)
-            self.sendEncoded(msg.encode())
+            self.sendMessage(networkOpts.message, self._roomMsg(msg, room))
         else:
             return networkOpts.passwordRequired
 
+    def sendMsgs(self, msgs: list, room: str = None):
+        """Sends the messages with as few writes as the protocol version allows"""
+        if self._loggedin:
+            self.sendMessages(networkOpts.message, [self._roomMsg(msg, room) for msg in msgs])
+        else:
+            return networkOpts.passwordRequired
+
+    def join(self, room: str):
+        """Joins room and sends the next messages to it, the server answers
+        with a join or with a part if it does not let the client in"""
+        if not _ServerBase.checkRoom(room.encode()):
+            raise ValueError("Inappropriate room name : %s" % room)
+        if self.version < 5:
+            raise ConnectionError("Server does not have rooms")
+        self.sendMessage(networkOpts.join, room.encode())
+        self.room = room
+
+    def part(self, room: str):
+        self.sendMessage(networkOpts.part, room.encode())
+
     def getMessage(self):
         return next(self.receiver)
 
     def addToIndex(self, msg):
-        self._messagesToSend.add(msg)
+        """Queues msg for the room it is in now"""
+        self._messagesToSend.add((msg, self.room))
+
+    def stats(self, timeout: float = networkOpts.timeout) -> dict:
+        """Metrics of the server, the password must be passed before"""
+        self.sendCode(networkOpts.stats)
+        stats = self.statsResult.take(timeout)
+        if stats is None:
+            raise ConnectionError("Connection closed")
+        return stats
 
     def isPasswordRequired(self):
-        while self.passwordRequired == None:
-            pass
-        return self.passwordRequired
+        return bool(self.passwordRequired.get())
 
     def login(self, password: str) -> int:
         password = self._checkPassword(password)
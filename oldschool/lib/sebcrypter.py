@@ -1,75 +1,121 @@
-"""Sebcrypter"""
-# 27/11/2021
-import os,random
-
-# CONSTANTS
-KEYFILESIZE = 4096
-BO = "little"  # byte order for byte-int conversions
-
-
-def keygen(fileName = None) -> bytes:
-    """Generates a new random key"""
-    allvalues = list(range(2048))
-    key = bytes()
-    key += b'SEBK'
-    while allvalues:
-        r = random.randint(0, len(allvalues)-1)
-        value = allvalues.pop(r)
-        bytevalue = value.to_bytes(2, BO)
-        key += bytevalue
-    if fileName:
-        with open(fileName,"w") as keyf:
-            keyf.write(key)
-    return key
-
-
-def readkey(keyfile="key.seb",key=None) -> list:
-    """Reads the contents of a key file and converts it
-    can be used with either byte format key or key file name"""
-    if key:
-        content = key[4:]
-    elif os.path.exists(keyfile):
-        with open(keyfile, 'rb') as keyf:
-            if keyf.read(4) != b'SEBK':
-                raise ValueError("The file is not a key file")
-            content = keyf.read()
-    else:
-        raise FileNotFoundError(keyfile)
-    if len(content) == KEYFILESIZE:
-        keytab = []
-        for i in range(256):
-            values = []
-            for j in range(8):
-                bytevalue = content[((i*8)+j)*2:((i*8)+j+1)*2]
-                value = int.from_bytes(bytevalue, BO)
-                values.append(value)
-            keytab.append(tuple(values))
-        return keytab
-    else:
-        raise ValueError("Damaged or invalid file name or key")
-
-
-def encrypt(value: bytes, key: list) -> bytes:
-    """Encrypts the given value by key"""
-    encryptedvalue = bytes()
-    for va in value:
-        r = random.choice(key[va])
-        encryptedvalue += r.to_bytes(2, BO)
-        continue
-    return encryptedvalue
-
-
-def decrypt(value: bytes, key: list) -> bytes:
-    """Decrypts the given value by key"""
-    decryptedvalue = bytes()
-    valuelen = len(value)
-    for i in range(valuelen//2):
-        bytevalue = value[i*2:(i+1)*2]
-        intvalue = int.from_bytes(bytevalue, BO)
-        ind = 0
-        for values in key:
-            if intvalue in values:
-                decryptedvalue += ind.to_bytes(1, BO)
-                break
-            ind += 1
-    return decryptedvalue
+"""Sebcrypter"""
+# 27/11/2021
+import os,random,sys
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# CONSTANTS
+KEYFILESIZE = 4096
+BO = "little"  # byte order for byte-int conversions
+KEYVALUES = 2048
+NUMPYTHRESHOLD = 256  # numpy is slower than the tables below this payload size
+
+
+class KeyTable(list):
+    """Key returned by readkey, key[byte] is the tuple of the values of byte.
+    Keeps flat lookup tables for encrypt and inverse ones for decrypt"""
+
+    def __init__(self, keytab) -> None:
+        super().__init__(keytab)
+        # values[byte*8 + choice] is the encrypted form of byte
+        self.values = [value for values in self for value in values]
+        # inverse[value] is the byte of value, -1 if the key does not have it
+        self.inverse = [-1] * KEYVALUES
+        for ind in reversed(range(len(self))):
+            for value in self[ind]:
+                if value < KEYVALUES:
+                    self.inverse[value] = ind
+        if np is not None:
+            self.npvalues = np.array(self.values, dtype="<u2")
+            self.npinverse = np.array(self.inverse, dtype=np.int16)
+
+
+def _words(values: array) -> array:
+    if sys.byteorder != BO:
+        values.byteswap()
+    return values
+
+
+def keygen(fileName = None) -> bytes:
+    """Generates a new random key"""
+    allvalues = array("H", range(KEYVALUES))
+    random.shuffle(allvalues)
+    key = b'SEBK' + _words(allvalues).tobytes()
+    if fileName:
+        with open(fileName,"wb") as keyf:
+            keyf.write(key)
+    return key
+
+
+def readkey(keyfile="key.seb",key=None) -> KeyTable:
+    """Reads the contents of a key file and converts it
+    can be used with either byte format key or key file name"""
+    if key:
+        content = key[4:]
+    elif os.path.exists(keyfile):
+        with open(keyfile, 'rb') as keyf:
+            if keyf.read(4) != b'SEBK':
+                raise ValueError("The file is not a key file")
+            content = keyf.read()
+    else:
+        raise FileNotFoundError(keyfile)
+    if len(content) == KEYFILESIZE:
+        values = array("H")
+        values.frombytes(content)
+        values = _words(values)
+        keytab = [tuple(values[i*8:(i+1)*8]) for i in range(256)]
+        return KeyTable(keytab)
+    else:
+        raise ValueError("Damaged or invalid file name or key")
+
+
+def encrypt(value: bytes, key: list) -> bytes:
+    """Encrypts the given value by key"""
+    if not isinstance(key, KeyTable):
+        key = KeyTable(key)
+    choices = random.randbytes(len(value))
+    if np is not None and len(value) >= NUMPYTHRESHOLD:
+        data = np.frombuffer(value, dtype=np.uint8).astype(np.intp)
+        choices = np.frombuffer(choices, dtype=np.uint8) & 7
+        return key.npvalues[(data << 3) | choices].tobytes()
+    values = key.values
+    encryptedvalue = array("H", [values[(va << 3) | (r & 7)] for va, r in zip(value, choices)])
+    return _words(encryptedvalue).tobytes()
+
+
+def decrypt(value: bytes, key: list) -> bytes:
+    """Decrypts the given value by key"""
+    if not isinstance(key, KeyTable):
+        key = KeyTable(key)
+    valuelen = len(value) - len(value) % 2
+    try:
+        if np is not None and valuelen >= NUMPYTHRESHOLD * 2:
+            words = np.frombuffer(value, dtype="<u2", count=valuelen // 2)
+            decryptedvalue = key.npinverse[words]
+            if (decryptedvalue < 0).any():
+                raise ValueError("Value is not in the key")
+            return decryptedvalue.astype(np.uint8).tobytes()
+        words = array("H")
+        words.frombytes(value[:valuelen])
+        return bytes(map(key.inverse.__getitem__, _words(words)))
+    except (IndexError, ValueError):
+        # Values that are not in the key are skipped like the table scan does
+        return _decrypt(value, key)
+
+
+def _decrypt(value: bytes, key: list) -> bytes:
+    decryptedvalue = bytearray()
+    valuelen = len(value)
+    for i in range(valuelen//2):
+        bytevalue = value[i*2:(i+1)*2]
+        intvalue = int.from_bytes(bytevalue, BO)
+        ind = 0
+        for values in key:
+            if intvalue in values:
+                decryptedvalue.append(ind)
+                break
+            ind += 1
+    return bytes(decryptedvalue)
@@ -0,0 +1,254 @@
+"""Append-only message store of a server
+
+Messages are records in segment files, [size 4][seq 8][time 8][room size 1]
+[user size 1][room][user][message], size is the one of room, user and
+message and time is in microseconds. The first record of a segment and every
+storeOpts.indexInterval'th after it have an entry in the index file of the
+segment, (seq, time, offset) as three uint64 that are read through mmap, so
+a query finds its first record with two binary searches and reads only the
+records it returns and at most indexInterval others."""
+import atexit
+import os
+import struct
+import threading as th
+import time
+from bisect import bisect_right
+from collections import namedtuple
+
+try:
+    from .consts import storeOpts, roomOpts
+    from .history import _Mapped
+    from lib import _Indexer, IndexerClosed
+except ImportError:
+    from consts import storeOpts, roomOpts
+    from history import _Mapped
+    from __init__ import _Indexer, IndexerClosed
+
+Record = namedtuple("Record", "seq time room user msg")
+
+_header = struct.Struct("<IQQBB")
+_entry = struct.Struct("<QQQ")
+
+
+class _Segment:
+    """Records from seq <first>, written by one thread and read by many"""
+
+    def __init__(self, directory: str, first: int):
+        self.first = first
+        self.path = os.path.join(directory, "%020d" % first)
+        self.data = open(self.path + storeOpts.extension, "a+b")
+        self.index = open(self.path + storeOpts.indexExtension, "a+b")
+        self.size = os.fstat(self.data.fileno()).st_size
+        self.entries = os.fstat(self.index.fileno()).st_size // _entry.size
+        self.last = first - 1  # seq of the last record
+        self.lastTime = 0
+        self._size = self.size  # written but not flushed
+        self._entries = self.entries
+        self._data = _Mapped(self.data)
+        self._index = _Mapped(self.index)
+
+    def rebuild(self):
+        """Indexes the segment again, cuts a partly written last record"""
+        self.index.truncate(0)
+        offset, self.entries = 0, 0
+        self._index.close()
+        for record, end in self.scan(0):
+            if (record.seq - self.first) % storeOpts.indexInterval == 0:
+                self.index.write(_entry.pack(record.seq, round(record.time * 1e6), offset))
+                self.entries += 1
+            self.last, self.lastTime, offset = record.seq, round(record.time * 1e6), end
+        self._data.close()
+        self.data.truncate(offset)
+        self.index.flush()
+        self.size = self._size = offset
+        self._entries = self.entries
+
+    def write(self, seq: int, timestamp: int, room: bytes, user: bytes, msg: bytes):
+        if (seq - self.first) % storeOpts.indexInterval == 0:
+            self.index.write(_entry.pack(seq, timestamp, self._size))
+            self._entries += 1
+        size = len(room) + len(user) + len(msg)
+        self.data.write(_header.pack(size, seq, timestamp, len(room), len(user)) + room + user + msg)
+        self._size += _header.size + size
+        self.last, self.lastTime = seq, timestamp
+
+    def flush(self, sync: bool = False):
+        self.data.flush()
+        self.index.flush()
+        if sync:
+            os.fsync(self.data.fileno())
+            os.fsync(self.index.fileno())
+        # Readers see the records once they are in the file
+        self.size, self.entries = self._size, self._entries
+
+    def entry(self, i: int) -> tuple:
+        return _entry.unpack_from(self._index.view((i + 1) * _entry.size), i * _entry.size)
+
+    def search(self, key: int, value: int) -> int:
+        """Offset of the last indexed record whose seq (key 0) or time (key 1)
+        is lower than value, 0 if there is not one"""
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[key] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return self.entry(low - 1)[2] if low else 0
+
+    def scan(self, offset: int):
+        """Yields (record, offset after it) from offset"""
+        size = self.size
+        if offset >= size:
+            return
+        view = self._data.view(size)
+        while offset + _header.size <= size:
+            length, seq, timestamp, roomLength, userLength = _header.unpack_from(view, offset)
+            start = offset + _header.size
+            end = start + length
+            if end > size:
+                return
+            userStart = start + roomLength
+            msgStart = userStart + userLength
+            room = bytes(view[start:userStart]).decode(errors="replace")
+            user = bytes(view[userStart:msgStart]).decode(errors="replace")
+            yield Record(seq, timestamp / 1e6, room, user, bytes(view[msgStart:end])), end
+            offset = end
+
+    def firstTime(self) -> float:
+        return self.entry(0)[1] / 1e6 if self.entries else None
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+        self.data.close()
+        self.index.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path + storeOpts.extension)
+        os.remove(self.path + storeOpts.indexExtension)
+
+
+class MessageStore:
+    """Keeps the messages of a server in segments of <segmentSize> bytes,
+    only the newest <retention> segments are kept
+
+    append only queues the message, a writer thread writes the queued ones
+    together and syncs them to the disk every <fsyncInterval> seconds,
+    0 syncs every write and None leaves it to the OS. Queries see the
+    messages once they are written."""
+
+    def __init__(self, directory: str = None, segmentSize: int = storeOpts.segmentSize,
+                 retention: int = storeOpts.retention, fsyncInterval: float = storeOpts.fsyncInterval):
+        self.directory = directory or os.path.join(os.path.dirname(__file__), "..", storeOpts.directory)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.segmentSize = segmentSize
+        self.retention = max(retention, 1)
+        self.fsyncInterval = fsyncInterval
+        self._lock = th.Lock()  # seq and time of appends
+        self._readLock = th.Lock()  # segments and their maps
+        self._queue = _Indexer("store")
+        firsts = sorted(int(name[:-len(storeOpts.extension)]) for name in os.listdir(self.directory)
+                        if name.endswith(storeOpts.extension))
+        self.segments = [_Segment(self.directory, first) for first in firsts or [0]]
+        for segment, after in zip(self.segments, self.segments[1:]):
+            segment.last = after.first - 1
+        # Only the last segment can have been cut by a crash
+        self.segments[-1].rebuild()
+        self.written = self.segments[-1].last  # seq of the last written message
+        self._next = self.written + 1
+        self._lastTime = self.segments[-1].lastTime
+        self._synced = time.monotonic()
+        self._writer = th.Thread(target=self._write, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def append(self, user: str, msg: bytes, room: str = roomOpts.default) -> int:
+        """Queues a message and returns its seq"""
+        with self._lock:
+            seq = self._next
+            self._next += 1
+            # Times never go back, so they can be searched
+            self._lastTime = max(int(time.time() * 1e6), self._lastTime)
+            self._queue.add((seq, self._lastTime, room.encode(), user.encode(), msg))
+        return seq
+
+    def _write(self):
+        while True:
+            try:
+                batch = [self._queue.pop()]
+            except IndexerClosed:
+                break
+            while len(self._queue):
+                batch.append(self._queue.pop())
+            segment = self.segments[-1]
+            for seq, timestamp, room, user, msg in batch:
+                if segment._size >= self.segmentSize and segment.last >= segment.first:
+                    segment = self._rotate(segment, seq)
+                segment.write(seq, timestamp, room, user, msg)
+            sync = self.fsyncInterval is not None and time.monotonic() - self._synced >= self.fsyncInterval
+            segment.flush(sync)
+            if sync:
+                self._synced = time.monotonic()
+            self.written = segment.last
+        segment = self.segments[-1]
+        segment.flush(self.fsyncInterval is not None)
+
+    def _rotate(self, segment: _Segment, first: int) -> _Segment:
+        segment.flush(self.fsyncInterval is not None)
+        new = _Segment(self.directory, first)
+        with self._readLock:
+            self.segments.append(new)
+            while len(self.segments) > self.retention:
+                self.segments.pop(0).remove()
+        return new
+
+    def range(self, start: int, stop: int) -> list:
+        """Records with seq in [start, stop)"""
+        stop = min(stop, self.written + 1)
+        result = []
+        with self._readLock:
+            i = max(bisect_right([s.first for s in self.segments], start) - 1, 0)
+            for segment in self.segments[i:]:
+                if segment.first >= stop:
+                    break
+                for record, end in segment.scan(segment.search(0, start + 1)):
+                    if record.seq >= stop:
+                        break
+                    if record.seq >= start:
+                        result.append(record)
+        return result
+
+    def last(self, n: int) -> list:
+        """The newest n records"""
+        return self.range(max(self.written + 1 - n, 0), self.written + 1)
+
+    def since(self, timestamp: float, limit: int = None) -> list:
+        """Records written at or after timestamp, the oldest <limit> of them if limit is given"""
+        value = int(timestamp * 1e6)
+        stop = self.written + 1
+        result = []
+        with self._readLock:
+            times = [s.firstTime() for s in self.segments]
+            i = max(bisect_right([t for t in times if t is not None], timestamp) - 1, 0)
+            for segment in self.segments[i:]:
+                for record, end in segment.scan(segment.search(1, value)):
+                    if record.seq >= stop or (limit is not None and len(result) >= limit):
+                        return result
+                    if round(record.time * 1e6) >= value:
+                        result.append(record)
+        return result
+
+    def __len__(self) -> int:
+        """Messages that are kept"""
+        return self.written + 1 - self.segments[0].first
+
+    def close(self):
+        """Writes the queued messages and closes the files"""
+        self._queue.close()
+        self._writer.join()
+        with self._readLock:
+            for segment in self.segments:
+                segment.close()
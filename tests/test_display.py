@@ -0,0 +1,66 @@
+"""Tests of the display parts that do not draw, run with python -m unittest discover tests"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oldschool"))
+
+from lib.display import _GapBuffer
+
+
+class TestGapBuffer(unittest.TestCase):
+    def check(self, buffer: _GapBuffer, text: str, cursor: int):
+        self.assertEqual(buffer.text(), text)
+        self.assertEqual(buffer.cursor, cursor)
+        self.assertEqual(len(buffer), len(text))
+
+    def test_edit(self):
+        buffer = _GapBuffer()
+        buffer.delete()
+        buffer.deleteForward()
+        self.check(buffer, "", 0)
+        buffer.insert("hello")
+        buffer.move(-3)
+        buffer.insert("ğ")
+        self.check(buffer, "heğllo", 3)
+        buffer.deleteForward()
+        buffer.delete()
+        self.check(buffer, "helo", 2)
+        buffer.move(-10)
+        self.check(buffer, "helo", 0)
+        buffer.move(10)
+        self.check(buffer, "helo", 4)
+        buffer.clear()
+        self.check(buffer, "", 0)
+
+    def test_random_edits(self):
+        """Every edit matches the same edit of a str"""
+        rng = random.Random(15)
+        buffer = _GapBuffer()
+        text, cursor = "", 0
+        for _ in range(5000):
+            action = rng.randrange(5)
+            if action == 0:
+                chars = "".join(rng.choice("abcçğ ") for _ in range(rng.randrange(1, 4)))
+                buffer.insert(chars)
+                text, cursor = text[:cursor] + chars + text[cursor:], cursor + len(chars)
+            elif action == 1:
+                buffer.delete()
+                if cursor:
+                    text, cursor = text[:cursor - 1] + text[cursor:], cursor - 1
+            elif action == 2:
+                buffer.deleteForward()
+                text = text[:cursor] + text[cursor + 1:]
+            else:
+                n = rng.randint(-8, 8)
+                buffer.move(n)
+                cursor = max(0, min(cursor + n, len(text)))
+            self.check(buffer, text, cursor)
+            start = rng.randint(0, len(text) + 2)
+            stop = rng.randint(start, len(text) + 4)
+            self.assertEqual(buffer.slice(start, stop), text[start:stop])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""Tests of the links between servers, run with python -m unittest discover tests"""
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oldschool"))
+
+from lib import _thread
+from lib.consts import federationOpts, roomOpts
+from lib.federation import Federation
+from lib.metrics import Metrics
+
+
+class _Server:
+    """Records what the peers tell a server"""
+
+    def __init__(self):
+        self.metrics = Metrics("test")
+        self.users = {}
+        self.left = []
+
+    def remoteMessage(self, msg: bytes):
+        pass
+
+    def remoteJoined(self, user: tuple, userName: str, room: str):
+        self.users[user + (room,)] = userName
+
+    def remoteLeft(self, user: tuple, room: str):
+        self.left.append(user + (room,))
+        del self.users[user + (room,)]
+
+
+def _port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait(condition, timeout: float = 5) -> bool:
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class TestTriangle(unittest.TestCase):
+    """a, b and c linked to each other, ursula is logged in to c"""
+
+    def setUp(self):
+        self.options = federationOpts.reconnect, federationOpts.heartbeatInterval
+        federationOpts.reconnect = (0.2, 0.5)
+        federationOpts.heartbeatInterval = 0.2
+        portA, portB = _port(), _port()
+        self.a = Federation(portA, secret=b"secret")
+        self.b = Federation(portB, [("127.0.0.1", portA)], b"secret")
+        self.c = Federation(None, [("127.0.0.1", portB)], b"secret")
+        for federation in (self.a, self.b, self.c):
+            federation.start(_Server())
+        self.assertTrue(_wait(lambda: len(self.b.links) == 2))
+        self.c.joined(1, "ursula", roomOpts.default)
+        self.ursula = (self.c.node, 1, roomOpts.default)
+        # a knows her through b before c links to it
+        self.assertTrue(_wait(lambda: self.ursula in self.a.server.users and self.ursula in self.b.server.users))
+        _thread(self.c.connector, "127.0.0.1", portA)
+        self.assertTrue(_wait(lambda: all(len(f.links) == 2 for f in (self.a, self.b, self.c))))
+
+    def tearDown(self):
+        federationOpts.reconnect, federationOpts.heartbeatInterval = self.options
+
+    def missed(self) -> float:
+        """Seconds after which the users of a silent node are forgotten"""
+        return federationOpts.heartbeatInterval * (federationOpts.missedHeartbeats + 2)
+
+    def test_lost_link_keeps_users_of_other_paths(self):
+        for link in self.a.links:
+            if link.node == self.b.node:
+                link.close()
+        time.sleep(self.missed())
+        for federation in (self.a, self.b):
+            self.assertIn(self.ursula, federation.server.users)
+            self.assertEqual(federation.server.left, [])
+
+    def test_left_of_the_home_node(self):
+        self.c.left(1, "ursula", roomOpts.default)
+        self.assertTrue(_wait(lambda: not self.a.server.users and not self.b.server.users))
+
+    def test_users_of_a_lost_node_are_forgotten(self):
+        # c can not link again
+        self.c.secret = b"other"
+        for link in list(self.c.links):
+            link.close()
+        self.assertTrue(_wait(lambda: not self.a.server.users and not self.b.server.users))
+
+    def test_stale_left_of_a_user_that_is_here(self):
+        # a left that a peer made up is answered by the node of the user
+        with self.a._lock:
+            self.a._send([self.a._event(federationOpts.left, self.a._presence(self.ursula, "ursula"))])
+        time.sleep(self.missed())
+        for federation in (self.a, self.b):
+            self.assertIn(self.ursula, federation.server.users)
+
+
+if __name__ == "__main__":
+    unittest.main()
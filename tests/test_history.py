@@ -0,0 +1,88 @@
+"""Tests of the chat history of the client, run with python -m unittest discover tests"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oldschool"))
+
+from lib.consts import historyOpts
+from lib.history import History
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "server")
+        self.histories = []
+
+    def tearDown(self):
+        for history in self.histories:
+            history.close()
+        self.directory.cleanup()
+
+    def open(self) -> History:
+        history = History("server", self.directory.name)
+        self.histories.append(history)
+        return history
+
+    def close(self, history: History):
+        self.histories.remove(history)
+        history.close()
+
+    def fill(self, history: History, n: int):
+        for i in range(n):
+            history.append("user%s" % (i % 3), "message %d ü\n" % i)
+
+    def test_read(self):
+        history = self.open()
+        self.assertEqual(history.read(0, 10), [])
+        self.fill(history, 50)
+        self.assertEqual(len(history), 50)
+        self.assertEqual(history.read(0, 1), [("message 0 ü\n", "user0")])
+        self.assertEqual([m for m, u in history.read(10, 13)], ["message %d ü\n" % i for i in (10, 11, 12)])
+        self.assertEqual(len(history.read(-5, 100)), 50)
+        self.assertEqual(history.read(49, 50)[0][0], "message 49 ü\n")
+        self.assertEqual(history.read(30, 20), [])
+        # Lines written after the files are mapped
+        history.read(0, 50)
+        self.fill(history, 5)
+        self.assertEqual(history.read(50, 55)[-1][0], "message 4 ü\n")
+
+    def test_reopen(self):
+        history = self.open()
+        self.fill(history, 20)
+        self.close(history)
+        history = self.open()
+        self.assertEqual(len(history), 20)
+        self.assertEqual(history.read(19, 20)[0], ("message 19 ü\n", "user1"))
+
+    def test_reopen_after_partly_written_line(self):
+        history = self.open()
+        self.fill(history, 20)
+        self.close(history)
+        size = os.path.getsize(self.path + historyOpts.extension)
+        with open(self.path + historyOpts.extension, "ab") as file:
+            file.write(b'["user0", "cut')
+        history = self.open()
+        self.assertEqual(len(history), 20)
+        self.assertEqual(os.path.getsize(self.path + historyOpts.extension), size)
+        history.append("user2", "after")
+        self.assertEqual(history.read(19, 21)[-1], ("after", "user2"))
+
+    def test_lost_index_is_rebuilt(self):
+        history = self.open()
+        self.fill(history, 20)
+        self.close(history)
+        # Cut in an offset and after one
+        for size in (10 * 8 + 3, 10 * 8):
+            with open(self.path + historyOpts.indexExtension, "r+b") as file:
+                file.truncate(size)
+            history = self.open()
+            self.assertEqual(len(history), 20)
+            self.assertEqual([m for m, u in history.read(0, 20)], ["message %d ü\n" % i for i in range(20)])
+            self.close(history)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tests of the server engines, run with python -m unittest discover tests"""
+import os
+import socket
+import sys
+import threading as th
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oldschool"))
+
+from lib.asyncnetwork import AsyncServer
+from lib.consts import networkOpts, roomOpts
+from lib.network import Server, _Client
+
+
+class _Server(Server):
+    """Server that returns instead of accepting connections"""
+
+    def waitConnection(self):
+        pass
+
+
+class _AsyncServer(AsyncServer):
+    """AsyncServer that returns instead of serving"""
+
+    async def serve(self):
+        pass
+
+
+def _client(server: Server, queueSize: int) -> _Client:
+    """Logged in client of server in the default room, nothing drains its send queue"""
+    sock, _ = socket.socketpair()
+    conn = _Client(sock, ("test", server.id()), None, queueSize)
+    conn.version = 5
+    conn.setUserName("user%s" % conn.addr[1])
+    conn.setId(conn.addr[1])
+    server.clients.append(conn)
+    server.clientsLoggedIn.append(conn)
+    server.joinRoom(conn, roomOpts.default)
+    return conn
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server(port=0, encryptWorkers=1)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_full_queue_during_room_broadcast(self):
+        """A client whose queue fills during a broadcast is evicted, the
+        broadcast does not wait for the lock it holds"""
+        healthy = _client(self.server, 100)
+        slow = _client(self.server, 2)
+        msg = self.server.formatRoom(roomOpts.default) + self.server.formatMessage(b"hi", "user")
+        broadcasts = th.Thread(target=lambda: [self.server.broadcast(msg) for _ in range(5)], daemon=True)
+        broadcasts.start()
+        broadcasts.join(5)
+        self.assertFalse(broadcasts.is_alive(), "broadcast deadlocked")
+        self.assertTrue(slow.outbound.closed)
+        self.assertNotIn(slow, self.server.clientsLoggedIn)
+        self.assertNotIn(slow, self.server.rooms[roomOpts.default])
+        self.assertEqual(self.server.metrics.snapshot()["counters"]["evictions"], 1)
+        codes = [healthy.outbound.pop(0)[0] for _ in range(len(healthy.outbound))]
+        self.assertEqual(codes.count(networkOpts.message), 5)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_engines_export_the_same_metrics(self):
+        server = _Server(port=0, encryptWorkers=1)
+        try:
+            threading = server.metrics.snapshot()
+        finally:
+            server.close()
+        asyncio = _AsyncServer(port=0, encryptWorkers=1).metrics.snapshot()
+        self.assertEqual(sorted(threading["gauges"]), sorted(asyncio["gauges"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
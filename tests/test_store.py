@@ -0,0 +1,126 @@
+"""Tests of the message store, run with python -m unittest discover tests"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oldschool"))
+
+from lib.consts import roomOpts, storeOpts
+from lib.store import MessageStore
+
+
+def _append(store: MessageStore, n: int, room: str = roomOpts.default) -> int:
+    """Appends n messages and waits until they are written, returns the last seq"""
+    for i in range(n):
+        seq = store.append("user%s" % (i % 3), b"message %d" % i, room)
+    end = time.monotonic() + 5
+    while store.written < seq:
+        if time.monotonic() > end:
+            raise TimeoutError("Messages are not written")
+        time.sleep(0.01)
+    return seq
+
+
+class TestMessageStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        self.directory.cleanup()
+
+    def open(self, **kwargs) -> MessageStore:
+        # Small segments so a few hundred messages rotate them
+        kwargs.setdefault("segmentSize", 1024)
+        kwargs.setdefault("retention", 100)
+        store = MessageStore(self.path, fsyncInterval=None, **kwargs)
+        self.stores.append(store)
+        return store
+
+    def close(self, store: MessageStore):
+        self.stores.remove(store)
+        store.close()
+
+    def test_range_across_rotation(self):
+        # Several index entries in every segment
+        store = self.open(segmentSize=4096)
+        last = _append(store, 300)
+        self.assertGreater(len(store.segments), 2)
+        self.assertGreater(store.segments[0].entries, 1)
+        self.assertEqual(len(store), 300)
+        records = store.range(0, last + 1)
+        self.assertEqual([r.seq for r in records], list(range(300)))
+        self.assertEqual(records[123].msg, b"message 123")
+        self.assertEqual(records[123].user, "user0")
+        self.assertEqual(records[123].room, roomOpts.default)
+        for start, stop in ((0, 1), (63, 65), (100, 250), (299, 400), (350, 400)):
+            self.assertEqual([r.seq for r in store.range(start, stop)], list(range(start, min(stop, 300))))
+        # Segments start at any seq, not only at indexed ones
+        for segment in store.segments[1:]:
+            self.assertEqual(store.range(segment.first - 1, segment.first + 1)[-1].seq, segment.first)
+
+    def test_last(self):
+        store = self.open()
+        self.assertEqual(store.last(10), [])
+        _append(store, 200)
+        self.assertEqual([r.seq for r in store.last(10)], list(range(190, 200)))
+        self.assertEqual(len(store.last(1000)), 200)
+
+    def test_since(self):
+        store = self.open(segmentSize=4096)
+        _append(store, 150)
+        time.sleep(0.01)
+        _append(store, 150, "dev")
+        records = store.range(0, 300)
+        for record in (records[0], records[77], records[150], records[299]):
+            value = int(record.time * 1e6)
+            expected = [r.seq for r in records if round(r.time * 1e6) >= value]
+            self.assertEqual([r.seq for r in store.since(record.time)], expected)
+            self.assertEqual([r.seq for r in store.since(record.time, 5)], expected[:5])
+        self.assertEqual({r.room for r in store.since(records[150].time)}, {"dev"})
+        self.assertEqual(store.since(time.time() + 60), [])
+
+    def test_retention(self):
+        store = self.open(retention=2)
+        last = _append(store, 300)
+        self.assertEqual(len(store.segments), 2)
+        first = store.segments[0].first
+        self.assertEqual(len(store), last + 1 - first)
+        self.assertEqual([r.seq for r in store.range(0, last + 1)], list(range(first, last + 1)))
+        files = [name for name in os.listdir(self.path) if name.endswith(storeOpts.extension)]
+        self.assertEqual(len(files), 2)
+
+    def test_reopen(self):
+        store = self.open()
+        last = _append(store, 200)
+        self.close(store)
+        store = self.open()
+        self.assertEqual(store.written, last)
+        self.assertEqual([r.seq for r in store.range(0, last + 1)], list(range(last + 1)))
+        self.assertEqual(_append(store, 1), last + 1)
+
+    def test_reopen_after_partly_written_record(self):
+        store = self.open()
+        last = _append(store, 100)
+        path = store.segments[-1].path + storeOpts.extension
+        self.close(store)
+        size = os.path.getsize(path)
+        with open(path, "ab") as file:
+            # Header of a record whose data was not written
+            file.write(b"\x40\x00\x00\x00" + (last + 1).to_bytes(8, "little") + b"\x00" * 6)
+        store = self.open()
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(store.written, last)
+        self.assertEqual(store.last(1)[0].msg, b"message 99")
+        seq = _append(store, 1)
+        self.assertEqual(seq, last + 1)
+        self.assertEqual(store.range(seq, seq + 1)[0].msg, b"message 0")
+
+
+if __name__ == "__main__":
+    unittest.main()